@@ -0,0 +1,42 @@
+""" Compare the reference extraction of the Saxon and lxml backends
+
+    python -m benchmarks.backends [--books 10] [--chapters 20] [--lines 50] [--cite-data]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from dapitains.tei.backends import BACKENDS
+from dapitains.tei.document import Document
+from benchmarks.synthetic import generate_tei
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=10)
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--cite-data", action="store_true")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = generate_tei(
+            os.path.join(directory, "synthetic.xml"),
+            books=args.books, chapters=args.chapters, lines=args.lines, cite_data=args.cite_data
+        )
+        results = {}
+        for backend in BACKENDS:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                doc = Document(path, backend=backend)
+                results[backend] = {tree: [unit.json() for unit in doc.get_reffs(tree)] for tree in doc.citeStructure}
+                timings.append(time.perf_counter() - start)
+            print(f"{backend:>6}: best {min(timings):.3f}s over {args.repeat} runs")
+        assert all(result == results["saxon"] for result in results.values()), "Backends disagree"
+
+
+if __name__ == "__main__":
+    main()
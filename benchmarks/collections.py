@@ -0,0 +1,100 @@
+""" Measure collection requests and hierarchy queries on a large synthetic catalog
+
+    python -m benchmarks.collections [--branching 100] [--depth 2] [--page-size 50] [--repeat 20]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from flask import Flask
+from dapitains.app.app import create_app
+from dapitains.app.database import Collection
+from dapitains.app.ingest import store_catalog
+from dapitains.metadata.xml_parser import parse
+from benchmarks.synthetic import generate_catalog
+
+
+def timed(client, url: str, repeat: int) -> float:
+    """ Best time of a request, in milliseconds """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--branching", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        catalog, _ = parse(generate_catalog(os.path.join(directory, "catalog.xml"), args.branching, args.depth))
+        app = Flask("collections")
+        app, db = create_app(app, base_uri="http://localhost:5000", collection_page_size=args.page_size)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{directory}/catalog.db"
+        db.init_app(app)
+        start = time.perf_counter()
+        with app.app_context():
+            db.create_all()
+            store_catalog(catalog)
+        print(f"{len(catalog.objects)} collections stored in {time.perf_counter() - start:.1f}s")
+
+        client = app.test_client()
+        last_page = -(-args.branching // args.page_size)
+        for label, url in [
+            ("root, page 1", "/collection/"),
+            (f"root, page {last_page}", f"/collection/?page={last_page}"),
+            ("leaf, parents", f"/collection/?id=https://example.org/root{'.0' * args.depth}&nav=parents"),
+        ]:
+            print(f"{label:>16}: {timed(client, url, args.repeat):.2f}ms")
+
+        with app.app_context():
+            leaf_identifier = f"https://example.org/root{'.0' * args.depth}"
+            leaf = Collection.query.where(Collection.identifier == leaf_identifier).first()
+
+            def children_walk(collection: Collection):
+                # Hierarchy queries with direct relationships only, one query per collection
+                found, queue = [], [collection]
+                while queue:
+                    children = db.session.query(Collection).filter(Collection.parents.any(id=queue.pop().id)).all()
+                    found.extend(children)
+                    queue.extend(children)
+                return found
+
+            def parents_walk(collection: Collection):
+                found, queue = [], [collection]
+                while queue:
+                    parents = db.session.query(Collection).filter(Collection.children.any(id=queue.pop().id)).all()
+                    found.extend(parents)
+                    queue.extend(parents)
+                return found
+
+            for label, before, after in [
+                ("root lookup", lambda: db.session.query(Collection).filter(~Collection.parents.any()).first(),
+                 Collection.root),
+                ("descendants", lambda: children_walk(Collection.root()), lambda: Collection.root().descendants()),
+                ("breadcrumbs", lambda: parents_walk(leaf), leaf.ancestors),
+            ]:
+                timings = {}
+                for name, function in (("before", before), ("after", after)):
+                    runs = []
+                    for _ in range(max(1, args.repeat // 10)):
+                        start = time.perf_counter()
+                        function()
+                        runs.append(time.perf_counter() - start)
+                    timings[name] = min(runs) * 1000
+                print(
+                    f"{label:>16}: {timings['before']:.2f}ms with direct edges, "
+                    f"{timings['after']:.2f}ms with closure"
+                )
+
+
+if __name__ == "__main__":
+    main()
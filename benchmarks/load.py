@@ -0,0 +1,127 @@
+""" Local load test of the Flask and ASGI applications
+
+Both applications serve the same catalog of synthetic resources to `--clients` concurrent clients: the Flask
+application from as many threads, as a threaded WSGI server would, the ASGI application from a single event loop.
+
+    python -m benchmarks.load [--resources 8] [--requests 400] [--clients 16] [--passages 0.2]
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from urllib.parse import quote
+
+from flask import Flask
+from dapitains.app.app import create_app
+from dapitains.app.asgi import create_asgi_app
+from dapitains.app.ingest import store_catalog
+from dapitains.metadata.xml_parser import parse
+from benchmarks.synthetic import generate_tei
+
+
+def write_catalog(directory: str, resources: int, books: int, chapters: int, lines: int) -> str:
+    """ Write a catalog of synthetic resources and return its path """
+    members = []
+    for index in range(resources):
+        path = generate_tei(
+            os.path.join(directory, f"resource-{index}.xml"), books=books, chapters=chapters, lines=lines, seed=index
+        )
+        members.append(
+            f'<resource identifier="https://example.org/resource-{index}" filepath="{path}">'
+            f'<title>Resource {index}</title></resource>'
+        )
+    catalog = os.path.join(directory, "catalog.xml")
+    with open(catalog, "w") as f:
+        f.write(
+            '<collection identifier="https://example.org/catalog"><title>Catalog</title>'
+            f'<members>{"".join(members)}</members></collection>'
+        )
+    return catalog
+
+
+def build_requests(args: argparse.Namespace) -> List[str]:
+    rng = random.Random(42)
+    requests = []
+    for _ in range(args.requests):
+        resource = quote(f"https://example.org/resource-{rng.randrange(args.resources)}", safe="")
+        book, chapter = rng.randint(1, args.books), rng.randint(1, args.chapters)
+        draw = rng.random()
+        if draw < args.passages:
+            requests.append(f"/document/?resource={resource}&ref={book}.{chapter}")
+        elif draw < args.passages + (1 - args.passages) / 2:
+            requests.append(f"/navigation/?resource={resource}&ref={book}&down=2")
+        else:
+            requests.append(f"/collection/?id={resource}")
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--resources", type=int, default=8)
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--chapters", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--passages", type=float, default=0.2, help="Share of passage requests")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        catalog, _ = parse(write_catalog(directory, args.resources, args.books, args.chapters, args.lines))
+        requests = build_requests(args)
+
+        flask_app = Flask("flask")
+        flask_app, db = create_app(flask_app, base_uri="http://localhost:5000")
+        flask_app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{directory}/flask.db"
+        db.init_app(flask_app)
+        with flask_app.app_context():
+            db.create_all()
+            store_catalog(catalog)
+
+        client = flask_app.test_client()
+        with ThreadPoolExecutor(args.clients) as threads:
+            start = time.perf_counter()
+            statuses = list(threads.map(lambda url: client.get(url).status_code, requests))
+            elapsed = time.perf_counter() - start
+        assert set(statuses) == {200}, statuses
+        print(f"flask: {len(requests) / elapsed:.1f} requests/s with {args.clients} threads")
+
+        asgi_app, db = create_asgi_app(Flask("asgi"), base_uri="http://localhost:5000")
+        asgi_app.app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{directory}/flask.db"
+        db.init_app(asgi_app.app)
+
+        async def get(url: str, semaphore: asyncio.Semaphore) -> int:
+            path, _, query = url.partition("?")
+            messages = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                messages.append(message)
+
+            async with semaphore:
+                await asgi_app({
+                    "type": "http", "http_version": "1.1", "method": "GET", "path": path,
+                    "query_string": query.encode(), "headers": [(b"host", b"localhost:5000")]
+                }, receive, send)
+            return messages[0]["status"]
+
+        async def run() -> List[int]:
+            semaphore = asyncio.Semaphore(args.clients)
+            return await asyncio.gather(*[get(url, semaphore) for url in requests])
+
+        start = time.perf_counter()
+        statuses = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        asgi_app.shutdown()
+        assert set(statuses) == {200}, statuses
+        print(f" asgi: {len(requests) / elapsed:.1f} requests/s with {args.clients} concurrent clients")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+""" Measure the throughput of passage rendering in the calling process against a pool of worker processes
+
+The pool is fed by concurrent threads. The in-process baseline renders passages one after the other: the GIL and
+the Saxon lock serialize rendering in a single process anyway.
+
+    python -m benchmarks.passages [--files 4] [--requests 64] [--threads 8] [--workers 1 2 4]
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dapitains.app.workers import PassagePool, render_passage
+from dapitains.tei.document import Document
+from benchmarks.synthetic import generate_tei
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [
+            generate_tei(
+                os.path.join(directory, f"synthetic-{index}.xml"),
+                books=args.books, chapters=args.chapters, lines=args.lines, seed=index
+            )
+            for index in range(args.files)
+        ]
+        # Range over a whole book, the requests are spread over the files
+        requests = [
+            (paths[index % args.files], "1.1.1", f"1.{args.chapters}.{args.lines}")
+            for index in range(args.requests)
+        ]
+
+        documents = {path: Document(path) for path in paths}
+        start = time.perf_counter()
+        for path, ref, end in requests:
+            render_passage(documents[path], ref, end=end)
+        elapsed = time.perf_counter() - start
+        print(f"  in process: {len(requests) / elapsed:.2f} passages/s")
+
+        for workers in args.workers:
+            pool = PassagePool(workers=workers, timeout=None, max_pending=len(requests))
+            # Start the workers and fill their document caches before measuring
+            with ThreadPoolExecutor(args.threads) as threads:
+                list(threads.map(lambda path: pool.render(path, "1.1.1"), paths))
+                start = time.perf_counter()
+                list(threads.map(lambda request: pool.render(request[0], request[1], end=request[2]), requests))
+                elapsed = time.perf_counter() - start
+            pool.shutdown()
+            print(f"{workers:>2} worker(s): {len(requests) / elapsed:.2f} passages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+""" Latency of passages read in sequence, with and without prefetching of the following passage
+
+Each session reads consecutive chapters of a resource, pausing between requests as a reader would.
+
+    python -m benchmarks.prefetch [--resources 8] [--sessions 20] [--think 0.05]
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+from flask import Flask
+from dapitains.app.app import create_app
+from dapitains.app.caching import PassageCache
+from dapitains.app.ingest import store_catalog
+from dapitains.app.prefetch import Prefetcher
+from dapitains.metadata.xml_parser import parse
+from benchmarks.load import write_catalog
+
+
+def build_sessions(args: argparse.Namespace) -> List[List[str]]:
+    rng = random.Random(42)
+    sessions = []
+    for _ in range(args.sessions):
+        resource = quote(f"https://example.org/resource-{rng.randrange(args.resources)}", safe="")
+        book = rng.randint(1, args.books)
+        first = rng.randint(1, args.chapters - args.length + 1)
+        sessions.append([
+            f"/document/?resource={resource}&ref={book}.{chapter}" for chapter in range(first, first + args.length)
+        ])
+    return sessions
+
+
+def measure(app: Flask, sessions: List[List[str]], think: float) -> Dict[str, float]:
+    """ Latency percentiles of the requests, in milliseconds """
+    client = app.test_client()
+    timings = []
+    for urls in sessions:
+        for url in urls:
+            start = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, (url, response.status_code)
+            time.sleep(think)
+    quantiles = statistics.quantiles(timings, n=20)
+    return {"p50": statistics.median(timings) * 1000, "p95": quantiles[-1] * 1000}
+
+
+def run(directory: str, name: str, catalog, sessions, think: float, prefetcher: Optional[Prefetcher]):
+    app, db = create_app(
+        Flask(name), base_uri="http://localhost:5000", passage_cache=PassageCache(), prefetcher=prefetcher
+    )
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{directory}/{name}.db"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        store_catalog(catalog)
+    return measure(app, sessions, think)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--resources", type=int, default=8)
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--chapters", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--length", type=int, default=5, help="Number of consecutive chapters read by a session")
+    parser.add_argument("--think", type=float, default=0.05, help="Seconds between two requests of a session")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        catalog, _ = parse(write_catalog(directory, args.resources, args.books, args.chapters, args.lines))
+        sessions = build_sessions(args)
+        before = run(directory, "plain", catalog, sessions, args.think, None)
+        prefetcher = Prefetcher()
+        after = run(directory, "prefetch", catalog, sessions, args.think, prefetcher)
+        prefetcher.shutdown()
+
+        for percentile in ("p50", "p95"):
+            print(f"{percentile}: {before[percentile]:.2f} ms -> {after[percentile]:.2f} ms")
+        stats = prefetcher.stats()
+        print(f"{stats['rendered']} prefetched, {stats['skipped']} skipped, hit rate {stats['hit_rate']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
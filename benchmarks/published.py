@@ -0,0 +1,84 @@
+""" Latency of the endpoints served from the ingest database and from its published, read-only copy
+
+    python -m benchmarks.published [--resources 8] [--requests 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+from urllib.parse import quote
+
+from flask import Flask
+from dapitains.app.app import create_app
+from dapitains.app.ingest import store_catalog, publish_catalog
+from dapitains.metadata.xml_parser import parse
+from benchmarks.load import write_catalog
+
+
+def build_requests(args: argparse.Namespace) -> Dict[str, List[str]]:
+    rng = random.Random(42)
+    requests = {"collection": [], "navigation": [], "document": []}
+    for _ in range(args.requests):
+        resource = quote(f"https://example.org/resource-{rng.randrange(args.resources)}", safe="")
+        book, chapter = rng.randint(1, args.books), rng.randint(1, args.chapters)
+        requests["collection"].append(f"/collection/?id={resource}")
+        requests["navigation"].append(f"/navigation/?resource={resource}&ref={book}&down=2")
+        requests["document"].append(f"/document/?resource={resource}&ref={book}.{chapter}")
+    return requests
+
+
+def measure(app: Flask, requests: Dict[str, List[str]]) -> Dict[str, float]:
+    """ Median latency of each endpoint, in milliseconds """
+    client = app.test_client()
+    latencies = {}
+    for endpoint, urls in requests.items():
+        timings = []
+        for url in urls:
+            start = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, (url, response.status_code)
+        latencies[endpoint] = statistics.median(timings) * 1000
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--resources", type=int, default=8)
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--chapters", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        catalog, _ = parse(write_catalog(directory, args.resources, args.books, args.chapters, args.lines))
+        requests = build_requests(args)
+
+        ingest, db = create_app(Flask("ingest"), base_uri="http://localhost:5000")
+        ingest.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{directory}/ingest.db"
+        db.init_app(ingest)
+        with ingest.app_context():
+            db.create_all()
+            store_catalog(catalog)
+        before = measure(ingest, requests)
+
+        with ingest.app_context():
+            publish_catalog(os.path.join(directory, "published.db"))
+        published, db = create_app(
+            Flask("published"), base_uri="http://localhost:5000",
+            read_only_database=os.path.join(directory, "published.db")
+        )
+        db.init_app(published)
+        after = measure(published, requests)
+
+        for endpoint in requests:
+            print(f"{endpoint:>10}: {before[endpoint]:.2f} ms -> {after[endpoint]:.2f} ms (median)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+""" Generators of synthetic TEI files used by the benchmarks """
+import os
+import random
+
+
+TEI_HEADER = """<TEI xmlns="http://www.tei-c.org/ns/1.0">
+    <teiHeader>
+        <refsDecl n="nums" default="true">
+            <citeStructure unit="book" match="//body/div" use="@n">
+                <citeStructure unit="chapter" match="div" use="@n" delim=".">
+                    <citeStructure unit="line" match="l" use="@n" delim=".">{cite_data}</citeStructure>
+                </citeStructure>
+            </citeStructure>
+        </refsDecl>
+        <refsDecl n="ids">
+            <citeStructure unit="book" match="//body/div" use="@xml:id">
+                <citeStructure unit="chapter" match="div" use="position()" delim="/"/>
+            </citeStructure>
+        </refsDecl>
+    </teiHeader>
+    <text>
+        <body>
+"""
+
+CITE_DATA = """
+                        <citeData use="./@ana" property="http://purl.org/dc/terms/subject"/>
+                        <citeData use="./persName/text()" property="http://purl.org/dc/terms/creator"/>"""
+
+
+def generate_tei(
+        path: str,
+        books: int = 10,
+        chapters: int = 20,
+        lines: int = 50,
+        cite_data: bool = False,
+        seed: int = 42
+) -> str:
+    """ Write a TEI file with books * chapters * lines citable lines
+
+    :param path: Path of the file to write
+    :param books: Number of books
+    :param chapters: Number of chapters per book
+    :param lines: Number of lines per chapter
+    :param cite_data: Add citeData to the line level
+    :param seed: Seed of the random generator used for line content
+    :return: Path of the written file
+    """
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(TEI_HEADER.format(cite_data=CITE_DATA if cite_data else ""))
+        for book in range(1, books + 1):
+            f.write(f'            <div n="{book}" xml:id="book-{book}">\n')
+            for chapter in range(1, chapters + 1):
+                f.write(f'                <div n="{chapter}">\n')
+                for line in range(1, lines + 1):
+                    text = " ".join(rng.choice(words) for _ in range(8))
+                    f.write(f'                    <l n="{line}" ana="#{rng.choice(words)}">{text} '
+                            f'<persName>{rng.choice(words).title()}</persName></l>\n')
+                f.write("                </div>\n")
+            f.write("            </div>\n")
+        f.write("        </body>\n    </text>\n</TEI>")
+    return path
+
+
+def generate_catalog(path: str, branching: int = 30, depth: int = 3) -> str:
+    """ Write a catalog of nested collections, with branching ** depth collections at the lowest level
+
+    Collections do not point to files: the catalog exercises the collection hierarchy only.
+
+    :param path: Path of the file to write
+    :param branching: Number of members of each collection
+    :param depth: Number of levels under the root collection
+    :return: Path of the written file
+    """
+    def write(f, identifier: str, level: int):
+        f.write(f'<collection identifier="https://example.org/{identifier}"><title>Collection {identifier}</title>')
+        if level < depth:
+            f.write("<members>")
+            for index in range(branching):
+                write(f, f"{identifier}.{index}", level + 1)
+            f.write("</members>")
+        f.write("</collection>")
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        write(f, "root", 0)
+    return path
@@ -0,0 +1,50 @@
+""" Stress Document from many threads and report throughput and correctness
+
+Each thread alternates between a shared Document and a Document of its own, resolving references and rendering
+passages. Results are checked against a single-threaded run.
+
+    python -m benchmarks.threads [--threads 1 4 16 32] [--jobs 400] [--backend auto]
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+from dapitains.tei.document import Document
+from benchmarks.synthetic import generate_tei
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--jobs", type=int, default=400)
+    parser.add_argument("--backend", default="auto", choices=["auto", "saxon", "lxml"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = generate_tei(os.path.join(directory, "synthetic.xml"), books=4, chapters=10, lines=20)
+        shared = Document(path, backend=args.backend)
+        refs = [f"{book}.{chapter}" for book in range(1, 5) for chapter in range(1, 11)]
+
+        def job(index: int):
+            doc = shared if index % 2 else Document(path, backend=args.backend)
+            ref = refs[index % len(refs)]
+            return (
+                [unit.json() for unit in doc.get_reffs("nums")],
+                etree.tostring(doc.get_passage(ref, tree="nums"), encoding=str)
+            )
+
+        expected = [job(index) for index in range(len(refs) * 2)]
+        for threads in args.threads:
+            with ThreadPoolExecutor(threads) as executor:
+                start = time.perf_counter()
+                results = list(executor.map(job, range(args.jobs)))
+                elapsed = time.perf_counter() - start
+            errors = sum(result != expected[index % len(expected)] for index, result in enumerate(results))
+            print(f"{threads:>3} thread(s): {args.jobs / elapsed:.1f} jobs/s, {errors} wrong result(s)")
+
+
+if __name__ == "__main__":
+    main()
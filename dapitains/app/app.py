@@ -1,8 +1,8 @@
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple, Union
 
 try:
     import uritemplate
-    from flask import Flask, request, Response
+    from flask import Flask, request, Response, send_file, stream_with_context
     from flask_sqlalchemy import SQLAlchemy
     import click
 except ImportError:
@@ -10,47 +10,104 @@ except ImportError:
     raise
 
 import json
-import lxml.etree as ET
-from dapitains.tei.document import Document
+from dapitains.tei.sources import iter_source
 from dapitains.errors import InvalidRangeOrder
-from dapitains.app.database import db, Collection, Navigation
-from dapitains.app.navigation import get_nav, get_member_by_path
+from dapitains.app.database import (
+    db, Collection, Navigation, Reference, parent_child_association, read_only_config
+)
+from dapitains.app.navigation import select_nav, get_member_by_path, iter_dumps_with_fragments, RawJSON
+from dapitains.app.caching import PassageCache
+from dapitains.app.compression import Compression
+from dapitains.app.export import export_site
+from dapitains.app.ingest import build_pending_trees, ensure_tree
+from dapitains.app.navigation_index import NavigationIndex, NavigationIndexes
+from dapitains.app.prefetch import Prefetcher
+from dapitains.app.snapshot import CatalogCache, CatalogSnapshot
+from dapitains.app.warmup import Warmup, hot_uris, replay
+from dapitains.app.workers import PassagePool, PoolBusy, PassageTimeout, render_file_passage
 
 
 def msg_4xx(string, code=404) -> Response:
     return Response(json.dumps({"message": string}), status=code, mimetype="application/json")
 
 
+def page_bounds(total: int, page: Optional[int], page_size: Optional[int], kind: str) -> Union[Tuple[int, int], Response]:
+    """ Check a requested page of members
+
+    :param total: Number of members
+    :param page: Requested page, the first one by default
+    :param page_size: Number of members by page, None when the server does not paginate
+    :param kind: Kind of members, for error messages
+    :return: Page and last page, or the error response
+    """
+    if not page_size:
+        return msg_4xx(f"This server does not paginate {kind} members", code=400)
+    page = 1 if page is None else page
+    last_page = max(1, -(-total // page_size))
+    if page < 1 or page > last_page:
+        return msg_4xx(f"Page {page} does not exist, pages go from 1 to {last_page}", code=404)
+    return page, last_page
+
+
+def pagination_view(page_uri: Callable[[int], str], page: int, last_page: int) -> Dict[str, Any]:
+    """ Pagination object linking a page of members to the other ones """
+    return {
+        "@id": page_uri(page),
+        "@type": "Pagination",
+        "first": page_uri(1),
+        "previous": page_uri(page - 1) if page > 1 else None,
+        "next": page_uri(page + 1) if page < last_page else None,
+        "last": page_uri(last_page)
+    }
+
+
 def collection_view(
         identifier: Optional[str],
         nav: str,
-        templates: Dict[str, uritemplate.URITemplate]
+        templates: Dict[str, uritemplate.URITemplate],
+        page: Optional[int] = None,
+        page_size: Optional[int] = None
 ) -> Response:
     """ Builds a collection view, regardless of how the parameters are received
 
     :param identifier:
     :param nav:
     :param templates:
+    :param page: Page of members to return, the first one by default when members are paginated
+    :param page_size: Number of members by page, members are not paginated without it
     """
     if not identifier:
-        coll: Collection = db.session.query(Collection).filter(~Collection.parents.any()).first()
+        coll: Collection = Collection.root()
     else:
         coll = Collection.query.where(Collection.identifier==identifier).first()
     if coll is None:
         return msg_4xx("Unknown collection")
     out = coll.json()
 
+    # Members are sought by their rank in the collection, so that every page costs the same
     if nav == 'children':
-        related_collections = db.session.query(Collection).filter(
-            Collection.parents.any(id=coll.id)
-        ).all()
+        rank = parent_child_association.c.position
+        related_query = db.session.query(Collection).join(
+            parent_child_association, parent_child_association.c.child_id == Collection.id
+        ).filter(parent_child_association.c.parent_id == coll.id)
+        total = coll.total_children
     elif nav == 'parents':
-        related_collections = db.session.query(Collection).filter(
-            Collection.children.any(id=coll.id)
-        ).all()
+        rank = parent_child_association.c.parent_position
+        related_query = db.session.query(Collection).join(
+            parent_child_association, parent_child_association.c.parent_id == Collection.id
+        ).filter(parent_child_association.c.child_id == coll.id)
+        total = coll.total_parents
     else:
         return msg_4xx(f"nav parameter has a wrong value {nav}", code=400)
 
+    if page is not None or page_size:
+        bounds = page_bounds(total, page, page_size, "collection")
+        if isinstance(bounds, Response):
+            return bounds
+        page, last_page = bounds
+        related_query = related_query.filter(rank >= (page - 1) * page_size, rank < page * page_size)
+    related_collections = related_query.order_by(rank).all()
+
     def inject_json(related: Collection) -> Dict:
         if related.resource:
             inj = {
@@ -69,7 +126,7 @@ def collection_view(
 
         return inj
 
-    return Response(json.dumps({
+    response = {
         "@context": "https://distributed-text-services.github.io/specifications/context/1-alpha1.json",
         "dtsVersion": "1-alpha",
         **out,
@@ -82,10 +139,89 @@ def collection_view(
                 )
                 for related in related_collections
             ]
-    }), mimetype="application/ld+json", status=200)
+    }
+    if page_size:
+        def page_uri(number: int) -> str:
+            return templates["collection"].expand({"id": coll.identifier, "page": number, "nav": nav})
+
+        response["view"] = pagination_view(page_uri, page, last_page)
 
+    return Response(json.dumps(response), mimetype="application/ld+json", status=200)
 
-def document_view(resource, ref, start, end, tree) -> Response:
+
+def snapshot_collection_view(
+        snapshot: CatalogSnapshot,
+        identifier: Optional[str],
+        nav: str,
+        templates: Dict[str, uritemplate.URITemplate],
+        page: Optional[int] = None,
+        page_size: Optional[int] = None
+) -> Response:
+    """ Builds a collection view from a catalog snapshot, with the payload of :func:`collection_view`
+
+    Representations are serialized in the snapshot: the response is assembled without touching the database.
+    """
+    entry = snapshot.get(identifier)
+    if entry is None:
+        return msg_4xx("Unknown collection")
+
+    if nav == 'children':
+        related = entry.children
+    elif nav == 'parents':
+        related = entry.parents
+    else:
+        return msg_4xx(f"nav parameter has a wrong value {nav}", code=400)
+
+    view = None
+    if page is not None or page_size:
+        bounds = page_bounds(len(related), page, page_size, "collection")
+        if isinstance(bounds, Response):
+            return bounds
+        page, last_page = bounds
+        related = related[(page - 1) * page_size:page * page_size]
+
+        def page_uri(number: int) -> str:
+            return templates["collection"].expand({"id": entry.identifier, "page": number, "nav": nav})
+
+        view = pagination_view(page_uri, page, last_page)
+
+    members = ", ".join(
+        snapshot.entries[member].as_member(entry.total_parents, entry.total_children)
+        for member in related
+    )
+    head = json.dumps({
+        "@context": "https://distributed-text-services.github.io/specifications/context/1-alpha1.json",
+        "dtsVersion": "1-alpha"
+    })[:-1]
+    body = (
+        f'{head}, {entry.fields}, "totalParents": {entry.total_parents}, "totalChildren": {entry.total_children}, '
+        f'"collection": {json.dumps(templates["collection"].uri)}, "member": [{members}]'
+    )
+    if view:
+        body += f', "view": {json.dumps(view)}'
+    return Response(body + "}", mimetype="application/ld+json", status=200)
+
+
+def document_view(
+        resource,
+        ref,
+        start,
+        end,
+        tree,
+        pool: Optional[PassagePool] = None,
+        compression: Optional[Compression] = None,
+        encoding: Optional[str] = None,
+        passages: Optional[PassageCache] = None,
+        prefetcher: Optional[Prefetcher] = None
+) -> Response:
+    """ Builds a document view
+
+    :param pool: Worker processes rendering passages
+    :param compression: Compression of the application, full documents are sent in their compressed variant
+    :param encoding: Encoding negotiated with the client
+    :param passages: Cache of rendered passages, shared by concurrent identical requests
+    :param prefetcher: Prefetcher of the passages following single references, which requires `passages`
+    """
     if not resource:
         return msg_4xx("Resource parameter was not provided")
 
@@ -93,44 +229,133 @@ def document_view(resource, ref, start, end, tree) -> Response:
     if not collection:
         return msg_4xx(f"Unknown resource `{resource}`")
 
-    nav: Navigation = Navigation.query.where(Navigation.collection_id == collection.id).first()
-    if nav is None:
+    # Citation trees are stored on the collection: the Navigation row is not needed to answer passage requests
+    if not collection.citeStructure:
         return msg_4xx(f"The resource `{resource}` does not support navigation")
 
     tree = tree or collection.default_tree
 
     # Check for forbidden combinations
     if ref or start or end:
-        if tree not in nav.references:
+        if tree not in collection.citeStructure:
             return msg_4xx(f"Unknown tree {tree} for resource `{resource}`")
         elif ref and (start or end):
             return msg_4xx(f"You cannot provide a ref parameter as well as start or end", code=400)
         elif not ref and ((start and not end) or (end and not start)):
             return msg_4xx(f"Range is missing one of its parameters (start or end)", code=400)
 
-    paths = nav.paths[tree]
-    if start and end and (start not in paths or end not in paths):
+    if not ref and not start:
+        variant = compression.variant(collection.filepath, encoding) if compression and encoding else None
+        if variant:
+            response = send_file(variant, mimetype="application/xml")
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            return response
+        # Streamed, and decompressed on the fly for compressed sources
+        return Response(iter_source(collection.filepath), mimetype="application/xml")
+
+    ensure_tree(collection, tree)
+    # Existence, order and reconstruction plans of the requested references come from the indexed refs table
+    rows = {
+        row.ref: row
+        for row in db.session.query(Reference.ref, Reference.ordinal, Reference.level, Reference.plan).filter(
+            Reference.collection_id == collection.id,
+            Reference.tree == tree,
+            Reference.ref.in_([value for value in (ref, start, end) if value])
+        )
+    }
+    if start and end and (start not in rows or end not in rows):
         return msg_4xx(f"Unknown reference {start} or {end} in the requested tree.", code=404)
-    if ref and ref not in paths:
+    if ref and ref not in rows:
         return msg_4xx(f"Unknown reference {ref} in the requested tree.", code=404)
+    if start and end and rows[start].ordinal > rows[end].ordinal:
+        return msg_4xx("End reference comes before start in the document order. Interchange start and end.", code=400)
+    plans = {value: row.plan for value, row in rows.items()}
 
-    if not ref and not start:
-        with open(collection.filepath) as f:
-            content = f.read()
-        return Response(content, mimetype="application/xml")
-
-    doc = Document(collection.filepath)
-    return Response(
-        ET.tostring(doc.get_passage(
-            ref_or_start=ref or start,
-            end=end,
-            tree=tree
-        ), encoding=str),
-        mimetype="application/xml"
-    )
+    def render() -> str:
+        return render_file_passage(
+            collection.filepath, ref or start, end=end, tree=tree, plans=plans, pool=pool,
+            content_hash=collection.content_hash
+        )
 
+    try:
+        if passages is None:
+            passage = render()
+        else:
+            key = PassageCache.key(resource, tree, ref or start, end, collection.content_hash)
+            if prefetcher is not None:
+                prefetcher.served(key)
+            passage = passages.get_or_render(key, render)
+    except PoolBusy:
+        return msg_4xx("Too many passages are being rendered, retry later", code=503)
+    except PassageTimeout:
+        return msg_4xx("The passage could not be rendered in time", code=504)
+    if prefetcher is not None and passages is not None and ref:
+        # Readers going through a text request the following reference next
+        prefetcher.schedule(
+            resource, collection.id, collection.filepath, collection.content_hash, tree,
+            rows[ref].ordinal, rows[ref].level
+        )
+    return Response(passage, mimetype="application/xml")
+
+
+def iter_member_fragments(
+        collection_id: int,
+        tree: str,
+        refs: List[str],
+        batch_size: int = 500
+) -> Iterator[RawJSON]:
+    """ Retrieve the serialized members of references, stored at ingest, one batch of rows at a time
+
+    :param collection_id: Database identifier of the resource
+    :param tree: Citation tree of the references
+    :param refs: References to retrieve, in document order
+    :param batch_size: Number of rows read at once
+    :return: Members, in the order of `refs`
+    """
+    if not refs:
+        return
+    scope = (Reference.collection_id == collection_id, Reference.tree == tree)
+    ordinals = [
+        ordinal
+        for ordinal, in db.session.query(Reference.ordinal).filter(*scope, Reference.ref.in_({refs[0], refs[-1]}))
+    ]
+    lowest, highest = min(ordinals), max(ordinals)
+    if highest - lowest < 2 * len(refs):
+        # Dense selections (eg. `down=-1`) are read as a range of the document order
+        selected = set(refs)
+        rows = db.session.query(Reference.ref, Reference.member).filter(
+            *scope, Reference.ordinal.between(lowest, highest)
+        ).order_by(Reference.ordinal).yield_per(batch_size)
+        for ref, member in rows:
+            if ref in selected:
+                yield RawJSON(member)
+    else:
+        for offset in range(0, len(refs), batch_size):
+            batch = refs[offset:offset + batch_size]
+            members = dict(db.session.query(Reference.ref, Reference.member).filter(*scope, Reference.ref.in_(batch)))
+            for ref in batch:
+                yield RawJSON(members[ref])
+
+
+def navigation_view(
+        resource,
+        ref,
+        start,
+        end,
+        tree,
+        down,
+        templates: Dict[str, uritemplate.URITemplate],
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        indexes: Optional[NavigationIndexes] = None
+) -> Response:
+    """ Builds a navigation view
 
-def navigation_view(resource, ref, start, end, tree, down, templates: Dict[str, uritemplate.URITemplate]) -> Response:
+    Members are streamed from the database into the response. With `page_size`, members are also paginated: `page`
+    (the first one by default) is returned with a `view` object linking to the other pages. When the citation tree
+    has a navigation index in `indexes`, members are read from the index instead of the database.
+    """
     if not resource:
         return msg_4xx("Resource parameter was not provided")
 
@@ -138,15 +363,20 @@ def navigation_view(resource, ref, start, end, tree, down, templates: Dict[str,
     if not collection:
         return msg_4xx(f"Unknown resource `{resource}`")
 
-    nav: Navigation = Navigation.query.where(Navigation.collection_id == collection.id).first()
-    if nav is None:
-        return msg_4xx(f"The resource `{resource}` does not support navigation")
-
     tree = tree or collection.default_tree
+    ensure_tree(collection, tree)
+
+    # Indexes are only written for resources with a navigation
+    index: Optional[NavigationIndex] = indexes.get(resource, tree) if indexes is not None else None
+    nav: Optional[Navigation] = None
+    if index is None:
+        nav = Navigation.query.where(Navigation.collection_id == collection.id).first()
+        if nav is None:
+            return msg_4xx(f"The resource `{resource}` does not support navigation")
 
     # Check for forbidden combinations
     if ref or start or end:
-        if tree not in nav.references:
+        if tree not in collection.citeStructure:
             return msg_4xx(f"Unknown tree {tree} for resource `{resource}`")
         elif ref and (start or end):
             return msg_4xx(f"You cannot provide a ref parameter as well as start or end", code=400)
@@ -154,28 +384,34 @@ def navigation_view(resource, ref, start, end, tree, down, templates: Dict[str,
             return msg_4xx(f"Range is missing one of its parameters (start or end)", code=400)
 
     # Start the response
+    query = {"ref": ref, "down": down, "start": start, "end": end, "tree": tree}
     out = {
         "@context": "https://distributed-text-services.github.io/specifications/context/1-alpha1.json",
         "dtsVersion": "1-alpha",
         "@type": "Navigation",
-        "@id": templates["navigation"].expand({
-            "ref": ref, "down": down, "start": start, "end": end, "tree": tree
-        }),
+        "@id": templates["navigation"].expand(query),
         "resource": collection.json(inject={k:v.uri for k,v in templates.items()}),
     }
 
-    refs = nav.references[tree]
-    paths = nav.paths[tree]
-
     # Three first rows of the specs folr combination of down/ref/start/end
     if down is None:
+        if not ref and not (start and end):
+            return msg_4xx(f"The down query parameter is required when requesting without ref or start/end", code=400)
+        if index is not None:
+            def member(value: str) -> Any:
+                return index.subtree(index.index(value))
+        else:
+            nav = nav or Navigation.query.where(Navigation.collection_id == collection.id).first()
+            paths = nav.paths[tree]
+            refs = nav.references[tree]
+
+            def member(value: str) -> Any:
+                return get_member_by_path(refs, paths[value])
         if ref:
-            out["ref"] = get_member_by_path(refs, paths[ref])
-        elif start and end:
-            out["start"] = get_member_by_path(refs, paths[start])
-            out["end"] = get_member_by_path(refs, paths[end])
+            out["ref"] = member(ref)
         else:
-            return msg_4xx(f"The down query parameter is required when requesting without ref or start/end", code=400)
+            out["start"] = member(start)
+            out["end"] = member(end)
         return Response(json.dumps(out), mimetype="application/json", status=200)
     elif down == 0 and start and end:
         return msg_4xx(f"The down query parameter cannot be `0` while using start/end", code=400)
@@ -183,34 +419,125 @@ def navigation_view(resource, ref, start, end, tree, down, templates: Dict[str,
         return msg_4xx(f"The down query parameter cannot be `0` without using the `ref` parameter", code=400)
 
     try:
-        members, start, end = get_nav(refs=refs, paths=paths, start_or_ref=start or ref, end=end, down=down)
+        if index is not None:
+            members, start, end = index.select(start_or_ref=start or ref, end=end, down=down)
+        else:
+            members, start, end = select_nav(paths=nav.paths[tree], start_or_ref=start or ref, end=end, down=down)
     except InvalidRangeOrder:
         return msg_4xx("End reference comes before start in the document order. Interchange start and end.", code=400)
     except Exception:
         raise
 
-    out["member"] = members
+    if page is not None or page_size:
+        bounds = page_bounds(len(members), page, page_size, "navigation")
+        if isinstance(bounds, Response):
+            return bounds
+        page, last_page = bounds
+        members = members[(page - 1) * page_size:page * page_size]
+
+    bound_refs = [value for value in (start, end) if value]
+    # Members are streamed from the database, or the index, while the response is written
+    if index is not None:
+        bounds = {value: index.member(index.index(value)) for value in bound_refs}
+        out["member"] = index.members(members)
+    else:
+        bounds = dict(zip(bound_refs, iter_member_fragments(collection.id, tree, bound_refs)))
+        out["member"] = iter_member_fragments(collection.id, tree, members)
     if end:
-        out["start"] = start
-        out["end"] = end
+        out["start"] = bounds[start]
+        out["end"] = bounds[end]
     else:
-        out["ref"] = start
+        out["ref"] = bounds[start] if start else None
+
+    if page_size:
+        def page_uri(number: int) -> str:
+            return templates["navigation"].expand({**query, "page": number})
+
+        out["view"] = pagination_view(page_uri, page, last_page)
 
-    return Response(json.dumps(out), mimetype="application/ld+json", status=200)
+    return Response(
+        stream_with_context(iter_dumps_with_fragments(out)),
+        mimetype="application/ld+json",
+        status=200
+    )
 
 
 def create_app(
         app: Flask,
         base_uri: str,
-        use_query: bool = False
+        use_query: bool = False,
+        passage_pool: Optional[PassagePool] = None,
+        navigation_page_size: Optional[int] = None,
+        collection_page_size: Optional[int] = None,
+        catalog_snapshot: bool = False,
+        navigation_index: Optional[str] = None,
+        read_only_database: Optional[str] = None,
+        compression: Optional[Compression] = None,
+        passage_cache: Optional[PassageCache] = None,
+        prefetcher: Optional[Prefetcher] = None,
+        warmup: Optional[Warmup] = None
 ) -> (Flask, SQLAlchemy):
     """
 
     Initialisation of the DB is up to you
+
+    :param passage_pool: Worker processes rendering passages, passages are rendered in the request thread without it
+    :param navigation_page_size: Number of members by page of navigation responses, members are not paginated
+        without it
+    :param collection_page_size: Number of members by page of collection responses, members are not paginated
+        without it
+    :param catalog_snapshot: Serve collections from an in-memory snapshot of the catalog, see
+        :class:`dapitains.app.snapshot.CatalogCache`. The snapshot is available as `app.extensions["dapitains_catalog"]`
+        and is replaced by :func:`dapitains.app.ingest.store_catalog`.
+    :param navigation_index: Directory of the navigation indexes, written by :func:`dapitains.app.ingest.store_catalog`
+        and mapped in memory to answer navigation requests, see :mod:`dapitains.app.navigation_index`
+    :param read_only_database: Path of a database written by :func:`dapitains.app.ingest.publish_catalog`, served
+        read-only (see :func:`dapitains.app.database.read_only_config`). The database configuration is set
+        accordingly, the DB still has to be initialised with `db.init_app(app)`.
+    :param compression: Compression of the responses, see :class:`dapitains.app.compression.Compression`. Compressed
+        variants of full documents are then written by :func:`dapitains.app.ingest.store_catalog`.
+    :param passage_cache: Cache of rendered passages, see :class:`dapitains.app.caching.PassageCache`. It is available
+        as `app.extensions["dapitains_passages"]`.
+    :param prefetcher: Prefetcher rendering the passage following each requested reference into `passage_cache`,
+        see :class:`dapitains.app.prefetch.Prefetcher`. It is available as `app.extensions["dapitains_prefetch"]`.
+    :param warmup: Requests replayed to fill the caches of the application before (or while) it serves its first
+        requests, see :class:`dapitains.app.warmup.Warmup`. It is available as `app.extensions["dapitains_warmup"]`.
     """
-    navigation_template = uritemplate.URITemplate(base_uri+"/navigation/{?resource}{&ref,start,end,tree,down}")
-    collection_template = uritemplate.URITemplate(base_uri+"/collection/{?id,nav}")
+    if read_only_database:
+        app.config["SQLALCHEMY_DATABASE_URI"], app.config["SQLALCHEMY_ENGINE_OPTIONS"] = read_only_config(
+            read_only_database
+        )
+
+    # Pages are only advertised by the endpoints that paginate their members
+    navigation_page = ",page" if navigation_page_size else ""
+    collection_page = ",page" if collection_page_size else ""
+    navigation_template = uritemplate.URITemplate(
+        base_uri+"/navigation/{?resource}{&ref,start,end,tree,down"+navigation_page+"}"
+    )
+    collection_template = uritemplate.URITemplate(base_uri+"/collection/{?id"+collection_page+",nav}")
     document_template = uritemplate.URITemplate(base_uri+"/document/{?resource}{&ref,start,end,tree}")
+    collection_templates = {
+        "navigation": navigation_template,
+        "collection": collection_template,
+        "document": document_template,
+    }
+    catalog = None
+    if catalog_snapshot:
+        catalog = app.extensions["dapitains_catalog"] = CatalogCache(collection_templates)
+    if warmup is not None:
+        # Registered first, so that the first requests wait for the warm-up before any cache is looked up
+        warmup.init_app(app)
+    if compression is not None:
+        compression.init_app(app)
+    if passage_cache is not None:
+        app.extensions["dapitains_passages"] = passage_cache
+    if prefetcher is not None:
+        if passage_cache is None:
+            raise ValueError("Prefetching passages requires a passage cache")
+        prefetcher.init_app(app, passage_cache, passage_pool)
+    indexes = None
+    if navigation_index:
+        indexes = app.extensions["dapitains_navigation_index"] = NavigationIndexes(navigation_index)
 
     @app.route("/")
     def index_route():
@@ -231,12 +558,14 @@ def create_app(
     def collection_route():
         resource = request.args.get("id")
         nav = request.args.get("nav", "children")
+        page = request.args.get("page", type=int, default=None)
 
-        return collection_view(resource, nav, templates={
-            "navigation": navigation_template,
-            "collection": collection_template,
-            "document": document_template,
-        })
+        if catalog is not None:
+            return snapshot_collection_view(
+                catalog.snapshot, resource, nav, templates=collection_templates, page=page,
+                page_size=collection_page_size
+            )
+        return collection_view(resource, nav, templates=collection_templates, page=page, page_size=collection_page_size)
 
     @app.route("/navigation/")
     def navigation_route():
@@ -246,12 +575,13 @@ def create_app(
         end = request.args.get("end")
         tree = request.args.get("tree")
         down = request.args.get("down", type=int, default=None)
+        page = request.args.get("page", type=int, default=None)
 
         return navigation_view(resource, ref, start, end, tree, down, templates={
             "navigation": navigation_template.partial({"resource": resource}),
             "collection": collection_template.partial({"id": resource}),
             "document": document_template.partial({"resource": resource}),
-        })
+        }, page=page, page_size=navigation_page_size, indexes=indexes)
 
     @app.route("/document/")
     def document_route():
@@ -260,7 +590,62 @@ def create_app(
         start = request.args.get("start")
         end = request.args.get("end")
         tree = request.args.get("tree")
-        return document_view(resource, ref, start, end, tree)
+        return document_view(
+            resource, ref, start, end, tree, pool=passage_pool, compression=compression,
+            encoding=compression.negotiate(request.headers.get("Accept-Encoding")) if compression else None,
+            passages=passage_cache, prefetcher=prefetcher
+        )
+
+    @app.cli.command("export")
+    @click.argument("directory")
+    @click.option("--level", default=1, show_default=True, help="Deepest level of the exported references")
+    @click.option(
+        "--down", "downs", type=int, multiple=True, default=(1, -1), show_default=True,
+        help="Values of down of the exported navigation responses"
+    )
+    @click.option("--workers", default=4, show_default=True, help="Number of responses rendered at once")
+    def export_command(directory: str, level: int, downs: Tuple[int, ...], workers: int):
+        """ Render collection, navigation and passage responses into DIRECTORY for static serving """
+        report = export_site(app, directory, level=level, downs=downs, workers=workers)
+        click.echo(f"{report.written} written, {report.skipped} unchanged, {report.removed} removed")
+        for uri in report.failed:
+            click.echo(f"Failed: {uri}", err=True)
+
+    @app.cli.command("build-trees")
+    @click.option("--limit", type=int, default=None, help="Number of citation trees built")
+    def build_trees_command(limit: Optional[int]):
+        """ Build the citation trees left out at ingest with `store_catalog(..., lazy_trees=True)` """
+        click.echo(f"{build_pending_trees(limit=limit)} citation trees built")
+
+    @app.cli.command("warmup")
+    @click.argument("source", type=click.File(encoding="utf-8"))
+    @click.option("--server", default=None, help="Base URL of a running server to warm, instead of this process")
+    @click.option("--limit", type=int, default=None, help="Number of distinct requests replayed, the most frequent first")
+    @click.option("--budget", type=int, default=None, help="Bytes of responses after which the warm-up stops")
+    @click.option("--pause", type=float, default=0.0, show_default=True, help="Seconds between two requests")
+    @click.option(
+        "--encoding", "encodings", multiple=True,
+        help="Encoding to request each URI in, besides uncompressed. Defaults to the ones of the application"
+    )
+    def warmup_command(
+            source,
+            server: Optional[str],
+            limit: Optional[int],
+            budget: Optional[int],
+            pause: float,
+            encodings: Tuple[str, ...]
+    ):
+        """ Replay the hot requests of SOURCE, an access log or a hot list (`-` for the standard input) """
+        report = replay(
+            server or app, hot_uris(source, limit=limit), budget=budget, pause=pause,
+            encodings=[None, *encodings] if encodings else None
+        )
+        click.echo(
+            f"{report.warmed} requests warmed ({report.size} bytes) in {report.seconds:.1f}s, "
+            f"{report.skipped} over budget"
+        )
+        for uri in report.failed:
+            click.echo(f"Failed: {uri}", err=True)
 
     return app, db
 
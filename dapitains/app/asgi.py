@@ -0,0 +1,237 @@
+""" ASGI variant of the DTS application.
+
+:func:`create_asgi_app` serves the routes registered by :func:`dapitains.app.app.create_app` from an event loop: the
+loop only parses requests and writes responses, while the views run in executors. Many concurrent clients can then be
+served by a single process, eg. with `uvicorn`:
+
+    uvicorn --factory my_module:build_app
+
+Payloads are the ones of the Flask application, as requests are dispatched to the same views, and streamed responses
+are sent chunk by chunk. Database access is not asynchronous: the views query the database synchronously with
+SQLAlchemy, from the threads of the executor.
+"""
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+try:
+    from flask import Flask
+    from flask_sqlalchemy import SQLAlchemy
+except ImportError:
+    print("This part of the package can only be imported with the web requirements.")
+    raise
+
+from dapitains.app.app import create_app
+from dapitains.app.workers import PassagePool, render_file_passage
+
+
+__all__ = ["DTSApplication", "SaxonThread", "create_asgi_app"]
+
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+# Number of chunks of a response rendered ahead of the ones sent
+STREAM_BUFFER = 8
+
+
+class SaxonThread:
+    """ Renders passages in a dedicated thread, with the interface of :class:`dapitains.app.workers.PassagePool`
+
+    Saxon work is serialized across the process (see :data:`dapitains.constants.SAXON_LOCK`): rendering passages in a
+    single thread keeps the other threads from queuing on the lock. Only the rendering itself runs there, the rest of
+    the requests (reference lookups, cached passages, full documents) is handled by the thread of the request.
+    """
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dts-saxon")
+
+    def render(
+            self,
+            file_path: str,
+            ref_or_start: str,
+            end: Optional[str] = None,
+            tree: Optional[str] = None,
+            plans: Optional[Dict[str, List[str]]] = None,
+            content_hash: Optional[str] = None
+    ) -> str:
+        # Documents are parsed for each passage in this thread, their version does not matter
+        return self._executor.submit(render_file_passage, file_path, ref_or_start, end, tree, plans).result()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+class DTSApplication:
+    """ ASGI application dispatching requests to a Flask application in executors
+
+    :param app: Flask application with the DTS routes
+    :param passage_pool: Renderer of the passages of the application (worker processes or :class:`SaxonThread`),
+        stopped with the application
+    :param max_threads: Number of threads running the views
+    """
+    def __init__(
+            self,
+            app: Flask,
+            passage_pool: Optional[Union[PassagePool, SaxonThread]] = None,
+            max_threads: Optional[int] = None
+    ):
+        self.app = app
+        self.passage_pool = passage_pool
+        self._io = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="dts-io")
+
+    @staticmethod
+    def _environ(scope: Scope) -> Dict[str, Any]:
+        """ Build the WSGI environment of a bodiless ASGI HTTP request """
+        server_name, server_port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("latin1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "CONTENT_LENGTH": "0",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": _EmptyInput(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin1").upper().replace("-", "_")
+            value = value.decode("latin1")
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+            elif name != "CONTENT_LENGTH":
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _handle(
+            self,
+            environ: Dict[str, Any],
+            emit: Callable[[Optional[Dict[str, Any]]], None],
+            stopped: threading.Event
+    ):
+        """ Run a request through the Flask application, in an executor thread, emitting its ASGI messages
+
+        The body is iterated in this thread, as streamed responses are bound to the context of their request. None is
+        emitted once the response is complete.
+        """
+        status_headers = []
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            status_headers[:] = [int(status.split(" ", 1)[0]), headers]
+
+        try:
+            chunks = self.app.wsgi_app(environ, start_response)
+            try:
+                status, headers = status_headers
+                emit({
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [(key.lower().encode("latin1"), value.encode("latin1")) for key, value in headers]
+                })
+                for chunk in chunks:
+                    if stopped.is_set():
+                        break
+                    if chunk:
+                        emit({"type": "http.response.body", "body": chunk, "more_body": True})
+            finally:
+                if hasattr(chunks, "close"):
+                    chunks.close()
+        finally:
+            emit(None)
+
+    async def _respond(self, environ: Dict[str, Any], send: Send):
+        loop = asyncio.get_running_loop()
+        messages: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(maxsize=STREAM_BUFFER)
+        stopped = threading.Event()
+
+        def emit(message: Optional[Dict[str, Any]]):
+            # Blocks the thread while the chunks ahead are not sent
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        handled = loop.run_in_executor(self._io, self._handle, environ, emit, stopped)
+        complete = False
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    complete = True
+                    break
+                await send(message)
+        finally:
+            if not complete:
+                # The client is gone: the thread stops at its next chunk
+                stopped.set()
+                while await messages.get() is not None:
+                    pass
+        await handled
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope `{scope['type']}`")
+        await self._respond(self._environ(scope), send)
+
+    def shutdown(self):
+        """ Stop the executor, and the passage renderer if any """
+        self._io.shutdown(wait=True)
+        if self.passage_pool is not None:
+            self.passage_pool.shutdown()
+
+
+class _EmptyInput:
+    """ Request body of bodiless requests """
+    def read(self, *args) -> bytes:
+        return b""
+
+    def readline(self, *args) -> bytes:
+        return b""
+
+    def __iter__(self):
+        return iter(())
+
+
+def create_asgi_app(
+        app: Flask,
+        base_uri: str,
+        use_query: bool = False,
+        passage_pool: Optional[PassagePool] = None,
+        max_threads: Optional[int] = None,
+        **create_app_kwargs
+) -> (DTSApplication, SQLAlchemy):
+    """ Build the ASGI DTS application
+
+    Initialisation of the DB is up to you, as with :func:`dapitains.app.app.create_app`.
+
+    :param app: Flask application the routes are registered on
+    :param base_uri: Base URI of the DTS endpoints
+    :param use_query: See :func:`dapitains.app.app.create_app`
+    :param passage_pool: Worker processes rendering passages, passages are rendered by a :class:`SaxonThread`
+        without it
+    :param max_threads: Number of threads running the views
+    :param create_app_kwargs: Other options of :func:`dapitains.app.app.create_app`, eg. `passage_cache`
+    :return: ASGI application and database
+    """
+    renderer = passage_pool if passage_pool is not None else SaxonThread()
+    app, db = create_app(app, base_uri=base_uri, use_query=use_query, passage_pool=renderer, **create_app_kwargs)
+    return DTSApplication(app, passage_pool=renderer, max_threads=max_threads), db
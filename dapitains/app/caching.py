@@ -0,0 +1,166 @@
+""" In-process caches of rendered responses
+
+:class:`BoundedCache` keeps the most recently used values within a budget of bytes. :class:`SingleFlight` runs a
+computation once for all the threads asking for it at the same time. :class:`PassageCache` combines them for
+passages: concurrent identical requests share a single rendering, and later ones are served from memory.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+
+__all__ = ["BoundedCache", "SingleFlight", "PassageCache"]
+
+
+V = TypeVar("V")
+
+
+class BoundedCache(Generic[V]):
+    """ Thread-safe LRU cache bounded by the size of its values
+
+    :param max_size: Total size of the values kept
+    :param size: Size of a value, its length by default
+    """
+    def __init__(self, max_size: int, size: Callable[[V], int] = len):
+        self.max_size = max_size
+        self._size = size
+        self._values: "OrderedDict[Hashable, Tuple[V, int]]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._values
+
+    @property
+    def total_size(self) -> int:
+        """ Size of the values currently kept """
+        return self._total
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            self._values.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, value: V):
+        """ Keep a value, evicting the least recently used ones if needed. Values larger than the cache are ignored """
+        size = self._size(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._values.pop(key, None)
+            if previous is not None:
+                self._total -= previous[1]
+            self._values[key] = (value, size)
+            self._total += size
+            while self._total > self.max_size:
+                _, (_, evicted) = self._values.popitem(last=False)
+                self._total -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._total = 0
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls with the same key
+
+    The first caller of a key runs the function, the callers arriving before it is done wait for its result (or its
+    exception) instead of running the function again.
+    """
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], V]) -> Tuple[V, bool]:
+        """ Run a function, or wait for the call of the same key that is already running
+
+        :return: Result of the function, and whether it was shared with another caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function()
+            return call.result, False
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class PassageCache:
+    """ Rendered passages, shared between concurrent identical requests
+
+    Keys identify a passage and the content of its source (see :meth:`key`), so that passages of a modified file
+    are not served.
+
+    :param max_size: Number of characters of passages kept in memory
+    """
+    def __init__(self, max_size: int = 64 * 1024 * 1024):
+        self.cache: BoundedCache[str] = BoundedCache(max_size)
+        self.flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(
+            resource: str,
+            tree: Optional[str],
+            ref_or_start: str,
+            end: Optional[str],
+            content_hash: Optional[str]
+    ) -> Tuple[str, Optional[str], str, Optional[str], Optional[str]]:
+        return resource, tree, ref_or_start, end, content_hash
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_or_render(self, key: Hashable, render: Callable[[], str]) -> str:
+        """ Retrieve a passage, rendering it if no other request is already doing so """
+        passage = self.cache.get(key)
+        if passage is not None:
+            self._count("hits")
+            return passage
+
+        def render_and_keep() -> str:
+            value = render()
+            self.cache.put(key, value)
+            return value
+
+        passage, shared = self.flight.do(key, render_and_keep)
+        self._count("coalesced" if shared else "misses")
+        return passage
+
+    def stats(self) -> Dict[str, int]:
+        """ Counters of the cache """
+        return {
+            "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+            "passages": len(self.cache), "size": self.cache.total_size
+        }
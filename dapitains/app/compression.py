@@ -0,0 +1,235 @@
+""" Compression of DTS responses
+
+Navigation JSON and TEI passages compress well, but compressing them on every request costs more CPU than building
+them. :class:`Compression` negotiates the encoding of responses with clients and keeps the compressed responses it
+produced, so that each unique response is only compressed once. Full documents are compressed at ingest, next to
+their source file, and sent as they are. Streamed responses are compressed while they are sent, and are not kept.
+
+gzip is always available, zstd and brotli when the `zstandard` and `brotli` packages are installed.
+"""
+import gzip
+import os
+import zlib
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+try:
+    from flask import Flask, Response, request
+except ImportError:
+    print("This part of the package can only be imported with the web requirements.")
+    raise
+
+from dapitains.app.caching import BoundedCache
+from dapitains.tei.sources import read_source, uncompressed_name
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+__all__ = ["Compression", "available_encodings", "compress_stream", "negotiate"]
+
+
+# Encodings by order of preference, with the compressors of responses (fast) and of stored variants (small)
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {}
+if brotli is not None:
+    CODECS["br"] = (lambda data: brotli.compress(data, quality=5), lambda data: brotli.compress(data, quality=11))
+if zstandard is not None:
+    CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor(level=6).compress(data),
+        lambda data: zstandard.ZstdCompressor(level=19).compress(data)
+    )
+CODECS["gzip"] = (
+    lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+    lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+)
+
+
+
+class _BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+# Incremental compressors of streamed responses, with the `compress` and `flush` methods of zlib objects
+STREAM_CODECS: Dict[str, Callable[[], Any]] = {"gzip": lambda: zlib.compressobj(6, zlib.DEFLATED, 31)}
+if brotli is not None:
+    STREAM_CODECS["br"] = _BrotliStream
+if zstandard is not None:
+    STREAM_CODECS["zstd"] = lambda: zstandard.ZstdCompressor(level=6).compressobj()
+
+EXTENSIONS = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+COMPRESSIBLE = ("application/json", "application/ld+json", "application/xml")
+
+
+def available_encodings() -> Tuple[str, ...]:
+    """ Encodings supported by the installed packages, by order of preference """
+    return tuple(CODECS)
+
+
+def negotiate(accept_encoding: Optional[str], encodings: Sequence[str]) -> Optional[str]:
+    """ Pick the encoding of a response from the Accept-Encoding header of a request
+
+    >>> negotiate("gzip, deflate, br;q=0.5", ["br", "gzip"])
+    'gzip'
+    >>> negotiate("*", ["zstd", "gzip"])
+    'zstd'
+    >>> negotiate("gzip;q=0, identity", ["gzip"]) is None
+    True
+
+    :param accept_encoding: Value of the header
+    :param encodings: Supported encodings, by order of preference
+    :return: Encoding, None to send the response as it is
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, *parameters = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class Compression:
+    """ Compression of the responses of an application
+
+    :param encodings: Encodings to offer, by order of preference, all the available ones by default
+    :param cache_size: Number of bytes of compressed responses kept in memory
+    :param minimum_size: Responses smaller than this number of bytes are sent as they are
+    """
+    def __init__(
+            self,
+            encodings: Optional[Sequence[str]] = None,
+            cache_size: int = 64 * 1024 * 1024,
+            minimum_size: int = 512
+    ):
+        self.encodings = tuple(encodings or available_encodings())
+        for encoding in self.encodings:
+            if encoding not in CODECS:
+                raise ValueError(f"Encoding {encoding} is not available")
+        self.minimum_size = minimum_size
+        # Compressed bodies and their mimetype, by request path and encoding
+        self.cache: BoundedCache[Tuple[bytes, str]] = BoundedCache(cache_size, size=lambda item: len(item[0]))
+
+    def init_app(self, app: Flask):
+        """ Compress the responses of an application, and serve compressed variants of full documents """
+        app.extensions["dapitains_compression"] = self
+        app.before_request(self._cached_response)
+        app.after_request(self._compress_response)
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        """ Pick the encoding of a response, see :func:`negotiate` """
+        return negotiate(accept_encoding, self.encodings)
+
+    # Variants of the source files
+    @staticmethod
+    def variant_path(path: str, encoding: str) -> str:
+        """ Path of the compressed variant of a file, the file itself when it is compressed with this encoding """
+        return uncompressed_name(path) + EXTENSIONS[encoding]
+
+    def precompress(self, path: str):
+        """ Write the compressed variants of a file next to it, unless they are up to date """
+        data = None
+        for encoding in self.encodings:
+            if self.variant(path, encoding):
+                continue
+            if data is None:
+                data = read_source(path)
+            variant = self.variant_path(path, encoding)
+            with open(f"{variant}.tmp", "wb") as f:
+                f.write(CODECS[encoding][1](data))
+            os.replace(f"{variant}.tmp", variant)
+
+    def variant(self, path: str, encoding: str) -> Optional[str]:
+        """ Path of the compressed variant of a file, None if it is missing or older than the file """
+        variant = self.variant_path(path, encoding)
+        try:
+            if os.stat(variant).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                return variant
+        except FileNotFoundError:
+            pass
+        return None
+
+    # Compressed responses
+    def clear(self):
+        """ Forget compressed responses, eg. when the catalog changed """
+        self.cache.clear()
+
+    def _cached_response(self) -> Optional[Response]:
+        encoding = self.negotiate(request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return None
+        cached = self.cache.get((request.full_path, encoding))
+        if cached is None:
+            return None
+        body, mimetype = cached
+        response = Response(body, mimetype=mimetype)
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def _compress_response(self, response: Response) -> Response:
+        if response.status_code != 200 or response.mimetype not in COMPRESSIBLE:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self.negotiate(request.headers.get("Accept-Encoding"))
+        if encoding is None or "Content-Encoding" in response.headers:
+            return response
+        if response.direct_passthrough:
+            # Files sent as they are, eg. full documents without a compressed variant
+            return response
+        if response.is_streamed:
+            # Compressed chunk by chunk, the body is never held in memory
+            body = response.response
+            response.response = compress_stream(response.iter_encoded(), encoding)
+            if hasattr(body, "close"):
+                response.call_on_close(body.close)
+            response.headers.pop("Content-Length", None)
+            response.headers["Content-Encoding"] = encoding
+            return response
+        data = response.get_data()
+        if len(data) < self.minimum_size:
+            return response
+        body = CODECS[encoding][0](data)
+        self.cache.put((request.full_path, encoding), (body, response.mimetype))
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+def compress_stream(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """ Compress a body chunk by chunk
+
+    >>> gzip.decompress(b"".join(compress_stream([b"<TEI>", b"</TEI>"], "gzip")))
+    b'<TEI></TEI>'
+    """
+    compressor = STREAM_CODECS[encoding]()
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -3,16 +3,20 @@ from collections import defaultdict
 try:
     from flask_sqlalchemy import SQLAlchemy
     from sqlalchemy.ext.mutable import MutableDict, Mutable
+    from sqlalchemy.pool import SingletonThreadPool
     from sqlalchemy.types import TypeDecorator, TEXT
-    from sqlalchemy import func
     import click
 except ImportError:
     print("This part of the package can only be imported with the web requirements.")
     raise
 
-from typing import Optional, Dict, Any
+from functools import partial
+from typing import Optional, Dict, Any, List, Tuple
+from urllib.request import pathname2url
 import dapitains.metadata.classes as abstracts
 import json
+import os
+import sqlite3
 
 
 class CustomKeyJSONDecoder(json.JSONDecoder):
@@ -25,15 +29,60 @@ class CustomKeyJSONDecoder(json.JSONDecoder):
 
 db = SQLAlchemy()
 
+
+def connect_read_only(path: str, mmap_size: int) -> sqlite3.Connection:
+    """ Open an immutable SQLite database: SQLite neither locks it nor checks whether it changed """
+    connection = sqlite3.connect(
+        f"file:{pathname2url(path)}?mode=ro&immutable=1", uri=True, check_same_thread=False
+    )
+    connection.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    return connection
+
+
+def read_only_config(path: str, mmap_size: int = 2 ** 30, threads: int = 64) -> Tuple[str, Dict[str, Any]]:
+    """ Database URI and engine options to serve a published database (see dapitains.app.ingest.publish_catalog)
+
+    The file is mapped in memory, and each thread keeps its own connection.
+
+    :param path: Path of the published database
+    :param mmap_size: Number of bytes of the database mapped in memory
+    :param threads: Number of threads keeping a connection at once
+    :return: Value of SQLALCHEMY_DATABASE_URI and SQLALCHEMY_ENGINE_OPTIONS
+    """
+    path = os.path.abspath(path)
+    return f"sqlite:///{path}", {
+        "creator": partial(connect_read_only, path, mmap_size),
+        "poolclass": SingletonThreadPool,
+        "pool_size": threads
+    }
+
+
 parent_child_association = db.Table('parent_child_association',
     db.Column('parent_id', db.Integer, db.ForeignKey('collections.id'), primary_key=True),
-    db.Column('child_id', db.Integer, db.ForeignKey('collections.id'), primary_key=True)
+    db.Column('child_id', db.Integer, db.ForeignKey('collections.id'), primary_key=True),
+    # Rank of the child among the children of the parent, and of the parent among the parents of the child,
+    #   used to seek pages of members (see dapitains.app.ingest.index_relationships)
+    db.Column('position', db.Integer, nullable=True),
+    db.Column('parent_position', db.Integer, nullable=True),
+    db.Index('ix_children_pages', 'parent_id', 'position'),
+    db.Index('ix_parents_pages', 'child_id', 'parent_position')
+)
+
+# Transitive closure of the collection hierarchy: one row per collection and each of its ancestors, at the depth of
+#   the shortest path between them, and one row per collection for itself at depth 0
+#   (see dapitains.app.ingest.build_closure)
+collection_closure = db.Table('collection_closure',
+    db.Column('ancestor_id', db.Integer, db.ForeignKey('collections.id'), primary_key=True),
+    db.Column('descendant_id', db.Integer, db.ForeignKey('collections.id'), primary_key=True),
+    db.Column('depth', db.Integer, nullable=False),
+    db.Index('ix_closure_ancestors', 'descendant_id', 'depth')
 )
 
 
 class JSONEncoded(TypeDecorator):
     """Enables JSON storage by encoding and decoding on the fly."""
     impl = TEXT
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
         if value is None:
@@ -56,10 +105,14 @@ class Collection(db.Model):
     description = db.Column(db.String, nullable=True)
     resource = db.Column(db.Boolean, default=False)
     filepath = db.Column(db.String, nullable=True)
+    # SHA-256 of the file of a resource at ingest, see dapitains.tei.sources.source_hash
+    content_hash = db.Column(db.String, nullable=True)
     dublin_core = db.Column(JSONEncoded, nullable=True)
     extensions = db.Column(JSONEncoded, nullable=True)
     citeStructure = db.Column(JSONEncoded, nullable=True)
     default_tree = db.Column(db.String, nullable=True)
+    # Citation trees left out at ingest, built on their first request, see dapitains.app.ingest.ensure_tree
+    pending_trees = db.Column(JSONEncoded, nullable=True)
 
     # One-to-one relationship with Navigation
     navigation = db.relationship('Navigation', uselist=False, backref='collection', lazy=True)
@@ -72,17 +125,37 @@ class Collection(db.Model):
         backref='children'
     )
 
-    @property
-    def total_children(self):
-        return db.session.query(func.count(parent_child_association.c.child_id)).filter(
-            parent_child_association.c.parent_id == self.id
-        ).scalar()
+    # Number of direct children and parents, computed at ingest
+    total_children = db.Column(db.Integer, nullable=False, default=0)
+    total_parents = db.Column(db.Integer, nullable=False, default=0, index=True)
 
-    @property
-    def total_parents(self):
-        return db.session.query(func.count(parent_child_association.c.parent_id)).filter(
-            parent_child_association.c.child_id == self.id
-        ).scalar()
+    @classmethod
+    def root(cls) -> Optional["Collection"]:
+        """ Retrieve the first collection without parents """
+        return cls.query.filter(cls.total_parents == 0).order_by(cls.id).first()
+
+    def descendants(self, resources_only: bool = False, max_depth: Optional[int] = None) -> List["Collection"]:
+        """ Retrieve the collections under this one, at any depth, by depth then in storage order
+
+        :param resources_only: Only retrieve resources
+        :param max_depth: Maximum depth of the descendants, 1 being the children
+        """
+        query = db.session.query(Collection).join(
+            collection_closure, collection_closure.c.descendant_id == Collection.id
+        ).filter(collection_closure.c.ancestor_id == self.id, collection_closure.c.depth > 0)
+        if resources_only:
+            query = query.filter(Collection.resource.is_(True))
+        if max_depth is not None:
+            query = query.filter(collection_closure.c.depth <= max_depth)
+        return query.order_by(collection_closure.c.depth, Collection.id).all()
+
+    def ancestors(self) -> List["Collection"]:
+        """ Retrieve the collections above this one, from the farthest to the parents (ie. breadcrumbs) """
+        return db.session.query(Collection).join(
+            collection_closure, collection_closure.c.ancestor_id == Collection.id
+        ).filter(
+            collection_closure.c.descendant_id == self.id, collection_closure.c.depth > 0
+        ).order_by(collection_closure.c.depth.desc(), Collection.id).all()
 
     def json(self, inject: Optional[Dict[str, Any]] = None):
         data = {
@@ -96,15 +169,11 @@ class Collection(db.Model):
         if self.resource:
             data["citationTrees"] = []
         if self.citeStructure:
-            data["citationTrees"] = [self.citeStructure[self.default_tree]]
-            if len(self.citeStructure) >= 1:
-                data["citationTrees"][0]["identifier"] = self.default_tree
-                for key in self.citeStructure:
-                    if key != self.default_tree:
-                        data["citationTrees"].append(self.citeStructure[key])
-                        self.citeStructure[key]["identifier"] = key
-            for tree in data["citationTrees"]:
-                tree["@type"] = "CitationTree"
+            # Trees are copied: the stored structures are shared by every representation of the collection
+            data["citationTrees"] = [
+                {**self.citeStructure[key], "identifier": key, "@type": "CitationTree"}
+                for key in [self.default_tree, *[key for key in self.citeStructure if key != self.default_tree]]
+            ]
         if self.dublin_core:  # ToDo: Fix the way it's presented to adapt to dts view
             data["dublinCore"] = self.dublin_core
         if self.extensions:
@@ -149,4 +218,28 @@ class Navigation(db.Model):
 
     # JSON fields stored as TEXT
     paths = db.Column(JSONEncoded, nullable=False, default={})
-    references = db.Column(JSONEncoded, nullable=False, default={})
+    # Only loaded when accessed: navigation members are read from the refs table
+    references = db.deferred(db.Column(JSONEncoded, nullable=False, default={}))
+
+
+class Reference(db.Model):
+    """ Citable unit of a resource, stored at ingest with data precomputed for passage requests """
+    __tablename__ = 'refs'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, nullable=False)
+    collection_id = db.Column(db.Integer, db.ForeignKey('collections.id'), nullable=False)
+    tree = db.Column(db.String, nullable=False)
+    ref = db.Column(db.String, nullable=False)
+    # Position of the reference in the document order of its tree, and depth in the tree
+    ordinal = db.Column(db.Integer, nullable=False)
+    level = db.Column(db.Integer, nullable=False)
+    # Reconstruction plan of the passage, see dapitains.tei.document.passage_plan
+    plan = db.Column(JSONEncoded, nullable=False)
+    # Serialized member of navigation responses, see dapitains.app.navigation.member_fragment
+    member = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_refs_lookup', 'collection_id', 'tree', 'ref', unique=True),
+        # Ranges of the document order, and following references (see dapitains.app.prefetch)
+        db.Index('ix_refs_ordinals', 'collection_id', 'tree', 'ordinal'),
+    )
@@ -0,0 +1,249 @@
+""" Static export of DTS responses
+
+Collections, navigation trees and top-level passages rarely change once ingested: :func:`export_site` renders them
+once into a directory that a web server can serve without calling the application. The directory holds:
+
+- one file by response, under `collection/`, `navigation/` and `document/`;
+- `urls.map`, the entries of an nginx `map` from request URIs to these files;
+- `manifest.json`, which records the source of each file, so that a new export only renders the responses whose
+  source changed.
+
+With nginx, the application being reachable as `@dts`:
+
+    map $request_uri $dts_static { include /path/to/export/urls.map; }
+    server {
+        location ~ ^/(collection|navigation|document)/ {
+            root /path/to/export;
+            types { application/ld+json json; application/xml xml; }
+            try_files $dts_static @dts;
+        }
+    }
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+try:
+    import uritemplate
+    from flask import Flask
+except ImportError:
+    print("This part of the package can only be imported with the web requirements.")
+    raise
+
+from dapitains.app.database import Collection, Reference, db
+from dapitains.app.navigation_index import FILE_MODE
+from dapitains.tei.sources import source_hash
+
+
+__all__ = ["ExportReport", "export_site", "plan_export"]
+
+
+COLLECTION_TEMPLATE = uritemplate.URITemplate("/collection/{?id,page,nav}")
+NAVIGATION_TEMPLATE = uritemplate.URITemplate("/navigation/{?resource}{&ref,start,end,tree,down,page}")
+DOCUMENT_TEMPLATE = uritemplate.URITemplate("/document/{?resource}{&ref,start,end,tree}")
+
+
+@dataclass
+class ExportReport:
+    """ Outcome of an export
+
+    :param written: Number of responses rendered and written
+    :param skipped: Number of responses whose source did not change
+    :param removed: Number of files of a previous export that are not part of the catalog anymore
+    :param failed: URIs that did not return a successful response
+    """
+    written: int = 0
+    skipped: int = 0
+    removed: int = 0
+    failed: Tuple[str, ...] = ()
+
+
+def _sha256(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _collection_source(collection: Collection) -> str:
+    """ Hash of what a collection response is made of: the collection, its totals and its members """
+    return _sha256(json.dumps([
+        collection.json(),
+        collection.total_parents,
+        collection.total_children,
+        [child.json() for child in collection.children],
+        [parent.json() for parent in collection.parents]
+    ], sort_keys=True).encode("utf-8"))
+
+
+def plan_export(level: int = 1, downs: Iterable[int] = (1, -1)) -> List[Tuple[str, str]]:
+    """ List the request URIs to export with the hash of their source, within an application context
+
+    :param level: Deepest level of the references whose navigation and passage are exported
+    :param downs: Values of `down` of the navigation responses, for the whole tree and for each reference
+    :return: Request URIs and hashes of their source
+    """
+    downs = list(downs)
+    planned = []
+    root = Collection.root()
+    for collection in Collection.query.order_by(Collection.id).all():
+        source = _collection_source(collection)
+        planned.append((COLLECTION_TEMPLATE.expand(id=collection.identifier), source))
+        if root is not None and collection.id == root.id:
+            planned.append((COLLECTION_TEMPLATE.expand(), source))
+
+        if not (collection.resource and collection.citeStructure):
+            continue
+        # Passages only depend on the file, navigation responses embed the resource as well: the settings of the
+        # export are part of their URI
+        file_source = collection.content_hash or source_hash(collection.filepath)
+        navigation_source = _sha256(file_source.encode("utf-8"), source.encode("utf-8"))
+        resource = collection.identifier
+        planned.append((DOCUMENT_TEMPLATE.expand(resource=resource), file_source))
+        refs = db.session.query(Reference.tree, Reference.ref).filter(
+            Reference.collection_id == collection.id, Reference.level <= level
+        ).order_by(Reference.tree, Reference.ordinal)
+        for tree in collection.citeStructure:
+            tree_param = {} if tree == collection.default_tree else {"tree": tree}
+            for down in downs:
+                planned.append((
+                    NAVIGATION_TEMPLATE.expand(resource=resource, down=str(down), **tree_param), navigation_source
+                ))
+        for tree, ref in refs:
+            tree_param = {} if tree == collection.default_tree else {"tree": tree}
+            planned.append((DOCUMENT_TEMPLATE.expand(resource=resource, ref=ref, **tree_param), file_source))
+            for down in downs:
+                planned.append((
+                    NAVIGATION_TEMPLATE.expand(resource=resource, ref=ref, down=str(down), **tree_param),
+                    navigation_source
+                ))
+    return planned
+
+
+def _file_name(uri: str) -> str:
+    route = uri.split("/", 2)[1]
+    extension = "xml" if route == "document" else "json"
+    return f"{route}/{hashlib.sha1(uri.encode('utf-8')).hexdigest()}.{extension}"
+
+
+def _write(path: str, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        f.write(content)
+    # Served by a web server that may not run as the user exporting the responses
+    os.chmod(f.name, FILE_MODE)
+    os.replace(f.name, path)
+
+
+def _request_uri(uri: Optional[str]) -> Optional[str]:
+    if not uri:
+        return None
+    parts = urlsplit(uri)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def _pages(content: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """ Request URIs of a paginated JSON response and of its next page """
+    view = json.loads(content).get("view") or {}
+    return _request_uri(view.get("@id")), _request_uri(view.get("next"))
+
+
+def export_site(
+        app: Flask,
+        directory: str,
+        level: int = 1,
+        downs: Iterable[int] = (1, -1),
+        workers: int = 4
+) -> ExportReport:
+    """ Render the stable responses of an application into a directory, see the module documentation
+
+    Responses are requested from `app` by `workers` threads at once. Passages are rendered in parallel when the
+    application has a passage pool, one after the other otherwise (see :data:`dapitains.constants.SAXON_LOCK`).
+    Following pages of paginated responses are exported with their first page.
+
+    :param app: Application serving the catalog
+    :param directory: Directory of the export, a previous export in it is updated
+    :param level: Deepest level of the references whose navigation and passage are exported
+    :param downs: Values of `down` of the navigation responses
+    :param workers: Number of responses rendered at once
+    :return: Summary of the export
+    """
+    manifest_path = os.path.join(directory, "manifest.json")
+    previous: Dict[str, Dict[str, str]] = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+
+    with app.app_context():
+        planned = plan_export(level=level, downs=downs)
+
+    client = app.test_client()
+    manifest: Dict[str, Dict[str, str]] = {}
+    failed: List[str] = []
+    report = ExportReport()
+    lock = threading.Lock()
+
+    def export(uri: str, source: str) -> List[Tuple[str, str]]:
+        """ Export a response, and return the following pages to export """
+        entry = previous.get(uri)
+        file_name = _file_name(uri)
+        if entry and entry["source"] == source and os.path.exists(os.path.join(directory, file_name)):
+            with lock:
+                manifest[uri] = entry
+                report.skipped += 1
+            return [(page, source) for page in entry.get("pages", [])]
+
+        response = client.get(uri)
+        content = response.get_data()
+        if response.status_code != 200:
+            with lock:
+                failed.append(uri)
+            return []
+        _write(os.path.join(directory, file_name), content)
+        page, next_page = (None, None) if uri.startswith("/document/") else _pages(content)
+        entry = {"file": file_name, "source": source, "sha256": _sha256(content)}
+        # First pages are also requested with an explicit page parameter, through the links of the other pages
+        if page and page != uri:
+            entry["aliases"] = [page]
+        if next_page:
+            entry["pages"] = [next_page]
+        with lock:
+            manifest[uri] = entry
+            report.written += 1
+        return [(next_page, source)] if next_page else []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = planned
+        while pending:
+            pending = [
+                following
+                for results in executor.map(lambda item: export(*item), pending)
+                for following in results
+                if following[0] not in manifest
+            ]
+
+    for uri, entry in previous.items():
+        if uri not in manifest:
+            try:
+                os.remove(os.path.join(directory, entry["file"]))
+                report.removed += 1
+            except FileNotFoundError:
+                pass
+
+    files = {}
+    for uri, entry in sorted(manifest.items()):
+        for alias in entry.get("aliases", []):
+            files.setdefault(alias, entry["file"])
+    files.update({uri: entry["file"] for uri, entry in manifest.items()})
+    with open(os.path.join(directory, "urls.map"), "w") as f:
+        for uri, file_name in sorted(files.items()):
+            f.write(f"{json.dumps(uri)} /{file_name};\n")
+    _write(manifest_path, json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+    report.failed = tuple(sorted(failed))
+    return report
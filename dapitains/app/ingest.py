@@ -1,34 +1,131 @@
-from typing import Dict, Optional
-from dapitains.app.database import Collection, Navigation, db, parent_child_association
-from dapitains.app.navigation import generate_paths
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, Optional, List
+from flask import current_app
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from dapitains.app.caching import SingleFlight
+from dapitains.app.database import (
+    Collection, Navigation, Reference, db, parent_child_association, collection_closure
+)
+from dapitains.app.navigation import generate_paths, member_fragment
 from dapitains.metadata.xml_parser import Catalog
-from dapitains.tei.document import Document
+from dapitains.tei.citeStructure import CiteStructureParser, CitableUnit, units_json
+from dapitains.tei.document import Document, passage_plan
+from dapitains.tei.sources import source_hash
+from dapitains.tei.streaming import read_cite_structures, is_streamable, stream_trees
 import tqdm
 
 
-def store_single(catalog: Catalog, keys: Optional[Dict[str, int]]):
+def get_references(
+        file_path: str,
+        cite_structures: Dict[Optional[str], CiteStructureParser]
+) -> Dict[Optional[str], List[CitableUnit]]:
+    """ Retrieve the references of every citation tree of a file.
+
+    Citation trees that can be streamed are resolved together in a single pass without loading the document. The
+    document is only parsed if at least one tree requires it, and such trees share a single walk of the document
+    when their backend allows it.
+
+    :param file_path: Path to the TEI file
+    :param cite_structures: Citation trees of the file
+    :return: References by citation tree
+    """
+    streamable = {
+        tree: parser.structure
+        for tree, parser in cite_structures.items()
+        if is_streamable(parser.structure)
+    }
+    references = stream_trees(file_path, streamable) if streamable else {}
+    others = [tree for tree in cite_structures if tree not in streamable]
+    if others:
+        references.update(Document(file_path).get_all_reffs(others))
+    return {tree: references[tree] for tree in cite_structures}
+
+
+def reference_rows(
+        collection_id: int,
+        cite_structures: Dict[Optional[str], CiteStructureParser],
+        references: Dict[Optional[str], List[Dict[str, Any]]]
+) -> List[Dict[str, Any]]:
+    """ Build the rows of the Reference table for a resource
+
+    :param collection_id: Database identifier of the resource
+    :param cite_structures: Citation trees of the resource
+    :param references: Serialized references by citation tree (see :func:`units_json`)
+    :return: Rows to insert. Duplicated references are only stored once, at their first position, with the member
+        of their last occurrence (as navigation paths do).
+    """
+    rows = {}
+    for tree, members in references.items():
+        ordinal = 0
+        stack = [iter(members)]
+        while stack:
+            member = next(stack[-1], None)
+            if member is None:
+                stack.pop()
+                continue
+            ref = member["identifier"]
+            if (tree, ref) not in rows:
+                rows[(tree, ref)] = {
+                    "collection_id": collection_id,
+                    "tree": tree,
+                    "ref": ref,
+                    "ordinal": ordinal,
+                    "level": member["level"],
+                    "plan": passage_plan(cite_structures[tree], ref)
+                }
+            rows[(tree, ref)]["member"] = member_fragment(member)
+            if member.get("members"):
+                stack.append(iter(member["members"]))
+            ordinal += 1
+    return list(rows.values())
+
+
+def write_indexes(identifier: str, paths: Dict[str, Dict[str, List[int]]], rows: List[Dict[str, Any]]):
+    """ Write the navigation indexes of the citation trees of a resource, if the application maps them """
+    indexes = current_app.extensions.get("dapitains_navigation_index")
+    if indexes is None:
+        return
+    for tree, tree_paths in paths.items():
+        indexes.write(identifier, tree, tree_paths, {row["ref"]: row["member"] for row in rows if row["tree"] == tree})
+
+
+def store_single(catalog: Catalog, keys: Optional[Dict[str, int]], lazy_trees: bool = False):
     keys = keys or {}
+    compression = current_app.extensions.get("dapitains_compression")
     for identifier, collection in tqdm.tqdm(catalog.objects.items(), desc="Parsing all collections"):
         coll_db = Collection.from_class(collection)
         db.session.add(coll_db)
         db.session.flush()
         keys[coll_db.identifier] = coll_db.id
         if collection.resource:
-            doc = Document(collection.filepath)
-            if doc.citeStructure:
+            cite_structures, default_tree = read_cite_structures(collection.filepath)
+            if cite_structures:
+                if compression is not None:
+                    compression.precompress(collection.filepath)
+                coll_db.content_hash = source_hash(collection.filepath)
+                built = cite_structures
+                if lazy_trees:
+                    built = {default_tree: cite_structures[default_tree]}
+                    coll_db.pending_trees = [tree for tree in cite_structures if tree != default_tree] or None
                 references = {
-                    tree: [ref.json() for ref in obj.find_refs(doc.xml, structure=obj.structure)]
-                    for tree, obj in doc.citeStructure.items()
+                    tree: units_json(units)
+                    for tree, units in get_references(collection.filepath, built).items()
                 }
                 paths = {key: generate_paths(tree) for key, tree in references.items()}
                 nav = Navigation(collection_id=coll_db.id, paths=paths, references=references)
                 db.session.add(nav)
                 coll_db.citeStructure = {
                     key: value.structure.json()
-                    for key, value in doc.citeStructure.items()
+                    for key, value in cite_structures.items()
                 }
-                coll_db.default_tree = doc.default_tree
+                coll_db.default_tree = default_tree
                 db.session.add(coll_db)
+                rows = reference_rows(coll_db.id, built, references)
+                db.session.execute(Reference.__table__.insert(), rows)
+                write_indexes(coll_db.identifier, paths, rows)
         db.session.commit()
 
     for parent, child in catalog.relationships:
@@ -37,10 +134,248 @@ def store_single(catalog: Catalog, keys: Optional[Dict[str, int]]):
             child_id=keys[child]
         )
         db.session.execute(insert_statement)
+    index_relationships()
+    build_closure()
     db.session.commit()
 
 
-def store_catalog(*catalogs):
+def index_relationships():
+    """ Rank the members of every collection and count them, so that pages of members can be sought directly
+
+    Children are ranked by their identifier in the database (ie. in the order they were stored), as are parents.
+    """
+    edges = db.session.execute(
+        select(parent_child_association.c.parent_id, parent_child_association.c.child_id)
+    ).all()
+    children, parents = defaultdict(list), defaultdict(list)
+    for parent, child in edges:
+        children[parent].append(child)
+        parents[child].append(parent)
+    positions = {}
+    for parent, members in children.items():
+        for position, child in enumerate(sorted(members)):
+            positions[(parent, child)] = [position, None]
+    for child, members in parents.items():
+        for position, parent in enumerate(sorted(members)):
+            positions[(parent, child)][1] = position
+
+    if positions:
+        db.session.execute(
+            parent_child_association.update().where(
+                parent_child_association.c.parent_id == bindparam("b_parent"),
+                parent_child_association.c.child_id == bindparam("b_child")
+            ).values(position=bindparam("b_position"), parent_position=bindparam("b_parent_position")),
+            [
+                {"b_parent": parent, "b_child": child, "b_position": position, "b_parent_position": parent_position}
+                for (parent, child), (position, parent_position) in positions.items()
+            ]
+        )
+    db.session.execute(update(Collection).values(total_children=0, total_parents=0))
+    counts = defaultdict(lambda: {"total_children": 0, "total_parents": 0})
+    for parent, members in children.items():
+        counts[parent]["total_children"] = len(members)
+    for child, members in parents.items():
+        counts[child]["total_parents"] = len(members)
+    if counts:
+        db.session.execute(update(Collection), [{"id": key, **value} for key, value in counts.items()])
+
+
+def store_catalog(*catalogs, lazy_trees: bool = False):
+    """ Store catalogs and the navigation of their resources
+
+    :param lazy_trees: Only build the default citation tree of resources, other trees are built on their first
+        request (see :func:`ensure_tree`) or by :func:`build_pending_trees`
+    """
     keys = {}
     for catalog in catalogs:
-        store_single(catalog, keys)
+        store_single(catalog, keys, lazy_trees=lazy_trees)
+    # Applications serving a snapshot of the catalog switch to the new one
+    catalog_cache = current_app.extensions.get("dapitains_catalog")
+    if catalog_cache is not None:
+        catalog_cache.refresh()
+    # Compressed responses may be outdated
+    compression = current_app.extensions.get("dapitains_compression")
+    if compression is not None:
+        compression.clear()
+
+
+# Builds of citation trees in progress, shared by the requests asking for the same tree
+_tree_builds = SingleFlight()
+
+
+def _claim_tree(collection_id: int, tree: str, timeout: float) -> bool:
+    """ Remove a tree from the pending trees of a resource, in a transaction left open for its build
+
+    The update only applies if the pending trees did not change since they were read: of the processes building the
+    same tree, one claims it and the others wait for its transaction to end, and find the tree built.
+
+    :return: Whether the tree was claimed, False if it is not pending anymore
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        pending = db.session.execute(
+            select(Collection.pending_trees).where(Collection.id == collection_id)
+        ).scalar()
+        if tree not in (pending or ()):
+            return False
+        try:
+            claimed = db.session.execute(
+                update(Collection).where(
+                    Collection.id == collection_id, Collection.pending_trees == pending
+                ).values(pending_trees=[other for other in pending if other != tree] or None)
+            ).rowcount
+        except OperationalError as error:
+            # SQLite gives up waiting for the lock of a build running in another process
+            db.session.rollback()
+            if "locked" not in str(error) or time.monotonic() > deadline:
+                raise
+            continue
+        if claimed:
+            return True
+        db.session.rollback()
+
+
+def build_tree(collection_id: int, tree: str, timeout: float = 300.0) -> bool:
+    """ Build and store the navigation of a citation tree left out at ingest
+
+    The build is claimed in the database first, so that processes building the same tree do not store it twice.
+
+    :param collection_id: Database identifier of the resource
+    :param tree: Citation tree to build
+    :param timeout: Seconds to wait for the build of the same tree by another process
+    :return: Whether the tree was built, False if it was not pending anymore or its references were already stored
+    """
+    db.session.commit()
+    if not _claim_tree(collection_id, tree, timeout):
+        return False
+    collection: Collection = db.session.get(Collection, collection_id)
+    db.session.refresh(collection)
+    cite_structures, _ = read_cite_structures(collection.filepath)
+    built = {tree: cite_structures[tree]}
+    references = {tree: units_json(get_references(collection.filepath, built)[tree])}
+    paths = {tree: generate_paths(references[tree])}
+    identifier = collection.identifier
+    _store_navigation(collection_id, paths, references)
+    rows = reference_rows(collection_id, built, references)
+    try:
+        db.session.execute(Reference.__table__.insert(), rows)
+        db.session.commit()
+        stored = True
+    except IntegrityError:
+        # References stored meanwhile by a process that did not see the claim: the tree is built, it is only removed
+        #   from the pending trees, otherwise each of its requests would build it again
+        db.session.rollback()
+        if not _claim_tree(collection_id, tree, timeout):
+            return False
+        _store_navigation(collection_id, paths, references)
+        db.session.commit()
+        stored = False
+    write_indexes(identifier, paths, rows)
+    return stored
+
+
+def _store_navigation(collection_id: int, paths: Dict[str, Any], references: Dict[str, Any]):
+    nav: Navigation = Navigation.query.where(Navigation.collection_id == collection_id).first()
+    # Assigned anew, as changes inside JSON values are not tracked
+    nav.paths = {**nav.paths, **paths}
+    nav.references = {**nav.references, **references}
+
+
+def ensure_tree(collection: Collection, tree: str):
+    """ Build a citation tree of a resource if it was left out at ingest
+
+    Concurrent requests for the same tree wait for a single build.
+    """
+    if tree not in (collection.pending_trees or ()):
+        return
+    _tree_builds.do((collection.id, tree), lambda: build_tree(collection.id, tree))
+    db.session.refresh(collection)
+
+
+def build_pending_trees(limit: Optional[int] = None) -> int:
+    """ Build the citation trees left out at ingest, eg. from a background job
+
+    :param limit: Number of trees to build
+    :return: Number of trees built
+    """
+    pending = [
+        (collection_id, tree)
+        for collection_id, trees in db.session.query(Collection.id, Collection.pending_trees).filter(
+            Collection.pending_trees.isnot(None)
+        )
+        for tree in trees
+    ]
+    built = 0
+    for collection_id, tree in pending[:limit]:
+        # Shared with the requests building the same tree
+        done, shared = _tree_builds.do((collection_id, tree), lambda: build_tree(collection_id, tree))
+        built += done and not shared
+    return built
+
+
+def build_closure():
+    """ Rebuild the closure table of the collection hierarchy from the direct relationships
+
+    Depth is the length of the shortest path between an ancestor and its descendant.
+    """
+    parents = defaultdict(list)
+    for parent, child in db.session.execute(
+            select(parent_child_association.c.parent_id, parent_child_association.c.child_id)
+    ):
+        parents[child].append(parent)
+
+    # Ancestors of each collection with their depth, walking up the hierarchy breadth first so that each ancestor is
+    #   reached at the depth of its shortest path, even when collections have several parents or form a cycle
+    ancestors: Dict[int, Dict[int, int]] = {}
+    for (collection_id, ) in db.session.execute(select(Collection.id).order_by(Collection.id)):
+        resolved = {collection_id: 0}
+        level = [collection_id]
+        while level:
+            following = []
+            for current in level:
+                for parent in parents[current]:
+                    if parent not in resolved:
+                        resolved[parent] = resolved[current] + 1
+                        following.append(parent)
+            level = following
+        ancestors[collection_id] = resolved
+
+    db.session.execute(collection_closure.delete())
+    rows = [
+        {"ancestor_id": ancestor, "descendant_id": descendant, "depth": depth}
+        for descendant, resolved in ancestors.items()
+        for ancestor, depth in resolved.items()
+    ]
+    if rows:
+        db.session.execute(collection_closure.insert(), rows)
+
+
+# Lookups of passage and navigation requests, only indexed once the catalog is complete to keep ingest fast.
+# ix_refs_ordinals is part of the model, it is only listed for databases created before it was.
+PUBLISH_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_refs_ordinals ON refs (collection_id, tree, ordinal)",
+    "CREATE INDEX IF NOT EXISTS ix_refs_plans ON refs (collection_id, tree, ref, ordinal, plan)",
+]
+
+
+def publish_catalog(target: str):
+    """ Write an immutable copy of the database, to be served by `create_app(..., read_only_database=target)`
+
+    Lookup indexes are added to the database and the statistics of the query planner gathered before it is copied:
+    the copy is vacuumed, and is not meant to be written to afterwards.
+
+    Citation trees left out at ingest are built first, as the published database cannot be written to.
+
+    :param target: Path of the published database, which must not exist
+    """
+    if db.engine.dialect.name != "sqlite":
+        raise ValueError("Only SQLite databases can be published")
+    if os.path.exists(target):
+        raise FileExistsError(target)
+    build_pending_trees()
+    db.session.commit()
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for statement in PUBLISH_INDEXES:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql("ANALYZE")
+        connection.exec_driver_sql("VACUUM INTO ?", (target, ))
@@ -1,4 +1,5 @@
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+import json
 from dapitains.errors import InvalidRangeOrder
 
 
@@ -65,15 +66,62 @@ def generate_paths(data: List[Dict[str, Any]], path: Optional[List[int]] = None)
     return paths
 
 
-def get_nav(
-        refs: List[Dict[str, Any]],
+class RawJSON(str):
+    """ JSON text serialized beforehand, written as is by :func:`dumps_with_fragments` """
+
+
+def iter_dumps_with_fragments(obj: Dict[str, Any]) -> Iterator[str]:
+    """ Serialize a dictionary as :func:`json.dumps` does, chunk by chunk
+
+    :class:`RawJSON` values, and lists or iterators of them, are written as is. Iterators are only consumed while
+    their own chunks are produced, so that large lists of members can be streamed.
+
+    :param obj: Dictionary to serialize
+    :return: Iterator over chunks of JSON text
+    """
+    yield "{"
+    for index, (key, value) in enumerate(obj.items()):
+        yield f"{', ' if index else ''}{json.dumps(key)}: "
+        if isinstance(value, RawJSON):
+            yield value
+        elif isinstance(value, Iterator) or (
+                isinstance(value, list) and value and all(isinstance(item, RawJSON) for item in value)
+        ):
+            yield "["
+            for position, item in enumerate(value):
+                yield f", {item}" if position else item
+            yield "]"
+        else:
+            yield json.dumps(value)
+    yield "}"
+
+
+def dumps_with_fragments(obj: Dict[str, Any]) -> str:
+    """ Serialize a dictionary as :func:`json.dumps` does, writing :class:`RawJSON` values (or lists of them) as is
+
+    >>> dumps_with_fragments({"a": 1, "member": [RawJSON('{"ref": "1"}')], "ref": RawJSON('{"ref": "1"}')})
+    '{"a": 1, "member": [{"ref": "1"}], "ref": {"ref": "1"}}'
+
+    :param obj: Dictionary to serialize
+    :return: JSON text
+    """
+    return "".join(iter_dumps_with_fragments(obj))
+
+
+def member_fragment(member: Dict[str, Any]) -> RawJSON:
+    """ Serialize a member as it appears in navigation responses, ie. without its own members """
+    return RawJSON(json.dumps(strip_members(member)))
+
+
+def select_nav(
         paths: Dict[str, List[int]],
         start_or_ref: Optional[str] = None,
         end: Optional[str] = None,
         down: Optional[int] = 1
-) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
-    """ Given a references set and a path set, provide the CitableUnit from start to end at down level.
+) -> Tuple[List[str], Optional[str], Optional[str]]:
+    """ Given a path set, select the references from start to end at down level.
 
+    :return: References of the members, reference of the start (or ref) and reference of the end
     """
 
     paths_index = list(paths.keys())
@@ -83,12 +131,11 @@ def get_nav(
         # For end, as end is inclusive, we check for the last partial match
         #   (ie, if Mark is [1], we want everything starting
         #   by [1].)
-        end_index = paths_index.index(end)
+        end_position = end_index = paths_index.index(end)
         len_end = len(paths[end])
-        for idx, reference in enumerate(paths_index[end_index+1:]):
-            # print(paths[:len_end], paths[end])
+        for idx, reference in enumerate(paths_index[end_position+1:]):
             if paths[reference][:len_end] == paths[end]:
-                end_index = end_index+idx
+                end_index = end_position + idx + 1
             else:
                 break
 
@@ -107,13 +154,10 @@ def get_nav(
     paths = dict(list(paths.items())[start_index:end_index+1])
 
     current_level = []
-    start_path, end_path = None, None
     if start_or_ref:
-        start_path = paths[start_or_ref]
-        current_level.append(len(start_path))
+        current_level.append(len(paths[start_or_ref]))
     if end:
-        end_path = paths[end]
-        current_level.append(len(end_path))
+        current_level.append(len(paths[end]))
 
     current_level = max(current_level) if current_level else 0
 
@@ -124,10 +168,24 @@ def get_nav(
     else:
         paths = {key: value for key, value in paths.items() if current_level <= len(value) <= down + current_level}
 
+    return list(paths), start_or_ref or None, end or None
+
+
+def get_nav(
+        refs: List[Dict[str, Any]],
+        paths: Dict[str, List[int]],
+        start_or_ref: Optional[str] = None,
+        end: Optional[str] = None,
+        down: Optional[int] = 1
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """ Given a references set and a path set, provide the CitableUnit from start to end at down level.
+
+    """
+    members, start, end = select_nav(paths, start_or_ref=start_or_ref, end=end, down=down)
     return (
         [
-            strip_members(get_member_by_path(refs, path)) for path in paths.values()
+            strip_members(get_member_by_path(refs, paths[member])) for member in members
         ],
-        strip_members(get_member_by_path(refs, start_path)) if start_path else None,
-        strip_members(get_member_by_path(refs, end_path)) if end_path else None
+        strip_members(get_member_by_path(refs, paths[start])) if start else None,
+        strip_members(get_member_by_path(refs, paths[end])) if end else None
     )
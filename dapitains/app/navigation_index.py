@@ -0,0 +1,270 @@
+""" Memory-mapped navigation indexes
+
+Navigation trees are decoded from the database by every process that serves them. A navigation index holds the
+same information in a read-only binary file written at ingest, that processes map in memory instead: pages of the
+file are shared by all the workers of a server, and nothing is decoded before a request needs it.
+
+An index lists the references of a citation tree in document order. The file is made of:
+
+- a header: magic bytes, number of references `n` and number of levels `m`;
+- `2n + 1` offsets (unsigned 64 bits) in the string table: the reference `i` spans from offset `2i` to `2i + 1`,
+  its member JSON from `2i + 1` to `2i + 2`;
+- the positions of the references sorted by their value (unsigned 32 bits), to find a reference by dichotomy;
+- for each reference, the number of references that directly follow it and descend from it (unsigned 32 bits);
+- for each level, the position of its last reference (unsigned 32 bits);
+- the level of each reference (unsigned 16 bits);
+- the string table, in UTF-8.
+
+Numbers are written in the byte order of the machine: indexes are not meant to be moved across architectures.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dapitains.app.caching import BoundedCache
+from dapitains.app.navigation import RawJSON
+from dapitains.errors import InvalidRangeOrder
+
+
+__all__ = ["NavigationIndex", "NavigationIndexes", "write_index"]
+
+
+MAGIC = b"DTSNAV\x00\x01"
+HEADER = struct.Struct("=8sII")
+# Mode of the files created by open(), read once as the umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+def write_index(path: str, paths: Dict[str, List[int]], members: Dict[str, str]):
+    """ Write the navigation index of a citation tree
+
+    The file is replaced atomically: processes that mapped the previous version keep reading it.
+
+    :param path: Path of the index file
+    :param paths: Paths of the references, in document order (see :func:`dapitains.app.navigation.generate_paths`)
+    :param members: Serialized member of each reference
+    """
+    refs = list(paths)
+    encoded = [ref.encode("utf-8") for ref in refs]
+    depths = array("H", [len(paths[ref]) for ref in refs])
+
+    descendants = array("I", [0] * len(refs))
+    for position, ref in enumerate(refs):
+        size = len(paths[ref])
+        following = position + 1
+        while following < len(refs) and paths[refs[following]][:size] == paths[ref]:
+            following += 1
+        descendants[position] = following - position - 1
+
+    last_of_level = array("I", [0] * (max(depths, default=0) + 1))
+    for position, depth in enumerate(depths):
+        last_of_level[depth] = position
+
+    strings = bytearray()
+    offsets = array("Q", [0])
+    for ref, value in zip(refs, encoded):
+        strings += value
+        offsets.append(len(strings))
+        strings += members[ref].encode("utf-8")
+        offsets.append(len(strings))
+
+    order = array("I", sorted(range(len(refs)), key=encoded.__getitem__))
+
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+        f.write(HEADER.pack(MAGIC, len(refs), len(last_of_level)))
+        for section in (offsets, order, descendants, last_of_level, depths):
+            f.write(section.tobytes())
+        f.write(strings)
+    # Temporary files are only readable by their owner, indexes are read by the processes of the server
+    os.chmod(f.name, FILE_MODE)
+    os.replace(f.name, path)
+
+
+class NavigationIndex:
+    """ Read-only view of a navigation index file
+
+    :param path: Path of the index file
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = self._view = memoryview(self._map)
+        magic, count, levels = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a navigation index")
+        self._count = count
+
+        def section(typecode: str, size: int, itemsize: int):
+            nonlocal cursor
+            data = view[cursor:cursor + size * itemsize].cast(typecode)
+            cursor += size * itemsize
+            return data
+
+        cursor = HEADER.size
+        self._offsets = section("Q", 2 * count + 1, 8)
+        self._order = section("I", count, 4)
+        self._descendants = section("I", count, 4)
+        self._last_of_level = section("I", levels, 4)
+        self._depths = section("H", count, 2)
+        self._strings = view[cursor:]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        """ Unmap the file, the index cannot be read anymore """
+        for view in (self._offsets, self._order, self._descendants, self._last_of_level, self._depths, self._strings):
+            view.release()
+        self._view.release()
+        self._map.close()
+
+    def _bytes(self, slot: int) -> bytes:
+        return bytes(self._strings[self._offsets[slot]:self._offsets[slot + 1]])
+
+    def ref(self, position: int) -> str:
+        """ Reference at a position of the document order """
+        return self._bytes(2 * position).decode("utf-8")
+
+    def member(self, position: int) -> RawJSON:
+        """ Serialized member of the reference at a position of the document order """
+        return RawJSON(self._bytes(2 * position + 1).decode("utf-8"))
+
+    def subtree(self, position: int) -> Dict[str, Any]:
+        """ Member of the reference at a position of the document order, with its descendants nested in `members` """
+        root = json.loads(self.member(position))
+        # Members of the current branch, by level
+        branch = {self._depths[position]: root}
+        for descendant in range(position + 1, position + 1 + self._descendants[position]):
+            member = json.loads(self.member(descendant))
+            depth = self._depths[descendant]
+            branch[depth - 1].setdefault("members", []).append(member)
+            branch[depth] = member
+        return root
+
+    def depth(self, position: int) -> int:
+        """ Level of the reference at a position of the document order """
+        return self._depths[position]
+
+    def index(self, ref: str) -> int:
+        """ Position of a reference in the document order
+
+        :raises ValueError: When the reference is not part of the tree
+        """
+        target = ref.encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(2 * self._order[middle]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._bytes(2 * self._order[low]) == target:
+            return self._order[low]
+        raise ValueError(f"{ref} is not in the navigation index")
+
+    def members(self, positions: List[int]) -> Iterator[RawJSON]:
+        """ Serialized members of references, given their positions """
+        for position in positions:
+            yield self.member(position)
+
+    def select(
+            self,
+            start_or_ref: Optional[str] = None,
+            end: Optional[str] = None,
+            down: Optional[int] = 1
+    ) -> Tuple[List[int], Optional[str], Optional[str]]:
+        """ Select the references from start to end at down level, as :func:`dapitains.app.navigation.select_nav`
+
+        :return: Positions of the members, reference of the start (or ref) and reference of the end
+        """
+        start_index, end_index = None, self._count
+
+        if end:
+            # The end is inclusive of the references it contains
+            end_index = self.index(end)
+            end_index += self._descendants[end_index]
+
+        if start_or_ref:
+            start_index = self.index(start_or_ref)
+            if not end:
+                if down == 0:
+                    end_index = self._count
+                else:
+                    # The range stops before the last reference of the same level, if it comes after the start
+                    last = self._last_of_level[self._depths[start_index]]
+                    if last > start_index:
+                        end_index = last - 1
+            if start_index > end_index:
+                raise InvalidRangeOrder
+
+        current_level = []
+        if start_or_ref:
+            current_level.append(self._depths[start_index])
+        if end:
+            current_level.append(self._depths[self.index(end)])
+        current_level = max(current_level) if current_level else 0
+
+        positions = range(start_index or 0, min(end_index + 1, self._count))
+        depths = self._depths
+        if down == 0:
+            selected = [position for position in positions if depths[position] == current_level]
+        elif down == -1:
+            selected = [position for position in positions if current_level <= depths[position]]
+        else:
+            selected = [position for position in positions if current_level <= depths[position] <= down + current_level]
+        return selected, start_or_ref or None, end or None
+
+
+class NavigationIndexes:
+    """ Directory of navigation indexes, one file by citation tree of a resource
+
+    Indexes are mapped once by process and mapped again when their file is replaced by a new ingest. Only the most
+    recently used ones are kept mapped: the others are dropped, and their file is unmapped and closed as soon as the
+    requests still reading them are done.
+
+    :param directory: Directory of the index files
+    :param max_open: Number of indexes kept mapped, each one holds a file descriptor
+    """
+    def __init__(self, directory: str, max_open: int = 256):
+        self.directory = directory
+        self._indexes: BoundedCache[Tuple[Tuple[int, int], NavigationIndex]] = BoundedCache(
+            max_open, size=lambda _: 1
+        )
+        self._lock = threading.Lock()
+
+    def path(self, resource: str, tree: Optional[str]) -> str:
+        """ Path of the index of a citation tree """
+        digest = hashlib.sha1(f"{resource}\x00{tree}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.nav")
+
+    def write(self, resource: str, tree: Optional[str], paths: Dict[str, List[int]], members: Dict[str, str]):
+        """ Write the index of a citation tree, see :func:`write_index` """
+        os.makedirs(self.directory, exist_ok=True)
+        write_index(self.path(resource, tree), paths, members)
+
+    def get(self, resource: str, tree: Optional[str]) -> Optional[NavigationIndex]:
+        """ Index of a citation tree, None when it was not written """
+        path = self.path(resource, tree)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+        cached = self._indexes.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            cached = self._indexes.get(path)
+            if cached is None or cached[0] != version:
+                cached = (version, NavigationIndex(path))
+                self._indexes.put(path, cached)
+            return cached[1]
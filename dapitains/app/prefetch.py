@@ -0,0 +1,141 @@
+""" Prefetching of the passages readers are likely to request next
+
+Readers page through texts: after `ref=1.4` comes `ref=1.5`. Once a passage is served, a :class:`Prefetcher` looks
+up the following reference of the same level in the refs table and renders it into the passage cache from a
+background thread, so that the next request of the reader is a cache hit.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, Optional
+
+try:
+    from flask import Flask
+except ImportError:
+    print("This part of the package can only be imported with the web requirements.")
+    raise
+
+from dapitains.app.caching import PassageCache
+from dapitains.app.database import Reference, db
+from dapitains.app.workers import PassagePool, render_file_passage
+
+
+__all__ = ["Prefetcher"]
+
+
+class Prefetcher:
+    """ Background rendering of the passage following each served passage
+
+    :param max_pending: Number of passages being prefetched at once, further prefetches are skipped
+    :param workers: Number of threads rendering prefetched passages
+    :param history: Number of prefetched passages remembered to measure the hit rate
+    """
+    def __init__(self, max_pending: int = 2, workers: int = 1, history: int = 10000):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dts-prefetch")
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._history = history
+        self._prefetched: "OrderedDict[Hashable, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.app: Optional[Flask] = None
+        self.passages: Optional[PassageCache] = None
+        self.pool: Optional[PassagePool] = None
+        self.counters: Dict[str, int] = {
+            "scheduled": 0, "skipped": 0, "cached": 0, "rendered": 0, "failed": 0, "hits": 0
+        }
+
+    def init_app(self, app: Flask, passages: PassageCache, pool: Optional[PassagePool] = None):
+        """ Prefetch the passages of an application into its passage cache """
+        self.app = app
+        self.passages = passages
+        self.pool = pool
+        app.extensions["dapitains_prefetch"] = self
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def served(self, key: Hashable):
+        """ Record that a passage was requested, to count the prefetched passages that were used """
+        with self._lock:
+            if key in self._prefetched:
+                del self._prefetched[key]
+                self.counters["hits"] += 1
+
+    def schedule(
+            self,
+            resource: str,
+            collection_id: int,
+            file_path: str,
+            content_hash: Optional[str],
+            tree: str,
+            ordinal: int,
+            level: int
+    ) -> bool:
+        """ Prefetch the reference following a served one, unless too many prefetches are running
+
+        :return: Whether the prefetch was scheduled
+        """
+        if not self._pending.acquire(blocking=False):
+            self._count("skipped")
+            return False
+        try:
+            future = self._executor.submit(
+                self._prefetch, resource, collection_id, file_path, content_hash, tree, ordinal, level
+            )
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        self._count("scheduled")
+        return True
+
+    def _prefetch(
+            self,
+            resource: str,
+            collection_id: int,
+            file_path: str,
+            content_hash: Optional[str],
+            tree: str,
+            ordinal: int,
+            level: int
+    ):
+        with self.app.app_context():
+            following = db.session.query(Reference.ref, Reference.plan).filter(
+                Reference.collection_id == collection_id,
+                Reference.tree == tree,
+                Reference.ordinal > ordinal,
+                Reference.level == level
+            ).order_by(Reference.ordinal).first()
+        if following is None:
+            return
+        key = PassageCache.key(resource, tree, following.ref, None, content_hash)
+        if key in self.passages.cache:
+            self._count("cached")
+            return
+        # Remembered before rendering: a request arriving during the rendering waits for it, and counts as a hit
+        with self._lock:
+            self._prefetched[key] = None
+            while len(self._prefetched) > self._history:
+                self._prefetched.popitem(last=False)
+        try:
+            self.passages.get_or_render(key, lambda: render_file_passage(
+                file_path, following.ref, tree=tree, plans={following.ref: following.plan}, pool=self.pool,
+                content_hash=content_hash
+            ))
+        except Exception:
+            with self._lock:
+                self._prefetched.pop(key, None)
+                self.counters["failed"] += 1
+            return
+        self._count("rendered")
+
+    def stats(self) -> Dict[str, float]:
+        """ Counters of the prefetcher, with the share of rendered passages that were requested afterwards """
+        with self._lock:
+            stats = dict(self.counters)
+        stats["hit_rate"] = stats["hits"] / stats["rendered"] if stats["rendered"] else 0.0
+        return stats
+
+    def shutdown(self, wait: bool = True):
+        """ Stop the prefetching thread """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,153 @@
+""" In-memory snapshot of the catalog
+
+Collections only change on ingest: a :class:`CatalogSnapshot` reads them once, with their members, and keeps their
+representations serialized, so that collection responses are built without querying the database. Snapshots are
+never modified. :class:`CatalogCache` holds the snapshot an application serves and replaces it in a single
+assignment when the catalog is ingested again: a request keeps reading the snapshot it started with.
+"""
+import json
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import uritemplate
+from sqlalchemy import select
+
+from dapitains.app.database import Collection, db, parent_child_association
+
+
+__all__ = ["CatalogEntry", "CatalogSnapshot", "CatalogCache"]
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    """ Collection of a snapshot
+
+    :param identifier: Identifier of the collection
+    :param fields: Serialized properties of the collection representation, without the surrounding braces
+    :param member_head: Start of the serialized representation of the collection as a member of another one
+    :param member_tail: End of the serialized representation as a member, after the totals of the requested collection
+    :param total_children: Number of children
+    :param total_parents: Number of parents
+    :param children: Identifiers of the children, in the order of the catalog
+    :param parents: Identifiers of the parents, in the order of the catalog
+    """
+    identifier: str
+    fields: str
+    member_head: str
+    member_tail: str
+    total_children: int
+    total_parents: int
+    children: Tuple[str, ...]
+    parents: Tuple[str, ...]
+
+    def as_member(self, total_parents: int, total_children: int) -> str:
+        """ Serialized representation of the collection as a member
+
+        Members carry the totals of the collection they are listed in.
+        """
+        return f'{self.member_head}, "totalParents": {total_parents}, "totalChildren": {total_children}{self.member_tail}'
+
+
+def _member_parts(collection: Collection, templates: Dict[str, uritemplate.URITemplate]) -> Tuple[str, str]:
+    """ Split the serialized member representation of a collection around the place of the totals """
+    if collection.resource:
+        links = {
+            "collection": templates["collection"].partial({"id": collection.identifier}).uri,
+            "document": templates["document"].partial({"resource": collection.identifier}).uri,
+        }
+        if collection.citeStructure:
+            links["navigation"] = templates["navigation"].partial({"resource": collection.identifier}).uri
+    else:
+        links = {"collection": templates["collection"].partial({"id": collection.identifier}).uri}
+    data = collection.json(inject=links)
+    keys = list(data)
+    split = keys.index(list(links)[-1]) + 1
+    head = json.dumps({key: data[key] for key in keys[:split]})[:-1]
+    tail = {key: data[key] for key in keys[split:]}
+    return head, ", " + json.dumps(tail)[1:] if tail else "}"
+
+
+class CatalogSnapshot:
+    """ Immutable view of the collections of the database
+
+    :param entries: Collections by identifier
+    :param root: Identifier of the root collection
+    """
+    def __init__(self, entries: Dict[str, CatalogEntry], root: Optional[str]):
+        self.entries: Mapping[str, CatalogEntry] = MappingProxyType(dict(entries))
+        self.root = root
+
+    def get(self, identifier: Optional[str]) -> Optional[CatalogEntry]:
+        """ Retrieve a collection, the root one without identifier """
+        return self.entries.get(identifier or self.root)
+
+    @classmethod
+    def load(cls, templates: Dict[str, uritemplate.URITemplate]) -> "CatalogSnapshot":
+        """ Read the catalog from the database
+
+        :param templates: URI templates of the collection, document and navigation routes
+        """
+        children: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+        parents: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+        for parent, child, position, parent_position in db.session.execute(select(
+                parent_child_association.c.parent_id,
+                parent_child_association.c.child_id,
+                parent_child_association.c.position,
+                parent_child_association.c.parent_position
+        )):
+            children[parent].append((position, child))
+            parents[child].append((parent_position, parent))
+
+        collections = Collection.query.order_by(Collection.id).all()
+        identifiers = {collection.id: collection.identifier for collection in collections}
+        entries = {}
+        root = None
+        for collection in collections:
+            if root is None and collection.total_parents == 0:
+                root = collection.identifier
+            head, tail = _member_parts(collection, templates)
+            entries[collection.identifier] = CatalogEntry(
+                identifier=collection.identifier,
+                fields=json.dumps(collection.json())[1:-1],
+                member_head=head,
+                member_tail=tail,
+                total_children=collection.total_children,
+                total_parents=collection.total_parents,
+                children=tuple(identifiers[child] for _, child in sorted(children[collection.id])),
+                parents=tuple(identifiers[parent] for _, parent in sorted(parents[collection.id]))
+            )
+        return cls(entries, root)
+
+
+class CatalogCache:
+    """ Snapshot served by an application
+
+    The snapshot is loaded on first use, and :meth:`refresh` swaps in a new one. Both must be called within an
+    application context.
+
+    :param templates: URI templates of the collection, document and navigation routes
+    """
+    def __init__(self, templates: Dict[str, uritemplate.URITemplate]):
+        self.templates = templates
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = CatalogSnapshot.load(self.templates)
+                snapshot = self._snapshot
+        return snapshot
+
+    def refresh(self) -> CatalogSnapshot:
+        """ Load a new snapshot from the database and serve it from now on """
+        snapshot = CatalogSnapshot.load(self.templates)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
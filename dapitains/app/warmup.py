@@ -0,0 +1,244 @@
+""" Warm-up of the caches of an application from its hot requests
+
+A freshly started application parses documents, maps navigation indexes and renders passages on its first requests,
+which are therefore much slower than the following ones. :class:`Warmup` replays the most requested URIs, taken from
+an access log or a hot list (see :func:`hot_uris`), so that the caches of the application are filled before (or while)
+it serves its traffic: the passage cache, the compressed responses in each encoding, the navigation indexes and, with
+a :class:`dapitains.app.workers.PassagePool`, the documents parsed by the workers.
+"""
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Sequence, Union
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+try:
+    from flask import Flask
+except ImportError:
+    print("This part of the package can only be imported with the web requirements.")
+    raise
+
+from dapitains.app.export import DOCUMENT_TEMPLATE, NAVIGATION_TEMPLATE
+
+
+__all__ = ["Warmup", "WarmupReport", "hot_uris", "replay"]
+
+
+ENDPOINTS = ("/collection/", "/navigation/", "/document/")
+# Request line of the common and combined log formats
+LOG_REQUEST = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[\d.]+" (\d{3})')
+
+
+def _request_uri(uri: str) -> str:
+    parts = urlsplit(uri)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def hot_uris(lines: Iterable[str], limit: Optional[int] = None) -> List[str]:
+    """ Requests to warm, the most frequent first
+
+    Each line is either a line of an access log (common or combined format, only successful GET and HEAD requests
+    are kept), a request URI, or a resource identifier followed by a reference (a passage) or alone (its navigation).
+
+    >>> hot_uris([
+    ...     '127.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /document/?resource=a&ref=1 HTTP/1.1" 200 512',
+    ...     '127.0.0.1 - - [19/Oct/2026:10:00:01 +0000] "GET /document/?resource=b HTTP/1.1" 404 12',
+    ...     'https://foo.bar/text Luke 1',
+    ...     'https://foo.bar/text Luke 1',
+    ...     'https://foo.bar/text',
+    ...     'https://foo.bar/text Luke 1',
+    ...     '/document/?resource=a&ref=1'
+    ... ])
+    ['/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201', '/document/?resource=a&ref=1', \
+'/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=1']
+
+    :param lines: Lines of the access log or of the hot list
+    :param limit: Number of URIs to keep
+    """
+    counts = Counter()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        logged = LOG_REQUEST.search(line)
+        if logged:
+            if not logged.group(2).startswith("2"):
+                continue
+            uri = _request_uri(logged.group(1))
+        elif line.startswith("/") or (line.startswith("http") and urlsplit(line).path.startswith(ENDPOINTS)):
+            uri = _request_uri(line)
+        else:
+            resource, _, ref = line.partition(" ")
+            if ref.strip():
+                uri = DOCUMENT_TEMPLATE.expand(resource=resource, ref=ref.strip())
+            else:
+                uri = NAVIGATION_TEMPLATE.expand(resource=resource, down=1)
+        if uri.startswith(ENDPOINTS):
+            counts[uri] += 1
+    return [uri for uri, _ in counts.most_common(limit)]
+
+
+@dataclass
+class WarmupReport:
+    """ Outcome of a warm-up
+
+    :param warmed: Number of requests replayed
+    :param size: Number of bytes of the responses
+    :param seconds: Duration of the warm-up
+    :param skipped: Number of requests left out once the budget was reached
+    :param failed: URIs that did not return a successful response
+    """
+    warmed: int = 0
+    size: int = 0
+    seconds: float = 0.0
+    skipped: int = 0
+    failed: List[str] = field(default_factory=list)
+
+
+class Warmup:
+    """ Replay of hot requests to fill the caches of an application
+
+    Once registered with :meth:`init_app`, the warm-up runs on the first request the application receives: that
+    request (and the ones arriving meanwhile) waits for it, unless `background` is set, in which case the requests
+    are replayed in a background thread, `pause` seconds apart, while the application serves its traffic. It can also
+    be run explicitly with :meth:`run`, once the database of the application is initialised and before it is served.
+
+    :param uris: URIs to request, or lines of an access log or hot list (see :func:`hot_uris`)
+    :param budget: Number of bytes of responses after which the warm-up stops, defaults to the size of the passage
+        cache of the application
+    :param background: Warm the application in a background thread instead of holding its first requests
+    :param pause: Seconds between two requests of a background warm-up
+    """
+    def __init__(
+            self,
+            uris: Iterable[str],
+            budget: Optional[int] = None,
+            background: bool = False,
+            pause: float = 0.0
+    ):
+        self.uris = hot_uris(uris)
+        self.budget = budget
+        self.background = background
+        self.pause = pause
+        self.app: Optional[Flask] = None
+        self.report: Optional[WarmupReport] = None
+        self._started = False
+        self._done = threading.Event()
+        self._runner: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "Warmup":
+        """ Warm-up from an access log or a hot list """
+        with open(path, encoding="utf-8") as f:
+            return cls(f, **kwargs)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        app.extensions["dapitains_warmup"] = self
+        app.before_request(self._before_request)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def _start(self) -> bool:
+        with self._lock:
+            if self._started:
+                return False
+            self._started = True
+            return True
+
+    def _before_request(self):
+        # Requests replayed by the warm-up go through this hook as well
+        if self._done.is_set() or threading.current_thread() is self._runner:
+            return
+        if self._start():
+            if self.background:
+                threading.Thread(target=self._run, name="dts-warmup", daemon=True).start()
+            else:
+                self._run()
+        elif not self.background:
+            self._done.wait()
+
+    def run(self) -> Optional[WarmupReport]:
+        """ Warm the application now, unless the warm-up already started
+
+        :return: Report of the warm-up, None if it already started
+        """
+        if not self._start():
+            return None
+        return self._run()
+
+    def _run(self) -> WarmupReport:
+        self._runner = threading.current_thread()
+        budget = self.budget
+        if budget is None and "dapitains_passages" in self.app.extensions:
+            budget = self.app.extensions["dapitains_passages"].cache.max_size
+        try:
+            self.report = replay(self.app, self.uris, budget, pause=self.pause if self.background else 0.0)
+            return self.report
+        finally:
+            self._runner = None
+            self._done.set()
+
+
+def _encodings(app: Flask) -> List[Optional[str]]:
+    compression = app.extensions.get("dapitains_compression")
+    return [None, *compression.encodings] if compression else [None]
+
+
+def replay(
+        app_or_server: Union[Flask, str],
+        uris: List[str],
+        budget: Optional[int] = None,
+        pause: float = 0.0,
+        encodings: Optional[Sequence[Optional[str]]] = None
+) -> WarmupReport:
+    """ Request URIs in order until their responses reach the budget
+
+    Compressed responses are kept by encoding (see :class:`dapitains.app.compression.Compression`): each URI is
+    requested once by encoding, the Accept-Encoding header of each request naming a single one.
+
+    :param app_or_server: Application, requested in-process, or base URL of a running server
+    :param uris: Request URIs
+    :param budget: Number of bytes of responses after which the warm-up stops
+    :param pause: Seconds between two requests
+    :param encodings: Encodings to request, None standing for uncompressed responses. Defaults to uncompressed
+        responses and, for an application, the encodings of its compression.
+    """
+    report = WarmupReport()
+    began = time.perf_counter()
+    client = None
+    if isinstance(app_or_server, Flask):
+        client = app_or_server.test_client()
+        encodings = encodings if encodings is not None else _encodings(app_or_server)
+    encodings = encodings if encodings is not None else [None]
+    for position, uri in enumerate(uris):
+        if budget is not None and report.size >= budget:
+            report.skipped = len(uris) - position
+            break
+        succeeded = True
+        for encoding in encodings:
+            if (position or encoding != encodings[0]) and pause:
+                time.sleep(pause)
+            headers = {"Accept-Encoding": encoding} if encoding else {}
+            if client is not None:
+                response = client.get(uri, headers=headers)
+                status, size = response.status_code, len(response.get_data())
+            else:
+                try:
+                    with urlopen(Request(app_or_server.rstrip("/") + uri, headers=headers)) as response:
+                        status, size = response.status, len(response.read())
+                except OSError:
+                    status, size = 0, 0
+            report.size += size
+            succeeded = succeeded and 200 <= status < 300
+        report.warmed += 1
+        if not succeeded:
+            report.failed.append(uri)
+    report.seconds = time.perf_counter() - began
+    return report
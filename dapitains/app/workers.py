@@ -0,0 +1,165 @@
+""" Offloading of passage rendering to worker processes.
+
+Passage reconstruction is CPU-bound Python: in a threaded server, a large range request holds the GIL and stalls every
+other request of the process. A :class:`PassagePool` renders passages in worker processes instead. Each resource is
+always sent to the same worker, which keeps its parsed documents in memory between requests, by version of their
+source file.
+"""
+import multiprocessing
+import os
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Union
+
+import lxml.etree as ET
+from dapitains.tei.document import Document
+
+
+__all__ = ["PassagePool", "PoolBusy", "PassageTimeout", "render_passage", "render_file_passage"]
+
+
+class PoolBusy(Exception):
+    """ Raised when too many passages are already waiting to be rendered """
+
+
+class PassageTimeout(Exception):
+    """ Raised when a passage was not rendered in time """
+
+
+def render_passage(
+        doc: Document,
+        ref_or_start: str,
+        end: Optional[str] = None,
+        tree: Optional[str] = None,
+        plans: Optional[Dict[str, List[str]]] = None
+) -> str:
+    """ Render a passage of a document as an XML string
+
+    :param doc: Document
+    :param ref_or_start: First element of a range or single ref
+    :param end: End of a range
+    :param tree: Name of a specific tree
+    :param plans: Reconstruction plans of the requested references
+    :return: Serialized passage
+    """
+    return ET.tostring(doc.get_passage(ref_or_start=ref_or_start, end=end, tree=tree, plans=plans), encoding=str)
+
+
+def _parse(file_path: str, version: Union[str, int]) -> Document:
+    return Document(file_path)
+
+
+# Documents already parsed by the current worker process, by path and version of their file, set up by _init_worker
+_load_document: Callable[[str, Union[str, int]], Document] = _parse
+
+
+def _init_worker(cache_size: int):
+    global _load_document
+    _load_document = lru_cache(maxsize=cache_size)(_parse)
+
+
+def _render(
+        file_path: str,
+        ref_or_start: str,
+        end: Optional[str],
+        tree: Optional[str],
+        plans: Optional[Dict[str, List[str]]],
+        content_hash: Optional[str] = None
+) -> str:
+    # A modified source is parsed again: its content hash changes once it is ingested again, its modification time
+    #   stands for it when the hash is not known
+    version = content_hash or os.stat(file_path).st_mtime_ns
+    return render_passage(_load_document(file_path, version), ref_or_start, end=end, tree=tree, plans=plans)
+
+
+class PassagePool:
+    """ Pool of worker processes rendering passages
+
+    Workers are started with the `spawn` method, as SaxonC does not survive a fork once initialized.
+
+    :param workers: Number of worker processes, defaults to the number of CPUs
+    :param timeout: Seconds to wait for a passage before giving up, None to wait forever
+    :param max_pending: Number of passages that can be queued or rendered at once before new requests are refused
+    :param cache_size: Number of documents each worker keeps parsed
+    """
+    def __init__(
+            self,
+            workers: Optional[int] = None,
+            timeout: Optional[float] = 30.0,
+            max_pending: int = 64,
+            cache_size: int = 16
+    ):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        context = multiprocessing.get_context("spawn")
+        # One single-process executor per worker, so that a resource is always rendered by the process that
+        # already parsed it
+        self._executors = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker, initargs=(cache_size,))
+            for _ in range(self.workers)
+        ]
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def _executor(self, file_path: str) -> ProcessPoolExecutor:
+        return self._executors[zlib.crc32(file_path.encode()) % self.workers]
+
+    def render(
+            self,
+            file_path: str,
+            ref_or_start: str,
+            end: Optional[str] = None,
+            tree: Optional[str] = None,
+            plans: Optional[Dict[str, List[str]]] = None,
+            content_hash: Optional[str] = None
+    ) -> str:
+        """ Render a passage in the worker assigned to its file
+
+        :param file_path: Path to the TEI file
+        :param ref_or_start: First element of a range or single ref
+        :param end: End of a range
+        :param tree: Name of a specific tree
+        :param plans: Reconstruction plans of the requested references
+        :param content_hash: Hash of the file at ingest (see :func:`dapitains.tei.sources.source_hash`), identifying
+            the version of the document kept by the worker. The modification time of the file is used without it.
+        :return: Serialized passage
+        :raises PoolBusy: When `max_pending` passages are already waiting
+        :raises PassageTimeout: When the passage was not rendered within `timeout` seconds
+        """
+        if not self._pending.acquire(blocking=False):
+            raise PoolBusy()
+        try:
+            future = self._executor(file_path).submit(
+                _render, file_path, ref_or_start, end, tree, plans, content_hash
+            )
+        except BaseException:
+            self._pending.release()
+            raise
+        # The slot is only freed once the worker is done, even if the request gave up waiting
+        future.add_done_callback(lambda _: self._pending.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PassageTimeout()
+
+    def shutdown(self, wait: bool = True):
+        """ Stop the worker processes """
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
+
+
+def render_file_passage(
+        file_path: str,
+        ref_or_start: str,
+        end: Optional[str] = None,
+        tree: Optional[str] = None,
+        plans: Optional[Dict[str, List[str]]] = None,
+        pool: Optional[PassagePool] = None,
+        content_hash: Optional[str] = None
+) -> str:
+    """ Render a passage of a source file, in the worker processes of `pool` or in the current process without one """
+    if pool is None:
+        return render_passage(Document(file_path), ref_or_start, end=end, tree=tree, plans=plans)
+    return pool.render(file_path, ref_or_start, end=end, tree=tree, plans=plans, content_hash=content_hash)
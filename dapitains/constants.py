@@ -1,5 +1,9 @@
 import logging
 import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, TypeVar
 
 try:
     saxon_version = os.getenv("pysaxon", "HE")
@@ -20,6 +24,31 @@ except ImportError:
     PROCESSOR = saxonlib.PySaxonProcessor()
 
 
+# SaxonC runs in a single native isolate, which only knows one current thread: two Python threads calling into it at
+# the same time crash the process, even with one processor per thread. Every use of Saxon (parsing, XPath evaluation,
+# reading results, releasing objects) must happen within saxon_thread(). Saxon objects can be created in a thread
+# and used in another one.
+SAXON_LOCK = threading.RLock()
+
+_Function = TypeVar("_Function", bound=Callable)
+
+
+@contextmanager
+def saxon_thread():
+    """ Hold :data:`SAXON_LOCK` and make the current thread the one Saxon runs on """
+    with SAXON_LOCK:
+        # Accessing the attribute attaches the thread
+        PROCESSOR.attach_current_thread
+        yield PROCESSOR
+
+
+def saxon_locked(function: _Function) -> _Function:
+    """ Decorator running the function within :func:`saxon_thread` """
+    @wraps(function)
+    def wrapped(*args, **kwargs):
+        with saxon_thread():
+            return function(*args, **kwargs)
+    return wrapped
 
 
 def get_xpath_proc(elem: saxonlib.PyXdmNode) -> saxonlib.PyXPathProcessor:
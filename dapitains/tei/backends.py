@@ -0,0 +1,288 @@
+""" XML engines used to resolve the references of citation trees.
+
+Saxon supports the full XPath 3.1 language used by refsDecl, but each evaluation crosses the native boundary of
+SaxonC. When every XPath of a citation tree is XPath 1.0, lxml's compiled :class:`lxml.etree.XPath` give the same
+results directly on an lxml tree. :func:`select_backend` picks lxml whenever the citation tree allows it.
+"""
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from lxml import etree
+from dapitains.constants import saxonlib, saxon_locked
+from dapitains.tei.citeStructure import CitableStructure, CitableUnit, CiteStructureParser
+
+
+__all__ = ["Backend", "SaxonBackend", "LxmlBackend", "BACKENDS", "select_backend", "qualify_xpath"]
+
+
+_TEI_NS = "http://www.tei-c.org/ns/1.0"
+_NAMESPACES = {"tei": _TEI_NS}
+
+_XPATH1_FUNCTIONS = {
+    "last", "position", "count", "id", "local-name", "namespace-uri", "name", "string", "concat", "starts-with",
+    "contains", "substring-before", "substring-after", "substring", "string-length", "normalize-space",
+    "translate", "boolean", "not", "true", "false", "lang", "number", "sum", "floor", "ceiling", "round",
+    # Node types
+    "comment", "text", "processing-instruction", "node"
+}
+_OPERATORS = {"and", "or", "mod", "div", "*", "/", "//", "|", "+", "-", "=", "!=", "<", "<=", ">", ">="}
+_NAME_TEST_CONTEXT = {"@", "::", "(", "[", ","}
+
+_token = re.compile(r"""
+    (?P<literal>"[^"]*"|'[^']*')
+    |(?P<number>\d+(?:\.\d*)?|\.\d+)
+    |(?P<name>[A-Za-z_][\w.\-]*(?::(?:[A-Za-z_][\w.\-]*|\*))?)
+    |(?P<symbol>//|::|\.\.|!=|<=|>=|[/.@()\[\],|=<>+\-*$])
+    |(?P<space>\s+)
+""", re.VERBOSE)
+
+
+def qualify_xpath(xpath: str) -> Optional[str]:
+    """ Bind unprefixed element names of an XPath 1.0 expression to the TEI namespace
+
+    Saxon declares TEI as the default namespace, which XPath 1.0 has no notion of: `//body/div[@n='1']` becomes
+    `//tei:body/tei:div[@n='1']`, while attributes, functions and axes are left untouched.
+
+    :param xpath: XPath expression
+    :return: Qualified expression, or None if the expression is not XPath 1.0
+    """
+    tokens = []
+    position = 0
+    while position < len(xpath):
+        match = _token.match(xpath, position)
+        if not match:
+            return None
+        tokens.append((match.lastgroup, match.group()))
+        position = match.end()
+
+    significant = [index for index, (kind, _) in enumerate(tokens) if kind != "space"]
+    # Whether each significant token is an operator, following the disambiguation rules of XPath 1.0 (3.7)
+    is_operator: List[bool] = []
+    for rank, index in enumerate(significant):
+        kind, value = tokens[index]
+        previous = tokens[significant[rank - 1]][1] if rank else None
+        next_value = tokens[significant[rank + 1]][1] if rank + 1 < len(significant) else None
+        operator_position = rank > 0 and previous not in _NAME_TEST_CONTEXT and not is_operator[rank - 1]
+        is_operator.append(value in _OPERATORS and (operator_position or value not in ("*", "and", "or", "mod", "div")))
+
+        if kind != "name" or is_operator[rank]:
+            continue
+        if next_value == "(":
+            if value not in _XPATH1_FUNCTIONS:
+                return None
+        elif next_value == "::" or previous in ("@", "$") or ":" in value:
+            continue
+        elif rank > 1 and previous == "::" and tokens[significant[rank - 2]][1] in ("attribute", "namespace"):
+            continue
+        else:
+            tokens[index] = (kind, f"tei:{value}")
+
+    return "".join(value for _, value in tokens)
+
+
+@lru_cache(maxsize=1024)
+def _compile(xpath: str) -> Optional[etree.XPath]:
+    """ Compile a TEI XPath with lxml, or return None if lxml cannot evaluate it """
+    qualified = qualify_xpath(xpath)
+    if qualified is None:
+        return None
+    try:
+        return etree.XPath(qualified, namespaces=_NAMESPACES)
+    except etree.XPathError:
+        return None
+
+
+def _string_value(item: Union[str, etree._Element]) -> str:
+    if isinstance(item, etree._Element):
+        return "".join(item.itertext())
+    return str(item)
+
+
+class Backend:
+    """ Engine resolving the references of citation trees over a parsed document """
+    name: str = ""
+
+    @classmethod
+    def supports(cls, structure: CitableStructure) -> bool:
+        """ Check whether the backend can resolve a citation tree (with its children) """
+        raise NotImplementedError
+
+    def find_refs(self, parser: CiteStructureParser) -> List[CitableUnit]:
+        """ Retrieve the references of a citation tree
+
+        :param parser: Citation tree
+        :return: References, with their children
+        """
+        raise NotImplementedError
+
+    def find_all_refs(
+            self,
+            parsers: Dict[Optional[str], CiteStructureParser]
+    ) -> Dict[Optional[str], List[CitableUnit]]:
+        """ Retrieve the references of several citation trees of the same document
+
+        :param parsers: Citation trees by name
+        :return: References by tree name
+        """
+        return {tree: self.find_refs(parser) for tree, parser in parsers.items()}
+
+
+class SaxonBackend(Backend):
+    """ Saxon backend, supports every citation tree
+
+    :param xml: Document parsed by Saxon
+    """
+    name = "saxon"
+
+    def __init__(self, xml: saxonlib.PyXdmNode):
+        self.xml = xml
+
+    @classmethod
+    def supports(cls, structure: CitableStructure) -> bool:
+        return True
+
+    @saxon_locked
+    def find_refs(self, parser: CiteStructureParser) -> List[CitableUnit]:
+        return parser.find_refs(root=self.xml, structure=parser.structure)
+
+
+class LxmlBackend(Backend):
+    """ lxml backend, supports citation trees whose match, use and citeData are XPath 1.0 expressions
+
+    `use="position()"` is supported as long as `match` is a single step.
+
+    :param xml: Document parsed by lxml
+    """
+    name = "lxml"
+
+    def __init__(self, xml: etree._ElementTree):
+        self.xml = xml
+
+    @staticmethod
+    def _match_xpath(structure: CitableStructure, root: bool) -> str:
+        # At the root, Saxon evaluates `match` from the document node, lxml would evaluate it from the root element
+        if root and not structure.match.startswith("/"):
+            return f"/{structure.match}"
+        return f"./{structure.match}" if not root else structure.match
+
+    @classmethod
+    def supports(cls, structure: CitableStructure, root: bool = True) -> bool:
+        if not structure.match or not structure.use:
+            return False
+        if structure.use == "position()":
+            if "/" in structure.match or _compile(cls._match_xpath(structure, root)) is None:
+                return False
+        elif _compile(f"{cls._match_xpath(structure, root)}/{structure.use}") is None or _compile(structure.use) is None:
+            return False
+        if any(_compile(f"./{cite_data.xpath}") is None for cite_data in structure.metadata):
+            return False
+        return all(cls.supports(child, root=False) for child in structure.children)
+
+    def find_refs(self, parser: CiteStructureParser) -> List[CitableUnit]:
+        return self.find_all_refs({None: parser})[None]
+
+    def find_all_refs(
+            self,
+            parsers: Dict[Optional[str], CiteStructureParser]
+    ) -> Dict[Optional[str], List[CitableUnit]]:
+        """ Retrieve the references of several citation trees in a single walk
+
+        Evaluations are shared between trees: trees that use the same `match`, `use` or citeData from the same node
+        (eg. `//body/div` with `@n` in one tree and `@xml:id` in another) evaluate it only once.
+
+        :param parsers: Citation trees by name
+        :return: References by tree name
+        """
+        for parser in parsers.values():
+            if not self.supports(parser.structure):
+                raise ValueError(f"The citeStructure `{parser.structure.citeType}` is not supported by lxml")
+        cache: Dict[Tuple[str, Any], List[Any]] = {}
+        references = {}
+        for tree, parser in parsers.items():
+            references[tree] = []
+            self._find_refs(
+                context=self.xml, structures=[parser.structure], units=references[tree], parent=None, level=1,
+                first_nodes={}, cache=cache
+            )
+        return references
+
+    @staticmethod
+    def _evaluate(xpath: str, node: Union[etree._ElementTree, etree._Element], cache: Dict) -> List[Any]:
+        key = (xpath, node)
+        if key not in cache:
+            cache[key] = _compile(xpath)(node)
+        return cache[key]
+
+    def _find_refs(
+            self,
+            context: Union[etree._ElementTree, etree._Element],
+            structures: List[CitableStructure],
+            units: List[CitableUnit],
+            parent: Optional[CitableUnit],
+            level: int,
+            first_nodes: Dict[str, etree._Element],
+            cache: Dict[Tuple[str, Any], List[Any]]
+    ):
+        """ Resolve the references of sibling structures from a context node, in document order """
+        found = []
+        for structure in structures:
+            nodes = self._evaluate(self._match_xpath(structure, root=parent is None), context, cache)
+            for position, node in enumerate(nodes, 1):
+                if structure.use == "position()":
+                    values = [str(position)]
+                else:
+                    values = [_string_value(value) for value in self._evaluate(structure.use, node, cache)]
+                found.extend((node, value, structure) for value in values)
+
+        if len(structures) > 1:
+            order = {node: index for index, node in enumerate(context.iter())}
+            found.sort(key=lambda item: order[item[0]])
+
+        for node, value, structure in found:
+            ref = f"{parent.ref}{structure.delim}{value}" if parent else value
+            unit = CitableUnit(
+                citeType=structure.citeType,
+                ref=ref,
+                parent=parent.ref if parent else None,
+                level=level
+            )
+            # As on the Saxon path, a reference always resolves to the first node it designates
+            node = first_nodes.setdefault(ref, node)
+            for cite_data in structure.metadata:
+                for value in self._evaluate(f"./{cite_data.xpath}", node, cache):
+                    getattr(unit, cite_data.key)[cite_data.name].append(_string_value(value))
+            units.append(unit)
+            if structure.children:
+                self._find_refs(
+                    context=node,
+                    structures=structure.children,
+                    units=unit.children,
+                    parent=unit,
+                    level=level + 1,
+                    first_nodes=first_nodes,
+                    cache=cache
+                )
+
+
+BACKENDS: Dict[str, Type[Backend]] = {
+    SaxonBackend.name: SaxonBackend,
+    LxmlBackend.name: LxmlBackend
+}
+
+
+def select_backend(structure: CitableStructure, preferred: str = "auto") -> Type[Backend]:
+    """ Pick the backend used to resolve a citation tree
+
+    :param structure: Root structure of the citation tree
+    :param preferred: `auto` to use lxml when the citation tree allows it, or the name of a backend
+    :return: Backend class
+    """
+    if preferred == "auto":
+        return LxmlBackend if LxmlBackend.supports(structure) else SaxonBackend
+    try:
+        backend = BACKENDS[preferred]
+    except KeyError:
+        raise ValueError(f"Unknown backend `{preferred}`")
+    if not backend.supports(structure):
+        raise ValueError(f"The citeStructure `{structure.citeType}` is not supported by {preferred}")
+    return backend
@@ -1,9 +1,9 @@
 import re
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Iterable, Iterator, Tuple
 from dataclasses import dataclass, field
 from collections import namedtuple, defaultdict
 from functools import cmp_to_key
-from dapitains.constants import get_xpath_proc, saxonlib
+from dapitains.constants import get_xpath_proc, saxonlib, saxon_thread
 
 
 @dataclass
@@ -23,15 +23,41 @@ class CiteData:
         return self._key
 
 
-@dataclass
 class CitableStructure:
-    citeType: str
-    xpath: str
-    xpath_match: str
-    use: str
-    delim: str = ""
-    children: List["CitableStructure"] = field(default_factory=list)
-    metadata: List["CiteData"] = field(default_factory=list)
+    """ Structure of a citation level, parsed from a citeStructure element
+
+    Instances use slots, as a citation tree has one instance per citeStructure.
+    """
+    __slots__ = ("citeType", "xpath", "xpath_match", "use", "delim", "match", "children", "metadata")
+
+    def __init__(
+            self,
+            citeType: str,
+            xpath: str,
+            xpath_match: str,
+            use: str,
+            delim: str = "",
+            match: str = "",
+            children: Optional[List["CitableStructure"]] = None,
+            metadata: Optional[List["CiteData"]] = None
+    ):
+        self.citeType: str = citeType
+        self.xpath: str = xpath
+        self.xpath_match: str = xpath_match
+        self.use: str = use
+        self.delim: str = delim
+        self.match: str = match
+        self.children: List["CitableStructure"] = children if children is not None else []
+        self.metadata: List["CiteData"] = metadata if metadata is not None else []
+
+    def __repr__(self):
+        return f"CitableStructure(citeType={self.citeType!r}, match={self.match!r}, use={self.use!r}, " \
+               f"delim={self.delim!r}, children={self.children!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, CitableStructure):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
 
     def get(self, ref: str):
         if self.use != "position()":
@@ -50,37 +76,191 @@ class CitableStructure:
         return out
 
 
-@dataclass
 class CitableUnit:
-    citeType: str
-    ref: str
-    children: List["CitableUnit"] = field(default_factory=list)
-    node: Optional[saxonlib.PyXdmNode] = None
-    dublinCore: Dict[str, List[str]] = field(default_factory=lambda: defaultdict(list))
-    extension: Dict[str, List[str]] = field(default_factory=lambda: defaultdict(list))
-    level: int = 1
-    parent: Optional[str] = None
+    """ Citable unit found in a document
+
+    Documents can hold millions of units: instances use slots, and their children and metadata containers are only
+    created when they are first written to.
+    """
+    __slots__ = ("citeType", "ref", "level", "parent", "node", "_children", "_dublinCore", "_extension")
+
+    def __init__(
+            self,
+            citeType: str,
+            ref: str,
+            children: Optional[List["CitableUnit"]] = None,
+            node: Optional[saxonlib.PyXdmNode] = None,
+            dublinCore: Optional[Dict[str, List[str]]] = None,
+            extension: Optional[Dict[str, List[str]]] = None,
+            level: int = 1,
+            parent: Optional[str] = None
+    ):
+        self.citeType: str = citeType
+        self.ref: str = ref
+        self.level: int = level
+        self.parent: Optional[str] = parent
+        self.node: Optional[saxonlib.PyXdmNode] = node
+        self._children: Optional[List["CitableUnit"]] = children or None
+        self._dublinCore: Optional[Dict[str, List[str]]] = defaultdict(list, dublinCore) if dublinCore else None
+        self._extension: Optional[Dict[str, List[str]]] = defaultdict(list, extension) if extension else None
+
+    @property
+    def children(self) -> List["CitableUnit"]:
+        if self._children is None:
+            self._children = []
+        return self._children
+
+    @children.setter
+    def children(self, value: List["CitableUnit"]):
+        self._children = value
+
+    @property
+    def dublinCore(self) -> Dict[str, List[str]]:
+        if self._dublinCore is None:
+            self._dublinCore = defaultdict(list)
+        return self._dublinCore
+
+    @property
+    def extension(self) -> Dict[str, List[str]]:
+        if self._extension is None:
+            self._extension = defaultdict(list)
+        return self._extension
+
+    def __repr__(self):
+        return f"CitableUnit(citeType={self.citeType!r}, ref={self.ref!r}, level={self.level!r}, " \
+               f"parent={self.parent!r}, children={self._children or []!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, CitableUnit):
+            return NotImplemented
+        return self.json() == other.json()
 
     def json(self):
-        out = {
-            "citeType": self.citeType,
-            "identifier": self.ref,
-            "level": self.level,
-            "parent": self.parent
+        return units_json([self])[0]
+
+
+def iter_units(units: List[CitableUnit]) -> Iterator[Tuple[int, Optional[int], CitableUnit]]:
+    """ Walk references in document order, without recursion
+
+    :param units: Top level references
+    :return: Iterator over (ordinal, ordinal of the parent or None, unit), where ordinals are positions in the
+        document order
+    """
+    ordinal = 0
+    stack: List[Tuple[Iterator[CitableUnit], Optional[int]]] = [(iter(units), None)]
+    while stack:
+        siblings, parent = stack[-1]
+        unit = next(siblings, None)
+        if unit is None:
+            stack.pop()
+            continue
+        yield ordinal, parent, unit
+        if unit._children:
+            stack.append((iter(unit._children), ordinal))
+        ordinal += 1
+
+
+def units_json(units: List[CitableUnit]) -> List[Dict[str, Any]]:
+    """ Serialize references, without recursion
+
+    :param units: Top level references
+    :return: Same output as `[unit.json() for unit in units]`
+    """
+    out: List[Dict[str, Any]] = []
+    # Members list of each serialized unit, by ordinal
+    members: Dict[int, List[Dict[str, Any]]] = {}
+    for ordinal, parent, unit in iter_units(units):
+        data = {
+            "citeType": unit.citeType,
+            "identifier": unit.ref,
+            "level": unit.level,
+            "parent": unit.parent
         }
-        if self.children:
-            out["members"] = [
-                member.json()
-                for member in self.children
-            ]
-        if self.dublinCore:
-            out["dublinCore"] = dict(self.dublinCore)
-        if self.extension:
-            out["extension"] = dict(self.extension)
-        return out
+        if unit._children:
+            data["members"] = members[ordinal] = []
+        if unit._dublinCore:
+            data["dublinCore"] = dict(unit._dublinCore)
+        if unit._extension:
+            data["extension"] = dict(unit._extension)
+        (out if parent is None else members[parent]).append(data)
+    return out
+
+
+_simple_node = namedtuple("SimpleNode", ["citation", "xpath", "struct", "metadata"])
+
+
+class _RefLevel:
+    """ State of :class:`RefTokenizer`, one per citeStructure """
+    __slots__ = ("key", "delim", "stops", "children")
+
+    def __init__(self, key: str, delim: str, stops: Optional[frozenset], children: List["_RefLevel"]):
+        self.key = key
+        self.delim = delim
+        # Characters ending the value of the level, None for leaves which end at a line break
+        self.stops = stops
+        self.children = children
+
+    def scan(self, reference: str, position: int) -> int:
+        """ Return the end of the value of this level starting at position """
+        end = len(reference)
+        if self.stops is None:
+            line_break = reference.find("\n", position)
+            return end if line_break == -1 else line_break
+        while position < end and reference[position] not in self.stops:
+            position += 1
+        return position
+
+
+class RefTokenizer:
+    """ Deterministic parser splitting a reference into the values of each citation level
+
+    It follows the citeStructure tree: the value of a level runs until one of the delimiters of its children, and
+    the next level is the first child whose delimiter follows. Each character is read once, which guarantees a
+    linear time, and results are the same as :attr:`CiteStructureParser.regex_pattern` (including the group
+    names, such as `book__chapter__verse`).
+
+    :param structure: Root of the citation tree
+    """
+    def __init__(self, structure: CitableStructure):
+        self.root: _RefLevel = self._build(structure, "")
+
+    def _build(self, structure: CitableStructure, accumulated_units: str) -> _RefLevel:
+        key = f"{accumulated_units}__{structure.citeType}" if accumulated_units else structure.citeType
+        stops = None
+        if structure.children:
+            stops = frozenset("".join(child.delim for child in structure.children))
+        return _RefLevel(
+            key=key,
+            delim=structure.delim,
+            stops=stops,
+            children=[self._build(child, key) for child in structure.children]
+        )
 
+    def tokenize(self, reference: str) -> List[Tuple[str, str]]:
+        """ Split a reference into its values
 
-_simple_node = namedtuple("SimpleNode", ["citation", "xpath", "struct"])
+        :param reference: Reference to parse, such as `Luke 1:2`
+        :return: List of (level key, value) from the root to the deepest level found. Unparsable trailing
+            characters are ignored.
+        :raises ValueError: When the reference does not match the root level
+        """
+        tokens = []
+        levels, position = [self.root], 0
+        while levels:
+            for level in levels:
+                if not reference.startswith(level.delim, position):
+                    continue
+                start = position + len(level.delim)
+                end = level.scan(reference, start)
+                if end > start:
+                    tokens.append((level.key, reference[start:end]))
+                    levels, position = level.children, end
+                    break
+            else:
+                break
+        if not tokens:
+            raise ValueError(f"Reference '{reference}' does not match the expected format.")
+        return tokens
 
 
 def get_children_cite_structures(elem: saxonlib.PyXdmNode) -> List[saxonlib.PyXdmNode]:
@@ -103,6 +283,13 @@ class CiteStructureParser:
             get_xpath_proc(self.root).evaluate_single("./citeStructure[1]")
         )
         self.structure: CitableStructure = cite_structure
+        self.tokenizer: RefTokenizer = RefTokenizer(cite_structure)
+
+    def __del__(self):
+        # Releasing the refsDecl node calls into Saxon as well
+        if getattr(self, "root", None) is not None:
+            with saxon_thread():
+                self.root = None
 
     def build_regex_and_xpath(
             self,
@@ -126,7 +313,8 @@ class CiteStructureParser:
             xpath="",
             xpath_match="",
             use=use,
-            delim=delim or ""
+            delim=delim or "",
+            match=match or ""
         )
 
         children_cite_struct = get_children_cite_structures(element)
@@ -189,12 +377,10 @@ class CiteStructureParser:
         return current_regex, cite_structure
 
     def generate_xpath(self, reference):
-        match = re.match(self.regex_pattern, reference)
-        if not match:
-            raise ValueError(f"Reference '{reference}' does not match the expected format.")
-
-        match = {k:v for k, v in match.groupdict().items() if v}
-        xpath = "/".join([self.xpath_matcher[key].format(**{key: value}) for key, value in match.items()])
+        xpath = "/".join([
+            self.xpath_matcher[key].format(**{key: value})
+            for key, value in self.tokenizer.tokenize(reference)
+        ])
         # This is a VERY dirty trick in case we have // down the road
         xpath = xpath.replace("///", "//")
         return xpath
@@ -222,6 +408,66 @@ class CiteStructureParser:
                 level=level
             )
 
+    def _find_level_cite_data(
+            self,
+            xpath_proc: saxonlib.PyXPathProcessor,
+            match_xpath: str,
+            structure: CitableStructure,
+            values: List[saxonlib.PyXdmItem]
+    ) -> Optional[Dict[str, List[Tuple[CiteData, List[str]]]]]:
+        """ Evaluate the citeData of a structure for all the nodes of a level at once
+
+        Each citeData is evaluated with a single XPath over the nodes matched by the structure, instead of
+        resolving every unit from the root.
+
+        :param xpath_proc: XPath processor around the parent node
+        :param match_xpath: XPath matching the nodes of the level, relative to the parent
+        :param structure: Structure of the level
+        :param values: Values of `use` for the level, in document order
+        :return: CiteData values by reference, or None if nodes and values could not be aligned
+        """
+        if not structure.metadata:
+            return None
+        by_node: List[List[Tuple[CiteData, List[str]]]] = [[] for _ in values]
+        for cite_data in structure.metadata:
+            # For each node, the number of values is followed by the values themselves
+            items = iter(xpath_proc.evaluate(
+                f"for $node in {match_xpath} return "
+                f"(count($node/({cite_data.xpath})), $node/({cite_data.xpath}) ! string(.))"
+            ) or [])
+            node = -1
+            for node, count in enumerate(items):
+                if node >= len(values):
+                    return None
+                by_node[node].append((cite_data, [next(items).string_value for _ in range(int(count.string_value))]))
+            if node + 1 != len(values):
+                return None
+
+        metadata = {}
+        for value, found in zip(values, by_node):
+            # As references are resolved from the root, duplicates always get the data of the first node
+            metadata.setdefault(value.string_value, found)
+        return metadata
+
+    def _find_unit_cite_data(
+            self,
+            xpath_proc: saxonlib.PyXPathProcessor,
+            ref: str,
+            structure: CitableStructure
+    ) -> List[Tuple[CiteData, List[str]]]:
+        """ Evaluate the citeData of a single unit, resolving its node from its reference """
+        local_xproc = get_xpath_proc(xpath_proc.evaluate_single(self.generate_xpath(ref)))
+        return [
+            (cite_data, [value.get_string_value() for value in local_xproc.evaluate(cite_data.xpath) or []])
+            for cite_data in structure.metadata
+        ]
+
+    @staticmethod
+    def _set_cite_data(unit: CitableUnit, metadata: List[Tuple[CiteData, List[str]]]):
+        for cite_data, values in metadata:
+            if values:
+                unit.__getattribute__(cite_data.key)[cite_data.name].extend(values)
+
     def find_refs(
             self,
             root: saxonlib.PyXdmNode,
@@ -234,7 +480,10 @@ class CiteStructureParser:
         units = []
         xpath_prefix = "./" if unit else ""
 
-        for value in xpath_proc.evaluate(f"{xpath_prefix}{structure.xpath}"):
+        values = list(xpath_proc.evaluate(f"{xpath_prefix}{structure.xpath}") or [])
+        metadata = self._find_level_cite_data(xpath_proc, f"{xpath_prefix}{structure.xpath_match}", structure, values)
+
+        for index, value in enumerate(values):
             child = CitableUnit(
                 citeType=structure.citeType,
                 ref=f"{prefix}{value.string_value}",
@@ -242,12 +491,10 @@ class CiteStructureParser:
                 level=level
             )
 
-            if structure.metadata:
-                local_xproc = get_xpath_proc(xpath_proc.evaluate_single(self.generate_xpath(child.ref)))
-                for cite_data in structure.metadata:
-                    if metadata_found := local_xproc.evaluate(cite_data.xpath):
-                        for value in metadata_found:
-                            child.__getattribute__(cite_data.key)[cite_data.name].append(value.get_string_value())
+            if metadata is not None:
+                self._set_cite_data(child, metadata[value.string_value])
+            elif structure.metadata:
+                self._set_cite_data(child, self._find_unit_cite_data(xpath_proc, child.ref, structure))
 
             if unit:
                 unit.children.append(child)
@@ -287,16 +534,22 @@ class CiteStructureParser:
 
         unsorted = []
         for s in structure:
+            values = list(xpath_proc.evaluate(f"{xpath_prefix}{s.xpath}") or [])
+            metadata = self._find_level_cite_data(xpath_proc, f"{xpath_prefix}{s.xpath_match}", s, values)
             unsorted.extend(
                 [
-                    (f"{prefix}{s.delim}{value}", s)
-                    for value in xpath_proc.evaluate(f"{xpath_prefix}{s.xpath}")
+                    (
+                        f"{prefix}{s.delim}{value.string_value}",
+                        s,
+                        metadata[value.string_value] if metadata is not None else None
+                    )
+                    for value in values
                 ]
             )
 
         unsorted = [
-            _simple_node(ref, self.generate_xpath(ref), struct)
-            for ref, struct in unsorted
+            _simple_node(ref, self.generate_xpath(ref), struct, metadata)
+            for ref, struct, metadata in unsorted
         ]
         unsorted = sorted(unsorted, key=cmp_to_key(compare_nodes_by_doc_order))
 
@@ -309,6 +562,11 @@ class CiteStructureParser:
                 parent=unit.ref if unit else None
             )
 
+            if elem.metadata is not None:
+                self._set_cite_data(child_unit, elem.metadata)
+            elif elem.struct.metadata:
+                self._set_cite_data(child_unit, self._find_unit_cite_data(xpath_proc, child_unit.ref, elem.struct))
+
             if unit:
                 unit.children.append(child_unit)
             else:
@@ -324,3 +582,24 @@ class CiteStructureParser:
                 )
         return units
 
+
+def parse_refs_decls(
+        refs_decls: Iterable[saxonlib.PyXdmNode]
+) -> Tuple[Dict[Optional[str], CiteStructureParser], Optional[str]]:
+    """ Parse refsDecl elements into citation trees
+
+    :param refs_decls: refsDecl nodes containing at least one citeStructure
+    :return: Tuple of the citation trees by name and of the name of the default tree
+    """
+    cite_structures: Dict[Optional[str], CiteStructureParser] = {}
+
+    default = None
+    for refsDecl in refs_decls:
+        struct = CiteStructureParser(refsDecl)
+
+        cite_structures[refsDecl.get_attribute_value("n") or "default"] = struct
+
+        if refsDecl.get_attribute_value("default") == "true" or default is None:
+            default = refsDecl.get_attribute_value("n") or "default"
+
+    return cite_structures, default
@@ -1,10 +1,14 @@
-from dapitains.tei.citeStructure import CiteStructureParser
-from dapitains.constants import PROCESSOR, get_xpath_proc, saxonlib
+from dapitains.tei.citeStructure import CiteStructureParser, CitableUnit
+from dapitains.tei.backends import Backend, SaxonBackend, LxmlBackend, select_backend
+from dapitains.tei.streaming import read_cite_structures
+from dapitains.tei.sources import compression_of, open_source, read_source
+from dapitains.constants import PROCESSOR, get_xpath_proc, saxonlib, saxon_locked, saxon_thread
 from typing import Optional, List, Tuple, Dict
-from lxml.etree import fromstring
+from lxml.etree import fromstring, parse, _ElementTree, XMLParser
 from lxml.objectify import Element, SubElement
 from lxml import objectify
 import re
+import threading
 from dapitains.errors import UnknownTreeName
 
 
@@ -86,7 +90,8 @@ def copy_node(node: saxonlib.PyXdmNode, include_children=False, parent: Optional
         return element
 
     attribs = {
-        attr.name: attr.string_value
+        # Saxon names namespaced attributes Q{ns}name (EQName), lxml expects {ns}name
+        attr.name[1:] if attr.name.startswith("Q{") else attr.name: attr.string_value
         for attr in node.attributes
     }
     namespace, node_name = _namespace.match(node.name).groups()
@@ -122,6 +127,25 @@ def normalize_xpath(xpath: List[str]) -> List[str]:
     return new_xpath
 
 
+def xpath_split(string: str) -> List[str]:
+    """ Split an XPath around its slashes, keeping the second slash of // on the following step """
+    return [x for x in re.split(r"/(/?[^/]+)", string) if x]
+
+
+def passage_plan(parser: CiteStructureParser, ref: str) -> List[str]:
+    """ Compute the reconstruction plan of a reference, ie. the normalized XPath steps used by
+    :func:`reconstruct_doc`. Steps starting with `/` traverse more than one level (`//`).
+
+    The plan only depends on the citation tree and the reference: it can be computed once at ingest and handed
+    to :meth:`Document.get_passage`.
+
+    :param parser: Citation tree of the reference
+    :param ref: Reference
+    :return: List of XPath steps
+    """
+    return normalize_xpath(xpath_split(parser.generate_xpath(ref)))
+
+
 def reconstruct_doc(
     root: saxonlib.PyXdmNode,
     start_xpath: List[str],
@@ -227,28 +251,86 @@ def reconstruct_doc(
 
 
 class Document:
-    def __init__(self, file_path: str):
-        self.xml = PROCESSOR.parse_xml(xml_file_name=file_path)
-        self.xpath_processor = get_xpath_proc(elem=self.xml)
-        self.citeStructure: Dict[Optional[str], CiteStructureParser] = {}
-
-        default = None
-        for refsDecl in self.xpath_processor.evaluate("/TEI/teiHeader/refsDecl[./citeStructure]"):
-            struct = CiteStructureParser(refsDecl)
+    """ TEI Document
 
-            self.citeStructure[refsDecl.get_attribute_value("n") or "default"] = struct
+    Citation trees are read from the teiHeader only. The document itself is parsed by Saxon (:attr:`xml`) or lxml
+    (:attr:`lxml`) the first time one of them is required.
 
-            if refsDecl.get_attribute_value("default") == "true" or default is None:
-                default = refsDecl.get_attribute_value("n") or "default"
+    :param file_path: Path to the TEI file, which may be compressed (see :mod:`dapitains.tei.sources`)
+    :param backend: Engine used to resolve references: `auto` uses lxml when the citation tree allows it, `saxon`
+        and `lxml` force a specific engine.
 
+    A Document can be shared between threads. Its methods use Saxon within :func:`dapitains.constants.saxon_thread`,
+    so that Saxon work is serialized across the process, while lxml work runs concurrently. Saxon nodes obtained
+    from :attr:`xml` or :attr:`xpath_processor` must only be used within it as well.
+    """
+    def __init__(self, file_path: str, backend: str = "auto"):
+        self.file_path: str = file_path
+        self.backend: str = backend
+        self._xml: Optional[saxonlib.PyXdmNode] = None
+        self._lxml: Optional[_ElementTree] = None
+        self._lxml_lock = threading.Lock()
+        self.citeStructure: Dict[Optional[str], CiteStructureParser]
+        self.citeStructure, default = read_cite_structures(file_path)
         self.default_tree: str = default
 
-    def get_passage(self, ref_or_start: Optional[str], end: Optional[str] = None, tree: Optional[str] = None) -> Element:
+    def __del__(self):
+        # Releasing the Saxon document calls into Saxon as well
+        if getattr(self, "_xml", None) is not None:
+            with saxon_thread():
+                self._xml = None
+
+    @property
+    @saxon_locked
+    def xml(self) -> saxonlib.PyXdmNode:
+        """ Document parsed by Saxon """
+        if self._xml is None:
+            if compression_of(self.file_path):
+                self._xml = PROCESSOR.parse_xml(xml_text=read_source(self.file_path).decode("utf-8"))
+            else:
+                self._xml = PROCESSOR.parse_xml(xml_file_name=self.file_path)
+        return self._xml
+
+    @property
+    @saxon_locked
+    def xpath_processor(self) -> saxonlib.PyXPathProcessor:
+        return get_xpath_proc(elem=self.xml)
+
+    @property
+    def lxml(self) -> _ElementTree:
+        """ Document parsed by lxml """
+        if self._lxml is None:
+            with self._lxml_lock:
+                if self._lxml is None:
+                    with open_source(self.file_path) as f:
+                        self._lxml = parse(f, parser=XMLParser(huge_tree=True))
+        return self._lxml
+
+    def get_backend(self, tree: Optional[str] = None) -> Backend:
+        """ Retrieve the engine used to resolve the references of a tree
+
+        :param tree: Name of a specific tree
+        """
+        backend = select_backend(self.citeStructure[tree or self.default_tree].structure, preferred=self.backend)
+        if backend is LxmlBackend:
+            return LxmlBackend(self.lxml)
+        return SaxonBackend(self.xml)
+
+    @saxon_locked
+    def get_passage(
+            self,
+            ref_or_start: Optional[str],
+            end: Optional[str] = None,
+            tree: Optional[str] = None,
+            plans: Optional[Dict[str, List[str]]] = None
+    ) -> Element:
         """ Retrieve a given passage from the document
 
         :param ref_or_start: First element of a range or single ref
         :param end: End of a range
         :param tree: Name of a specific tree
+        :param plans: Reconstruction plans (see :func:`passage_plan`) of the requested references, computed at ingest.
+            References without plan are resolved through the citation tree.
         """
         if ref_or_start and not end:
             start, end = ref_or_start, None
@@ -260,18 +342,13 @@ class Document:
             raise ValueError("Start/End or Ref are necessary to get a passage")
 
         tree = tree or self.default_tree
-        try:
-            start = self.citeStructure[tree].generate_xpath(start)
-        except KeyError:
+        plans = plans or {}
+        if tree not in self.citeStructure:
             raise UnknownTreeName(tree)
 
-        def xpath_split(string: str) -> List[str]:
-            return [x for x in re.split(r"/(/?[^/]+)", string) if x]
-
-        start = normalize_xpath(xpath_split(start))
+        start = plans[start] if start in plans else passage_plan(self.citeStructure[tree], start)
         if end:
-            end = self.citeStructure[tree].generate_xpath(end)
-            end = normalize_xpath(xpath_split(end))
+            end = plans[end] if end in plans else passage_plan(self.citeStructure[tree], end)
         else:
             end = start
 
@@ -284,6 +361,22 @@ class Document:
         objectify.deannotate(root, cleanup_namespaces=True)
         return root
 
-    def get_reffs(self, tree: Optional[str] = None):
-        tree = self.citeStructure[tree or self.default_tree]
-        return tree.find_refs(root=self.xml, structure=tree.structure)
+    def get_reffs(self, tree: Optional[str] = None) -> List[CitableUnit]:
+        return self.get_backend(tree).find_refs(self.citeStructure[tree or self.default_tree])
+
+    def get_all_reffs(self, trees: Optional[List[str]] = None) -> Dict[Optional[str], List[CitableUnit]]:
+        """ Retrieve the references of several trees, sharing the document walk between trees of the same backend
+
+        :param trees: Names of the trees to resolve, all trees by default
+        :return: References by tree name, in the order of `trees`
+        """
+        trees = list(self.citeStructure) if trees is None else trees
+        by_backend: Dict[str, Tuple[Backend, Dict[Optional[str], CiteStructureParser]]] = {}
+        for tree in trees:
+            backend = self.get_backend(tree)
+            by_backend.setdefault(backend.name, (backend, {}))[1][tree] = self.citeStructure[tree]
+
+        references = {}
+        for backend, parsers in by_backend.values():
+            references.update(backend.find_all_refs(parsers))
+        return {tree: references[tree] for tree in trees}
@@ -0,0 +1,82 @@
+""" Compressed TEI sources
+
+TEI files can be stored compressed with gzip (`.gz`) or zstd (`.zst`, which requires the `zstandard` package):
+they are decompressed on the fly by the functions of this module whenever they are read, so that the file path of a
+compressed source can be used wherever the one of an XML file is expected.
+"""
+import gzip
+import hashlib
+import io
+import os
+from typing import BinaryIO, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+__all__ = ["compression_of", "uncompressed_name", "open_source", "read_source", "iter_source", "source_hash"]
+
+
+COMPRESSED_EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+
+def compression_of(file_path: str) -> Optional[str]:
+    """ Compression of a source file, from its extension
+
+    >>> compression_of("text.xml.gz"), compression_of("text.xml")
+    ('gzip', None)
+    """
+    return COMPRESSED_EXTENSIONS.get(os.path.splitext(file_path)[1])
+
+
+def uncompressed_name(file_path: str) -> str:
+    """ Path of a source file without its compression extension
+
+    >>> uncompressed_name("text.xml.zst")
+    'text.xml'
+    """
+    root, extension = os.path.splitext(file_path)
+    return root if extension in COMPRESSED_EXTENSIONS else file_path
+
+
+def open_source(file_path: str) -> BinaryIO:
+    """ Open a source file for reading, decompressing it if needed """
+    compression = compression_of(file_path)
+    if compression == "gzip":
+        return gzip.open(file_path, "rb")
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ImportError(f"Reading {file_path} requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), read_across_frames=True, closefd=True)
+    return open(file_path, "rb")
+
+
+def read_source(file_path: str) -> bytes:
+    """ Read a whole source file, decompressed """
+    with open_source(file_path) as f:
+        return f.read()
+
+
+def iter_source(file_path: str, chunk_size: int = 1 << 16) -> Iterator[str]:
+    """ Read a source file as text, decompressed chunk by chunk
+
+    :param file_path: Path to the source file
+    :param chunk_size: Number of characters of each chunk
+    """
+    with io.TextIOWrapper(open_source(file_path), encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def source_hash(file_path: str) -> str:
+    """ SHA-256 of a source file, as stored """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,207 @@
+""" Streaming extraction of references for large TEI files.
+
+The Saxon path (:meth:`CiteStructureParser.find_refs`) requires the whole document to be loaded in memory. For
+citeStructures that only use element names on the child axis for `match` and a single attribute for `use`, references
+can be computed from a single :func:`lxml.etree.iterparse` pass, which only keeps the current branch of the
+document in memory.
+"""
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+from lxml import etree
+from dapitains.constants import get_xpath_proc, saxon_thread
+from dapitains.tei.sources import open_source
+from dapitains.tei.citeStructure import CitableStructure, CitableUnit, CiteStructureParser, parse_refs_decls
+
+
+__all__ = ["is_streamable", "read_cite_structures", "stream_refs", "stream_trees"]
+
+
+_TEI_NS = "http://www.tei-c.org/ns/1.0"
+_XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+_name = r"[A-Za-z_][\w.\-]*"
+_root_match = re.compile(rf"^(?P<traversing>//|/)?(?P<steps>{_name}(?:/{_name})*)$")
+_child_match = re.compile(rf"^{_name}$")
+_attribute_use = re.compile(rf"^@(?P<prefix>xml:)?(?P<name>{_name})$")
+
+
+def _clark(name: str) -> str:
+    return f"{{{_TEI_NS}}}{name}"
+
+
+def _attribute(use: str) -> str:
+    """ Converts an eligible `use` attribute XPath into the attribute name used by lxml """
+    prefix, name = _attribute_use.match(use).groups()
+    if prefix:
+        return f"{{{_XML_NS}}}{name}"
+    return name
+
+
+def _iterparse(file_path: str) -> Iterator[Tuple[str, etree._Element]]:
+    """ Stream the start and end events of a file, decompressed if needed """
+    with open_source(file_path) as f:
+        yield from etree.iterparse(f, events=("start", "end"), huge_tree=True)
+
+
+def is_streamable(structure: CitableStructure, root: bool = True) -> bool:
+    """ Check whether a citation tree can be resolved with a streaming pass
+
+    The root structure may use an absolute or `//` prefixed path of simple element names (eg. `//body/div`), while
+    children structures must match a single element name (eg. `div`). Every level must use a single attribute
+    (eg. `@n`) and have no citeData.
+
+    :param structure: Structure to check, with its children
+    :param root: Whether the structure is the root of the citation tree
+    :return: True if :func:`stream_refs` returns the same references as the Saxon path
+    """
+    if structure.metadata or not _attribute_use.match(structure.use or ""):
+        return False
+    if not (_root_match if root else _child_match).match(structure.match or ""):
+        return False
+    return all(is_streamable(child, root=False) for child in structure.children)
+
+
+def read_cite_structures(file_path: str) -> Tuple[Dict[Optional[str], CiteStructureParser], Optional[str]]:
+    """ Read the citation trees of a file, without parsing the full document
+
+    The file is streamed up to the end of its teiHeader, and only the refsDecl elements are handed to Saxon.
+
+    :param file_path: Path to a TEI file
+    :return: Tuple of the citation trees by name and of the name of the default tree
+    """
+    refs_decls = []
+    depth = 0
+    for event, elem in _iterparse(file_path):
+        if event == "start":
+            depth += 1
+            # The teiHeader is the first child of TEI: anything else means we have no header to read
+            if (depth == 1 and elem.tag != _clark("TEI")) or (depth == 2 and elem.tag != _clark("teiHeader")):
+                break
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag == _clark("teiHeader"):
+            refs_decls = [
+                etree.tostring(refs_decl, encoding=str)
+                for refs_decl in elem.iterchildren(_clark("refsDecl"))
+                if refs_decl.find(_clark("citeStructure")) is not None
+            ]
+            break
+    with saxon_thread() as processor:
+        return parse_refs_decls(
+            get_xpath_proc(processor.parse_xml(xml_text=refs_decl)).evaluate_single("/refsDecl")
+            for refs_decl in refs_decls
+        )
+
+
+class _RootMatcher:
+    """ Checks whether the current branch of a streamed document matches the root `match` """
+    def __init__(self, match: str):
+        groups = _root_match.match(match)
+        self.steps = [_clark(step) for step in groups.group("steps").split("/")]
+        self.anywhere = groups.group("traversing") == "//"
+
+    def __call__(self, branch: List[str]) -> bool:
+        if self.anywhere:
+            return branch[-len(self.steps):] == self.steps
+        return branch == self.steps
+
+
+def _deduplicate(units: List[CitableUnit], seen: Dict[str, CitableUnit]) -> None:
+    """ Align duplicated references on the Saxon path, where the children of a reference are always the ones of
+    the first element the reference resolves to.
+    """
+    for unit in units:
+        if unit.ref in seen:
+            unit.children = _copy(seen[unit.ref].children)
+        else:
+            seen[unit.ref] = unit
+            _deduplicate(unit.children, seen)
+
+
+def _copy(units: List[CitableUnit]) -> List[CitableUnit]:
+    return [
+        CitableUnit(
+            citeType=unit.citeType,
+            ref=unit.ref,
+            children=_copy(unit.children),
+            level=unit.level,
+            parent=unit.parent
+        )
+        for unit in units
+    ]
+
+
+def stream_refs(file_path: str, structure: CitableStructure) -> List[CitableUnit]:
+    """ Retrieve the references of a file with a single streaming pass
+
+    :param file_path: Path to a TEI file
+    :param structure: Root structure of the citation tree, which must be streamable (see :func:`is_streamable`)
+    :return: Same references as `CiteStructureParser.find_refs(root=document, structure=structure)`
+    """
+    return stream_trees(file_path, {None: structure})[None]
+
+
+def stream_trees(
+        file_path: str,
+        structures: Dict[Optional[str], CitableStructure]
+) -> Dict[Optional[str], List[CitableUnit]]:
+    """ Retrieve the references of several citation trees of a file with a single streaming pass
+
+    :param file_path: Path to a TEI file
+    :param structures: Root structures of the citation trees by tree name, which must all be streamable
+    :return: References by tree name
+    """
+    roots = []
+    for tree, structure in structures.items():
+        if not is_streamable(structure):
+            raise ValueError(f"The citeStructure `{structure.citeType}` cannot be streamed")
+        roots.append((tree, _RootMatcher(structure.match), _attribute(structure.use), structure))
+    units: Dict[Optional[str], List[CitableUnit]] = {tree: [] for tree in structures}
+
+    # Current branch of element names, and units (with their structure) produced by each element of the branch
+    branch: List[str] = []
+    opened: List[List[Tuple[CitableUnit, CitableStructure]]] = []
+
+    for event, elem in _iterparse(file_path):
+        if event == "end":
+            branch.pop()
+            opened.pop()
+            # Free the memory used by elements we are done with
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            continue
+
+        branch.append(elem.tag)
+        produced = []
+
+        if opened:
+            for parent, parent_structure in opened[-1]:
+                for child_structure in parent_structure.children:
+                    if elem.tag != _clark(child_structure.match):
+                        continue
+                    value = elem.get(_attribute(child_structure.use))
+                    if value is None:
+                        continue
+                    child = CitableUnit(
+                        citeType=child_structure.citeType,
+                        ref=f"{parent.ref}{child_structure.delim}{value}",
+                        parent=parent.ref,
+                        level=parent.level + 1
+                    )
+                    parent.children.append(child)
+                    produced.append((child, child_structure))
+
+        for tree, root_matcher, root_attribute, structure in roots:
+            if root_matcher(branch):
+                value = elem.get(root_attribute)
+                if value is not None:
+                    unit = CitableUnit(citeType=structure.citeType, ref=value, level=1)
+                    units[tree].append(unit)
+                    produced.append((unit, structure))
+
+        opened.append(produced)
+
+    for tree_units in units.values():
+        _deduplicate(tree_units, {})
+    return units
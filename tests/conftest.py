@@ -0,0 +1,45 @@
+import os
+from typing import Optional
+import pytest
+from flask import Flask
+from dapitains.app.app import create_app
+from dapitains.app.database import db
+from dapitains.app.ingest import store_catalog
+from dapitains.metadata.xml_parser import parse
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+BASE_URI = "http://localhost:5000"
+
+
+@pytest.fixture
+def app_factory():
+    """Fixture building applications on the test catalog, with the options of create_app, dropped after the test
+
+    The factory takes the URI of the database (in memory by default), the catalog to store, whether to store only the
+    default citation trees (`lazy_trees`) and the options of create_app.
+    """
+    apps = []
+
+    def make(
+            database: str = "sqlite://",
+            catalog: Optional[str] = f"{basedir}/catalog/example-collection.xml",
+            lazy_trees: bool = False,
+            **create_app_kwargs
+    ) -> Flask:
+        app, _ = create_app(Flask(__name__), base_uri=BASE_URI, **create_app_kwargs)
+        app.config["SQLALCHEMY_DATABASE_URI"] = database
+        app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        db.init_app(app)
+        apps.append(app)
+        if catalog:
+            with app.app_context():
+                db.create_all()
+                store_catalog(parse(catalog)[0], lazy_trees=lazy_trees)
+        return app
+
+    yield make
+
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
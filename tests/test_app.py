@@ -1,9 +1,20 @@
+import json
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from flask import Flask
-from dapitains.app.app import create_app
-from dapitains.app.ingest import store_catalog
-from dapitains.metadata.xml_parser import parse
+from dapitains.app.app import create_app, collection_view
+from dapitains.app.snapshot import CatalogSnapshot
+from dapitains.app import ingest
+from dapitains.app.ingest import store_catalog, publish_catalog, build_pending_trees, build_tree, build_closure
+from dapitains.app.database import Collection, Navigation, Reference, db, collection_closure
+from dapitains.app.navigation import get_nav
+from dapitains.app.navigation_index import FILE_MODE
+from dapitains.tei.document import Document, passage_plan
+import lxml.etree as ET
 import uritemplate
 import urllib
 
@@ -12,26 +23,10 @@ BASE_URI = "http://localhost:5000"
 
 
 @pytest.fixture
-def app():
+def app(app_factory):
     """Fixture to create a new instance of the Flask app for testing."""
-    app = Flask(__name__)
-    app, db = create_app(app, base_uri=BASE_URI)
     db_path = os.path.join(basedir, 'app.db')
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    db.init_app(app)
-
-    with app.app_context():
-        db.create_all()
-        catalog, _ = parse(f"{basedir}/catalog/example-collection.xml")
-        store_catalog(catalog)
-
-    yield app
-
-    # Teardown: Drop all tables after each test
-    with app.app_context():
-        db.session.remove()
-        db.drop_all()
+    return app_factory(database=f'sqlite:///{db_path}')
 
 
 @pytest.fixture
@@ -157,3 +152,411 @@ def test_collection(client):
             'title': 'My First Collection',
             'totalChildren': 1,
             'totalParents': 1} == response.get_json()
+
+
+def test_document_uses_stored_plans(app, client):
+    """Check that passage plans are stored at ingest and give the same passages as the citation tree"""
+    with app.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://example.org/resource1").first()
+        rows = Reference.query.where(Reference.collection_id == collection.id).all()
+        assert {row.tree for row in rows} == {"nums", "alpha"}
+        doc = Document(collection.filepath)
+        for row in rows:
+            assert row.plan == passage_plan(doc.citeStructure[row.tree], row.ref)
+
+    response = client.get("/document/?resource=https%3A%2F%2Fexample.org%2Fresource1&ref=4&tree=nums")
+    assert response.status_code == 200
+    assert response.mimetype == "application/xml"
+    doc = Document(f"{basedir}/tei/multiple_tree.xml")
+    assert response.get_data(as_text=True) == ET.tostring(doc.get_passage("4", tree="nums"), encoding=str)
+
+
+def test_document_reference_checks(app, client):
+    """Check that unknown references and reversed ranges are refused from the refs table"""
+    with app.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://example.org/resource1").first()
+        rows = Reference.query.where(
+            Reference.collection_id == collection.id, Reference.tree == "nums"
+        ).order_by(Reference.ordinal).all()
+        assert [(row.ref, row.ordinal, row.level) for row in rows] == [
+            ("I", 0, 1), ("1", 1, 1), ("A", 2, 1), ("4", 3, 1), ("V", 4, 1)
+        ]
+
+    base = "/document/?resource=https%3A%2F%2Fexample.org%2Fresource1"
+    response = client.get(f"{base}&ref=Unknown")
+    assert response.status_code == 404
+    assert response.get_json() == {"message": "Unknown reference Unknown in the requested tree."}
+    response = client.get(f"{base}&start=1&end=Unknown")
+    assert response.status_code == 404
+    response = client.get(f"{base}&start=4&end=1")
+    assert response.status_code == 400
+    assert response.get_json() == {
+        "message": "End reference comes before start in the document order. Interchange start and end."
+    }
+    response = client.get(f"{base}&start=1&end=4")
+    assert response.status_code == 200
+    response = client.get(f"{base}&ref=div-a1&tree=alpha")
+    assert response.status_code == 200
+    response = client.get(f"{base}&ref=1&tree=unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("query,expected", [
+    ({"down": 1}, (None, None, 1)),
+    ({"down": -1}, (None, None, -1)),
+    ({"ref": "Luke", "down": -1}, ("Luke", None, -1)),
+    ({"ref": "Luke 1", "down": 1}, ("Luke 1", None, 1)),
+    ({"ref": "Luke 1", "down": "0"}, ("Luke 1", None, 0)),
+    ({"start": "Luke 1:1", "end": "Mark 1:2", "down": 1}, ("Luke 1:1", "Mark 1:2", 1)),
+    ({"start": "Luke", "end": "Mark 1", "down": -1}, ("Luke", "Mark 1", -1)),
+])
+def test_navigation_fragments(app, client, query, expected):
+    """Check that navigation responses spliced from stored fragments are the ones json.dumps gives"""
+    template = uritemplate.URITemplate("/navigation/{?resource}{&ref,start,end,tree,down,page}")
+    response = client.get(template.expand(resource="https://foo.bar/text", **query))
+    assert response.status_code == 200
+    j = response.get_json()
+    assert response.get_data(as_text=True) == json.dumps(j)
+
+    with app.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://foo.bar/text").first()
+        nav = Navigation.query.where(Navigation.collection_id == collection.id).first()
+        members, start, end = get_nav(nav.references["default"], nav.paths["default"], *expected)
+    assert j["member"] == members
+    if end:
+        assert (j["start"], j["end"]) == (start, end)
+    else:
+        assert j["ref"] == start
+
+
+def test_navigation_pagination(app_factory):
+    """Check that paginated members, put together, are the members of the unpaginated response"""
+    app = app_factory(navigation_page_size=4)
+    client = app.test_client()
+    # Only the paginated endpoint advertises pages
+    entry = client.get("/").get_json()
+    assert entry["navigation"].endswith("{&ref,start,end,tree,down,page}")
+    assert entry["collection"].endswith("{?id,nav}")
+
+    base = "/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1"
+    pages = [client.get(base).get_json()]
+    assert pages[0]["view"]["@id"] == pages[0]["view"]["first"] == (
+        f"{BASE_URI}/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&tree=default&down=-1&page=1"
+    )
+    while pages[-1]["view"]["next"]:
+        pages.append(client.get(pages[-1]["view"]["next"].replace(BASE_URI, "")).get_json())
+    assert [len(page["member"]) for page in pages] == [4, 4, 3]
+    assert pages[-1]["view"]["last"] == pages[-1]["view"]["@id"]
+    assert pages[1]["view"]["previous"] == pages[0]["view"]["@id"]
+    assert pages[0]["view"]["previous"] is None
+
+    with app.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://foo.bar/text").first()
+        nav = Navigation.query.where(Navigation.collection_id == collection.id).first()
+        members, _, _ = get_nav(nav.references["default"], nav.paths["default"], down=-1)
+    assert [member for page in pages for member in page["member"]] == members
+
+    assert client.get(f"{base}&page=4").status_code == 404
+    assert client.get(f"{base}&page=0").status_code == 404
+
+
+def test_navigation_is_streamed(client):
+    response = client.get("/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1")
+    assert response.is_streamed
+    assert "view" not in response.get_json()
+    assert client.get("/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1&page=1").status_code == 400
+
+
+def test_collection_pagination(app_factory):
+    """Check that pages of members, put together, are the members of the unpaginated response"""
+    app = app_factory(collection_page_size=2)
+    with app.app_context():
+        unpaginated = collection_view(None, "children", templates={
+            "navigation": uritemplate.URITemplate(BASE_URI + "/navigation/{?resource}{&ref,start,end,tree,down}"),
+            "collection": uritemplate.URITemplate(BASE_URI + "/collection/{?id,page,nav}"),
+            "document": uritemplate.URITemplate(BASE_URI + "/document/{?resource}{&ref,start,end,tree}"),
+        }).get_json()
+    client = app.test_client()
+    assert client.get("/").get_json()["collection"].endswith("{?id,page,nav}")
+
+    first = client.get("/collection/").get_json()
+    assert first["view"] == {
+        "@id": f"{BASE_URI}/collection/?id=https%3A%2F%2Ffoo.bar%2Fdefault&page=1&nav=children",
+        "@type": "Pagination",
+        "first": f"{BASE_URI}/collection/?id=https%3A%2F%2Ffoo.bar%2Fdefault&page=1&nav=children",
+        "previous": None,
+        "next": f"{BASE_URI}/collection/?id=https%3A%2F%2Ffoo.bar%2Fdefault&page=2&nav=children",
+        "last": f"{BASE_URI}/collection/?id=https%3A%2F%2Ffoo.bar%2Fdefault&page=2&nav=children",
+    }
+    second = client.get(first["view"]["next"].replace(BASE_URI, "")).get_json()
+    assert second["view"]["next"] is None
+    assert first["member"] + second["member"] == unpaginated["member"]
+    assert first["totalChildren"] == 3
+    assert client.get("/collection/?page=3").status_code == 404
+
+    parents = client.get("/collection/?id=https%3A%2F%2Fexample.org%2Fresource1&nav=parents").get_json()
+    assert [member["@id"] for member in parents["member"]] == [
+        "https://foo.bar/default", "https://example.org/collection1"
+    ]
+
+
+@pytest.mark.parametrize("page_size", [None, 2])
+def test_collection_snapshot(app_factory, page_size):
+    """Check that collections served from the catalog snapshot are the ones built from the database"""
+    app = app_factory(collection_page_size=page_size, catalog_snapshot=True)
+    templates = {
+        "navigation": uritemplate.URITemplate(BASE_URI + "/navigation/{?resource}{&ref,start,end,tree,down}"),
+        "collection": uritemplate.URITemplate(
+            BASE_URI + ("/collection/{?id,page,nav}" if page_size else "/collection/{?id,nav}")
+        ),
+        "document": uritemplate.URITemplate(BASE_URI + "/document/{?resource}{&ref,start,end,tree}"),
+    }
+    client = app.test_client()
+    with app.app_context():
+        snapshot = app.extensions["dapitains_catalog"].snapshot
+        identifiers = [None, *[coll.identifier for coll in Collection.query.all()]]
+        pages = [None, 1, 2, 3, 0] if page_size else [None, 1]
+        for identifier in [*identifiers, "https://unknown.org"]:
+            for nav in ["children", "parents", "siblings"]:
+                for page in pages:
+                    expected = collection_view(identifier, nav, templates, page=page, page_size=page_size)
+                    response = client.get("/collection/", query_string={
+                        key: value for key, value in {"id": identifier, "nav": nav, "page": page}.items()
+                        if value is not None
+                    })
+                    assert response.status_code == expected.status_code
+                    assert response.get_data(as_text=True) == expected.get_data(as_text=True)
+
+        # Ingest swaps in a new snapshot, the previous one is left as it was
+        store_catalog()
+        assert app.extensions["dapitains_catalog"].snapshot is not snapshot
+        assert isinstance(snapshot, CatalogSnapshot)
+        assert snapshot.get(None).identifier == "https://foo.bar/default"
+
+
+def test_collection_json_does_not_mutate(app):
+    """Check that serializing a collection leaves its stored citation trees untouched"""
+    with app.app_context():
+        coll = Collection.query.where(Collection.citeStructure.isnot(None)).first()
+        before = json.dumps(coll.citeStructure)
+        coll.json()
+        coll.json(inject={"totalParents": 1})
+        assert json.dumps(coll.citeStructure) == before
+
+
+def test_collection_closure(app):
+    """Check the hierarchy queries answered by the closure table"""
+    with app.app_context():
+        root = Collection.root()
+        assert root.identifier == "https://foo.bar/default"
+        assert [coll.identifier for coll in root.descendants()] == [
+            "https://example.org/collection1", "https://example.org/resource1", "https://foo.bar/text"
+        ]
+        assert [coll.identifier for coll in root.descendants(resources_only=True)] == [
+            "https://example.org/resource1", "https://foo.bar/text"
+        ]
+        collection1 = Collection.query.where(Collection.identifier == "https://example.org/collection1").first()
+        assert [coll.identifier for coll in collection1.descendants(max_depth=1)] == ["https://example.org/resource1"]
+        resource = Collection.query.where(Collection.identifier == "https://example.org/resource1").first()
+        assert [coll.identifier for coll in resource.ancestors()] == [
+            "https://foo.bar/default", "https://example.org/collection1"
+        ]
+        assert root.ancestors() == []
+
+
+def test_closure_of_shared_collections(app_factory):
+    """Check that collections with several parents keep every ancestor, at the depth of its shortest path"""
+    app = app_factory(catalog=None)
+    edges = [(1, 2), (2, 3), (2, 4), (0, 3), (3, 4)]
+    with app.app_context():
+        db.create_all()
+        # 4 is stored first, so that it is resolved before its parents
+        collections = {number: Collection(identifier=f"https://example.org/{number}", title=str(number))
+                       for number in (4, 0, 1, 2, 3)}
+        db.session.add_all(collections.values())
+        for parent, child in edges:
+            collections[child].parents.append(collections[parent])
+        db.session.commit()
+        build_closure()
+        db.session.commit()
+
+        numbers = {collection.id: number for number, collection in collections.items()}
+        stored = {number: {} for number in collections}
+        for ancestor, descendant, depth in db.session.execute(collection_closure.select()):
+            stored[numbers[descendant]][numbers[ancestor]] = depth
+        for number in collections:
+            expected, level, depth = {number: 0}, [number], 0
+            while level:
+                depth += 1
+                level = [parent for parent, child in edges if child in level and parent not in expected]
+                expected.update({parent: depth for parent in level})
+            assert stored[number] == expected
+        assert stored[3] == {3: 0, 0: 1, 2: 1, 1: 2}
+        assert [coll.title for coll in collections[1].descendants()] == ["2", "4", "3"]
+
+
+def test_published_database(app, client, tmp_path):
+    """Check that a published database serves the responses of the one it was published from"""
+    target = str(tmp_path / "published.db")
+    with app.app_context():
+        publish_catalog(target)
+        with pytest.raises(FileExistsError):
+            publish_catalog(target)
+
+    published = sqlite3.connect(target)
+    indexes = {name for name, in published.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"ix_refs_ordinals", "ix_refs_plans"} <= indexes
+    assert published.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] > 0
+    published.close()
+
+    read_only = Flask(__name__)
+    read_only, db = create_app(read_only, base_uri=BASE_URI, read_only_database=target)
+    db.init_app(read_only)
+    read_only_client = read_only.test_client()
+    for url in [
+        "/collection/",
+        "/collection/?id=https%3A%2F%2Fexample.org%2Fresource1&nav=parents",
+        "/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1",
+        "/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201",
+        "/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201",
+    ]:
+        expected = client.get(url)
+        response = read_only_client.get(url)
+        assert response.status_code == expected.status_code == 200
+        assert response.get_data(as_text=True) == expected.get_data(as_text=True)
+
+    with read_only.app_context():
+        with pytest.raises(Exception, match="readonly"):
+            db.session.execute(Collection.__table__.delete())
+            db.session.commit()
+        db.session.rollback()
+
+
+def test_export(app, client, runner, tmp_path):
+    """Check that exported files are the responses of the application, and that unchanged ones are kept"""
+    result = runner.invoke(args=["export", str(tmp_path), "--level", "1"])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "manifest.json") as f:
+        manifest = json.load(f)
+    assert "/collection/" in manifest
+    assert "/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke&down=-1" in manifest
+    assert "/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke" in manifest
+    for uri, entry in manifest.items():
+        assert (tmp_path / entry["file"]).read_bytes() == client.get(uri).get_data()
+        # Readable by the web server, as any file created by the exporting user
+        assert os.stat(tmp_path / entry["file"]).st_mode & 0o777 == FILE_MODE
+    with open(tmp_path / "urls.map") as f:
+        assert f"\"/collection/\" /{manifest['/collection/']['file']};\n" in f.read()
+    assert result.output == f"{len(manifest)} written, 0 unchanged, 0 removed\n"
+
+    # Entries whose source changed are rendered again, the ones gone from the catalog are removed
+    manifest["/collection/"]["source"] = "changed"
+    manifest["/collection/?id=gone"] = {"file": "collection/gone.json", "source": "gone"}
+    (tmp_path / "collection" / "gone.json").write_text("{}")
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+    result = runner.invoke(args=["export", str(tmp_path)])
+    assert result.output == f"1 written, {len(manifest) - 2} unchanged, 1 removed\n"
+    assert not (tmp_path / "collection" / "gone.json").exists()
+
+    # Navigation responses embed the metadata of their resource, passages do not
+    with app.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://foo.bar/text").first()
+        collection.title = "Changed title"
+        db.session.commit()
+    result = runner.invoke(args=["export", str(tmp_path)])
+    with open(tmp_path / "manifest.json") as f:
+        updated = json.load(f)
+    navigation = "/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke&down=-1"
+    assert updated[navigation]["source"] != manifest[navigation]["source"]
+    assert "Changed title" in (tmp_path / updated[navigation]["file"]).read_text()
+    passage = "/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke"
+    assert updated[passage] == manifest[passage]
+
+
+def test_lazy_trees(app_factory, client, tmp_path):
+    """Check that trees left out at ingest are built once on their first request, as they would have been at ingest"""
+    lazy = app_factory(database=f"sqlite:///{tmp_path / 'lazy.db'}", lazy_trees=True)
+    with lazy.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://example.org/resource1").first()
+        assert collection.pending_trees == ["alpha"]
+        assert set(Navigation.query.where(Navigation.collection_id == collection.id).first().paths) == {"nums"}
+        assert {row.tree for row in Reference.query.where(Reference.collection_id == collection.id)} == {"nums"}
+
+    lazy_client = lazy.test_client()
+    url = "/navigation/?resource=https%3A%2F%2Fexample.org%2Fresource1&tree=alpha&down=1"
+    with ThreadPoolExecutor(4) as executor:
+        # Streamed responses are read in the thread that requested them
+        responses = list(executor.map(lambda _: lazy_client.get(url).get_data(as_text=True), range(4)))
+    assert responses == [client.get(url).get_data(as_text=True)] * 4
+    document = "/document/?resource=https%3A%2F%2Fexample.org%2Fresource1&tree=alpha&ref=div-xyz"
+    assert lazy_client.get(document).get_data() == client.get(document).get_data()
+
+    with lazy.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://example.org/resource1").first()
+        assert collection.pending_trees is None
+        # Built once, despite the concurrent requests
+        rows = Reference.query.where(Reference.collection_id == collection.id, Reference.tree == "alpha").all()
+        assert len(rows) == 5
+        assert build_pending_trees() == 0
+
+
+def test_build_pending_trees(app_factory):
+    """Check that trees left out at ingest are built by the background job"""
+    lazy = app_factory(lazy_trees=True)
+    result = lazy.test_cli_runner().invoke(args=["build-trees"])
+    assert result.output == "1 citation trees built\n"
+    with lazy.app_context():
+        assert Collection.query.where(Collection.pending_trees.isnot(None)).count() == 0
+        assert Reference.query.where(Reference.tree == "alpha").count() == 5
+
+
+def test_build_tree_claim(app_factory, tmp_path, monkeypatch):
+    """Check that sessions building the same tree at once, as other processes would, store it once"""
+    lazy = app_factory(database=f"sqlite:///{tmp_path / 'lazy.db'}", lazy_trees=True)
+    with lazy.app_context():
+        collection_id = Collection.query.where(Collection.identifier == "https://example.org/resource1").first().id
+
+    get_references = ingest.get_references
+
+    def slow_get_references(*args, **kwargs):
+        time.sleep(0.2)
+        return get_references(*args, **kwargs)
+
+    monkeypatch.setattr(ingest, "get_references", slow_get_references)
+    results = []
+
+    def build():
+        # Each application context has its own session, the SingleFlight of the process is not used
+        with lazy.app_context():
+            results.append(build_tree(collection_id, "alpha"))
+
+    threads = [threading.Thread(target=build) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, True]
+    with lazy.app_context():
+        assert Reference.query.where(Reference.collection_id == collection_id, Reference.tree == "alpha").count() == 5
+        assert db.session.get(Collection, collection_id).pending_trees is None
+
+
+def test_build_tree_already_stored(app_factory):
+    """Check that a tree pending while its references are stored is only removed from the pending trees"""
+    lazy = app_factory(lazy_trees=True)
+    with lazy.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://example.org/resource1").first()
+        assert build_tree(collection.id, "alpha")
+        # As left by a process storing the references without seeing the claim
+        collection.pending_trees = ["alpha"]
+        nav = Navigation.query.where(Navigation.collection_id == collection.id).first()
+        nav.paths = {key: value for key, value in nav.paths.items() if key != "alpha"}
+        db.session.commit()
+
+        assert not build_tree(collection.id, "alpha")
+        db.session.refresh(collection)
+        assert collection.pending_trees is None
+        assert "alpha" in Navigation.query.where(Navigation.collection_id == collection.id).first().paths
+        assert Reference.query.where(Reference.collection_id == collection.id, Reference.tree == "alpha").count() == 5
+        assert not build_tree(collection.id, "alpha")
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from flask import Flask
+from dapitains.app.asgi import DTSApplication, create_asgi_app
+from dapitains.app.caching import PassageCache
+from dapitains.app.ingest import store_catalog
+from dapitains.metadata.xml_parser import parse
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+BASE_URI = "http://localhost:5000"
+
+
+@pytest.fixture
+def asgi_app():
+    app = Flask(__name__)
+    asgi, db = create_asgi_app(app, base_uri=BASE_URI, passage_cache=PassageCache())
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        catalog, _ = parse(f"{basedir}/catalog/example-collection.xml")
+        store_catalog(catalog)
+    yield asgi
+    asgi.shutdown()
+
+
+async def call(asgi, path: str, query_string: str = "", messages: list = None):
+    """ Run a GET request through an ASGI application """
+    messages = [] if messages is None else messages
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi({
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+        "query_string": query_string.encode(), "headers": [(b"host", b"localhost")], "server": ("localhost", 80)
+    }, receive, send)
+    start, *bodies = messages
+    assert [body.get("more_body", False) for body in bodies] == [True] * (len(bodies) - 1) + [False]
+    return start["status"], dict(start["headers"]), b"".join(body["body"] for body in bodies)
+
+
+@pytest.mark.parametrize("path,query_string", [
+    ("/", ""),
+    ("/collection/", ""),
+    ("/collection/", "id=https%3A%2F%2Fexample.org%2Fcollection1"),
+    ("/navigation/", "resource=https%3A%2F%2Ffoo.bar%2Ftext&down=1"),
+    ("/navigation/", "resource=https%3A%2F%2Ffoo.bar%2Ftext&start=Luke%201%3A1&end=Mark%201%3A1&down=1"),
+    ("/document/", "resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201%3A1"),
+    ("/document/", "resource=https%3A%2F%2Fexample.org%2Fresource1&start=4&end=1"),
+    ("/document/", "resource=https%3A%2F%2Fexample.org%2Fresource1&ref=Unknown"),
+])
+def test_same_payloads_as_flask(asgi_app, path, query_string):
+    """Check that the ASGI application answers exactly as the Flask one"""
+    status, headers, body = asyncio.run(call(asgi_app, path, query_string))
+    response = asgi_app.app.test_client().get(f"{path}?{query_string}")
+    assert status == response.status_code
+    assert headers[b"content-type"].decode() == response.content_type
+    assert body == response.get_data()
+
+
+def test_concurrent_requests(asgi_app):
+    """Check that concurrent requests are all answered"""
+    async def run():
+        return await asyncio.gather(*[
+            call(asgi_app, "/document/", f"resource=https%3A%2F%2Fexample.org%2Fresource1&ref={ref}&tree=nums")
+            for ref in ["I", "1", "A", "4", "V"] * 4
+        ] + [call(asgi_app, "/collection/") for _ in range(20)])
+
+    results = asyncio.run(run())
+    assert [status for status, _, _ in results] == [200] * 40
+    assert len({body for _, _, body in results[:5]}) == 5
+
+
+def test_streamed_responses(asgi_app):
+    """Check that streamed responses are sent chunk by chunk"""
+    messages = []
+    status, _, body = asyncio.run(call(
+        asgi_app, "/navigation/", "resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1", messages=messages
+    ))
+    assert status == 200
+    assert len(messages) > 3
+    expected = asgi_app.app.test_client().get("/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1")
+    assert body == expected.get_data()
+
+
+def test_only_renderings_wait_for_saxon(asgi_app):
+    """Check that full documents and cached passages are not queued behind passage renderings"""
+    assert "dapitains_passages" in asgi_app.app.extensions
+    passage = "resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201%3A1"
+    asyncio.run(call(asgi_app, "/document/", passage))
+    busy, release = threading.Event(), threading.Event()
+    asgi_app.passage_pool._executor.submit(lambda: (busy.set(), release.wait(5)))
+    busy.wait(5)
+    try:
+        async def run():
+            return await asyncio.wait_for(asyncio.gather(
+                call(asgi_app, "/document/", "resource=https%3A%2F%2Ffoo.bar%2Ftext"),
+                call(asgi_app, "/document/", passage)
+            ), timeout=2)
+
+        assert [status for status, _, _ in asyncio.run(run())] == [200, 200]
+    finally:
+        release.set()
+
+
+def test_path_is_decoded_once():
+    """Check that the path of the scope, already decoded by the server, is passed on as is"""
+    environ = DTSApplication._environ({
+        "type": "http", "http_version": "1.1", "method": "GET", "path": "/collection/%25/é", "query_string": b""
+    })
+    assert environ["PATH_INFO"] == "/collection/%25/é".encode("utf8").decode("latin1")
@@ -0,0 +1,74 @@
+import os.path
+
+import pytest
+from dapitains.tei.document import Document
+from dapitains.tei.backends import LxmlBackend, SaxonBackend, qualify_xpath, select_backend
+
+local_dir = os.path.join(os.path.dirname(__file__), "tei")
+
+# Files and trees every backend must resolve identically
+CONFORMANCE = [
+    ("base_tei.xml", "default"),
+    ("multiple_tree.xml", "nums"),
+    ("multiple_tree.xml", "alpha"),
+    ("nested_attributes.xml", "nums"),
+    ("nested_attributes.xml", "ids"),
+    ("test_citeData.xml", "nums"),
+    ("test_citeData_two_levels.xml", "nums"),
+]
+
+
+@pytest.mark.parametrize("backend", ["saxon", "lxml"])
+@pytest.mark.parametrize("file,tree", CONFORMANCE)
+def test_conformance(backend, file, tree):
+    """Check that each backend gives the same references as the reference Saxon implementation"""
+    doc = Document(f"{local_dir}/{file}", backend=backend)
+    parser = doc.citeStructure[tree]
+    assert doc.get_backend(tree).name == backend
+    assert [unit.json() for unit in doc.get_reffs(tree)] == [
+        unit.json() for unit in parser.find_refs(root=doc.xml, structure=parser.structure)
+    ]
+
+
+@pytest.mark.parametrize("backend", ["saxon", "lxml"])
+def test_conformance_cite_data(backend):
+    doc = Document(f"{local_dir}/test_citeData_two_levels.xml", backend=backend)
+    assert [unit.json() for unit in doc.get_reffs()][0] == {
+        'citeType': 'part', 'identifier': 'part-1', 'parent': None, 'level': 1, 'members': [
+            {'citeType': 'book', 'identifier': 'part-1.1', 'parent': 'part-1', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ['Introduction', 'Introduction'],
+                'http://purl.org/dc/terms/creator': ['John Doe']}},
+            {'citeType': 'book', 'identifier': 'part-1.2', 'parent': 'part-1', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ["Background", 'Contexte']
+            }}
+        ], 'extension': {"http://foo.bar/part": ["1"]}}
+
+
+@pytest.mark.parametrize("backend", ["saxon", "lxml", "auto"])
+@pytest.mark.parametrize("file", ["multiple_tree.xml", "nested_attributes.xml"])
+def test_all_trees_at_once(backend, file):
+    """Check that resolving all trees at once gives the same references as one tree at a time"""
+    doc = Document(f"{local_dir}/{file}", backend=backend)
+    all_refs = doc.get_all_reffs()
+    assert list(all_refs) == list(doc.citeStructure)
+    assert {tree: [unit.json() for unit in units] for tree, units in all_refs.items()} == {
+        tree: [unit.json() for unit in Document(f"{local_dir}/{file}", backend="saxon").get_reffs(tree)]
+        for tree in doc.citeStructure
+    }
+
+
+def test_qualify_xpath():
+    assert qualify_xpath("//body/div[@n='1']") == "//tei:body/tei:div[@n='1']"
+    assert qualify_xpath(".//persName[1]/text()") == ".//tei:persName[1]/text()"
+    assert qualify_xpath("child::div[attribute::n and @xml:id]") == "child::tei:div[attribute::n and @xml:id]"
+    assert qualify_xpath("count(div) div 2") == "count(tei:div) div 2", "Operator names are kept"
+    assert qualify_xpath("string-join(./head, ' ')") is None, "XPath 2.0 functions are refused"
+
+
+def test_select_backend():
+    doc = Document(f"{local_dir}/tei_with_two_traversing_with_n.xml")
+    assert select_backend(doc.citeStructure["default"].structure) is SaxonBackend, "./ //l is not XPath 1.0"
+    with pytest.raises(ValueError):
+        select_backend(doc.citeStructure["default"].structure, preferred="lxml")
+    doc = Document(f"{local_dir}/multiple_tree.xml")
+    assert select_backend(doc.citeStructure["nums"].structure) is LxmlBackend
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from flask import Flask
+from sqlalchemy import inspect
+from dapitains.app.app import create_app
+from dapitains.app.caching import BoundedCache, SingleFlight, PassageCache
+from dapitains.app.database import Collection, db
+from dapitains.app.prefetch import Prefetcher
+from dapitains.tei.sources import source_hash
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def test_bounded_cache():
+    cache = BoundedCache(max_size=10)
+    cache.put("a", "12345")
+    cache.put("b", "1234")
+    assert cache.get("a") == "12345"
+    cache.put("c", "12")
+    # "b" is the least recently used
+    assert "b" not in cache and cache.get("a") == "12345" and cache.get("c") == "12"
+    assert cache.total_size == 7
+    cache.put("d", "x" * 11)
+    assert "d" not in cache
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def render():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "passage"
+
+    with ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(flight.do, "key", render)
+        started.wait(5)
+        followers = [executor.submit(flight.do, "key", render) for _ in range(3)]
+        time.sleep(0.05)
+        release.set()
+        assert leader.result() == ("passage", False)
+        assert [follower.result() for follower in followers] == [("passage", True)] * 3
+    assert len(calls) == 1
+
+    # Once done, the key is computed again, and errors are raised to the caller
+    with pytest.raises(ZeroDivisionError):
+        flight.do("key", lambda: 1 / 0)
+    assert flight.do("key", lambda: "again") == ("again", False)
+
+
+def test_passage_cache_in_app(app_factory):
+    cache = PassageCache()
+    app = app_factory(passage_cache=cache)
+    with app.app_context():
+        text = Collection.query.where(Collection.identifier == "https://foo.bar/text").first()
+        assert text.content_hash == source_hash(f"{basedir}/tei/base_tei.xml")
+    client = app.test_client()
+
+    url = "/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201"
+    with ThreadPoolExecutor(4) as executor:
+        responses = list(executor.map(lambda _: client.get(url), range(8)))
+    assert {response.get_data(as_text=True) for response in responses} == {responses[0].get_data(as_text=True)}
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] + stats["coalesced"] == 7
+    assert cache.cache.get(("https://foo.bar/text", "default", "Luke 1", None, text.content_hash))
+
+
+def test_prefetch_following_passage(app_factory):
+    cache, prefetcher = PassageCache(), Prefetcher()
+    app = app_factory(passage_cache=cache, prefetcher=prefetcher)
+    with app.app_context():
+        content_hash = Collection.query.where(Collection.identifier == "https://foo.bar/text").first().content_hash
+        # The following reference is sought in the document order, which is indexed at ingest
+        assert "ix_refs_ordinals" in {index["name"] for index in inspect(db.engine).get_indexes("refs")}
+    client = app.test_client()
+
+    def wait_for(counter: str, value: int):
+        for _ in range(500):
+            if prefetcher.stats()[counter] >= value:
+                return
+            time.sleep(0.01)
+        raise AssertionError(f"{counter} never reached {value}")
+
+    url = "/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref={}"
+    assert client.get(url.format("Luke%201%3A1")).status_code == 200
+    wait_for("rendered", 1)
+    # The following reference of the same level is prefetched, and served from the cache
+    following = ("https://foo.bar/text", "default", "Luke 1:2", None, content_hash)
+    assert following in cache.cache
+    response = client.get(url.format("Luke%201%3A2"))
+    assert response.get_data(as_text=True) == cache.cache.get(following)
+    assert prefetcher.stats()["hits"] == 1
+
+    # The last chapter of a book is followed by the first chapter of the next one, the last book by nothing
+    client.get(url.format("Luke%201"))
+    wait_for("rendered", 3)
+    assert ("https://foo.bar/text", "default", "Mark 1", None, content_hash) in cache.cache
+    scheduled = prefetcher.stats()["scheduled"]
+    client.get(url.format("Mark"))
+    prefetcher.shutdown()
+    stats = prefetcher.stats()
+    assert stats["scheduled"] == scheduled + 1 and stats["rendered"] == 3 and stats["failed"] == 0
+    assert stats["hit_rate"] == 1 / 3
+
+    with pytest.raises(ValueError):
+        create_app(Flask(__name__), base_uri="http://localhost:5000", prefetcher=Prefetcher())
@@ -1,6 +1,8 @@
-from dapitains.tei.citeStructure import CiteStructureParser
+from dapitains.tei.citeStructure import CiteStructureParser, units_json, iter_units
 from dapitains.constants import PROCESSOR, get_xpath_proc
 import os.path
+import random
+import re
 import pytest
 
 local_dir = os.path.join(os.path.dirname(__file__), "tei")
@@ -131,3 +133,122 @@ def test_advanced_cite_data():
                 'http://purl.org/dc/terms/creator': ['Marie Curie']
             }}
         ], 'extension': {"http://foo.bar/part": ["3"]}}]
+
+
+def test_cite_data_in_branches():
+    xml_string = """<TEI xmlns="http://www.tei-c.org/ns/1.0">
+    <teiHeader>
+        <refsDecl>
+            <citeStructure unit="book" match="//body/div" use="@n">
+                <citeStructure unit="poem" match="lg" use="@n" delim=".">
+                    <citeData use="./head/text()" property="http://purl.org/dc/terms/title"/>
+                </citeStructure>
+                <citeStructure unit="note" match="note" use="@n" delim="#">
+                    <citeData use="@type" property="http://foo.bar/type"/>
+                </citeStructure>
+            </citeStructure>
+        </refsDecl>
+    </teiHeader>
+    <text>
+    <body>
+    <div n="1">
+        <lg n="1"><head>First</head><l>Text</l></lg>
+        <note n="1" type="editorial">Note</note>
+        <lg n="2"><l>Untitled</l></lg>
+    </div>
+    </body>
+    </text>
+    </TEI>
+    """
+    TEI = PROCESSOR.parse_xml(xml_text=xml_string)
+    xpath = get_xpath_proc(elem=TEI)
+    parser = CiteStructureParser(xpath.evaluate_single("/TEI/teiHeader/refsDecl[1]"))
+    assert [root.json() for root in parser.find_refs(root=TEI, structure=parser.structure)] == [
+        {'citeType': 'book', 'identifier': '1', 'parent': None, 'level': 1, 'members': [
+            {'citeType': 'poem', 'identifier': '1.1', 'parent': '1', 'level': 2,
+             'dublinCore': {'http://purl.org/dc/terms/title': ['First']}},
+            {'citeType': 'note', 'identifier': '1#1', 'parent': '1', 'level': 2,
+             'extension': {'http://foo.bar/type': ['editorial']}},
+            {'citeType': 'poem', 'identifier': '1.2', 'parent': '1', 'level': 2},
+        ]}
+    ]
+
+
+def test_compact_units():
+    """Check that units are slotted, lazily allocated and serialized without recursion"""
+    TEI = PROCESSOR.parse_xml(xml_file_name=f"{local_dir}/test_citeData_two_levels.xml")
+    parser = CiteStructureParser(get_xpath_proc(elem=TEI).evaluate_single("/TEI/teiHeader/refsDecl[1]"))
+    refs = parser.find_refs(root=TEI, structure=parser.structure)
+
+    assert not hasattr(refs[0], "__dict__")
+    assert not hasattr(parser.structure, "__dict__")
+    leaf = refs[0].children[0]
+    assert leaf._children is None and leaf._extension is None, "Unused containers are not allocated"
+    assert units_json(refs) == [
+        {'citeType': 'part', 'identifier': 'part-1', 'parent': None, 'level': 1, 'members': [
+            {'citeType': 'book', 'identifier': 'part-1.1', 'parent': 'part-1', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ['Introduction', 'Introduction'],
+                'http://purl.org/dc/terms/creator': ['John Doe']}},
+            {'citeType': 'book', 'identifier': 'part-1.2', 'parent': 'part-1', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ["Background", 'Contexte']}}
+        ], 'extension': {"http://foo.bar/part": ["1"]}},
+        {'citeType': 'part', 'identifier': 'part-2', 'parent': None, 'level': 1, 'members': [
+            {'citeType': 'book', 'identifier': 'part-2.3', 'parent': 'part-2', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ['Methodology', 'Méthodologie'],
+                'http://purl.org/dc/terms/creator': ['Albert Einstein']}},
+            {'citeType': 'book', 'identifier': 'part-2.4', 'parent': 'part-2', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ['Results', 'Résultats'],
+                'http://purl.org/dc/terms/creator': ['Isaac Newton']}}
+        ], 'extension': {"http://foo.bar/part": ["2"]}},
+        {'citeType': 'part', 'identifier': 'part-3', 'parent': None, 'level': 1, 'members': [
+            {'citeType': 'book', 'identifier': 'part-3.5', 'parent': 'part-3', 'level': 2, 'dublinCore': {
+                'http://purl.org/dc/terms/title': ['Conclusion', 'Conclusion'],
+                'http://purl.org/dc/terms/creator': ['Marie Curie']}}
+        ], 'extension': {"http://foo.bar/part": ["3"]}}]
+    # Leaves carry no members, and their containers are left unallocated by the serialization
+    assert "members" not in units_json([leaf])[0] and leaf._children is None
+    assert [(ordinal, parent, unit.ref) for ordinal, parent, unit in iter_units(refs)] == [
+        (0, None, "part-1"), (1, 0, "part-1.1"), (2, 0, "part-1.2"),
+        (3, None, "part-2"), (4, 3, "part-2.3"), (5, 3, "part-2.4"),
+        (6, None, "part-3"), (7, 6, "part-3.5")
+    ]
+
+
+def _regex_xpath(parser: CiteStructureParser, reference: str) -> str:
+    """ Former implementation of generate_xpath, based on the regular expression """
+    match = re.match(parser.regex_pattern, reference)
+    if not match:
+        raise ValueError(f"Reference '{reference}' does not match the expected format.")
+    match = {k: v for k, v in match.groupdict().items() if v}
+    xpath = "/".join([parser.xpath_matcher[key].format(**{key: value}) for key, value in match.items()])
+    return xpath.replace("///", "//")
+
+
+@pytest.mark.parametrize("file", [
+    "base_tei.xml", "nested_attributes.xml", "test_citeData_two_levels.xml", "tei_with_two_traversing_with_n.xml"
+])
+def test_tokenizer_fuzzing(file):
+    """Check on random references that the tokenizer gives the same XPath as the regular expression"""
+    TEI = PROCESSOR.parse_xml(xml_file_name=f"{local_dir}/{file}")
+    rng = random.Random(file)
+    for refs_decl in get_xpath_proc(elem=TEI).evaluate("/TEI/teiHeader/refsDecl"):
+        parser = CiteStructureParser(refs_decl)
+        alphabet = list("ab1 :#./-\n") + ["Luke", "part-", "é"]
+        for _ in range(2000):
+            reference = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+            try:
+                expected = _regex_xpath(parser, reference)
+            except ValueError:
+                with pytest.raises(ValueError):
+                    parser.generate_xpath(reference)
+            else:
+                assert parser.generate_xpath(reference) == expected, reference
+
+
+def test_tokenizer_is_linear():
+    """Check that a long reference which does not fully match is parsed in linear time"""
+    TEI = PROCESSOR.parse_xml(xml_file_name=f"{local_dir}/base_tei.xml")
+    parser = CiteStructureParser(get_xpath_proc(elem=TEI).evaluate_single("/TEI/teiHeader/refsDecl[1]"))
+    assert parser.tokenizer.tokenize("Luke 1:" + "2" * 100000 + "\n3") == [
+        ("book", "Luke"), ("book__chapter", "1"), ("book__chapter__verse", "2" * 100000)
+    ]
@@ -0,0 +1,91 @@
+import gzip
+import os
+import shutil
+import pytest
+from dapitains.app.compression import Compression
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+BASE_URI = "http://localhost:5000"
+NAVIGATION = "/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&down=-1"
+DOCUMENT = "/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext"
+
+
+@pytest.fixture
+def compressed(app_factory, tmp_path):
+    """Application compressing its responses, on a copy of the test corpus so that variants are written there"""
+    shutil.copytree(f"{basedir}/catalog", tmp_path / "catalog")
+    shutil.copytree(f"{basedir}/tei", tmp_path / "tei")
+    compression = Compression(encodings=["gzip"])
+    app = app_factory(catalog=str(tmp_path / "catalog" / "example-collection.xml"), compression=compression)
+    return app, compression, tmp_path
+
+
+def test_compressed_responses(compressed):
+    app, compression, _ = compressed
+    client = app.test_client()
+    plain = client.get(NAVIGATION)
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    response = client.get(NAVIGATION, headers={"Accept-Encoding": "gzip, br;q=0.5"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+    assert response.mimetype == "application/ld+json"
+
+    # Passages are compressed once, and kept
+    compression.minimum_size = 0
+    passage = client.get(f"{DOCUMENT}&ref=Luke", headers={"Accept-Encoding": "gzip"})
+    assert passage.headers["Content-Encoding"] == "gzip"
+    assert passage.headers["Content-Length"] == str(len(passage.get_data()))
+    assert (f"{DOCUMENT}&ref=Luke", "gzip") in compression.cache
+
+    # The second request is answered from the compressed responses, without running the view
+    compression.cache.put((NAVIGATION, "gzip"), (gzip.compress(b"cached"), "application/ld+json"))
+    assert gzip.decompress(client.get(NAVIGATION, headers={"Accept-Encoding": "gzip"}).get_data()) == b"cached"
+
+    # Errors are not compressed
+    error = client.get("/navigation/?resource=unknown", headers={"Accept-Encoding": "gzip"})
+    assert error.status_code == 404
+    assert "Content-Encoding" not in error.headers
+
+
+def test_streamed_responses_stay_streamed(compressed):
+    app, compression, tmp_path = compressed
+    client = app.test_client()
+    plain = client.get(NAVIGATION).get_data()
+    response = client.get(NAVIGATION, headers={"Accept-Encoding": "gzip"})
+    # Streamed bodies are sent without a length, as they are compressed while they are sent
+    assert response.headers["Content-Encoding"] == "gzip" and "Content-Length" not in response.headers
+    assert gzip.decompress(response.get_data()) == plain
+    # Streamed bodies are never held in the cache
+    assert len(compression.cache) == 0
+
+    # Nor are full documents streamed from their source
+    os.remove(str(tmp_path / "tei" / "base_tei.xml.gz"))
+    response = client.get(DOCUMENT, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip" and "Content-Length" not in response.headers
+    with open(tmp_path / "tei" / "base_tei.xml", "rb") as f:
+        assert gzip.decompress(response.get_data()) == f.read()
+    assert len(compression.cache) == 0
+
+
+def test_precompressed_documents(compressed):
+    app, compression, tmp_path = compressed
+    source = str(tmp_path / "tei" / "base_tei.xml")
+    assert compression.variant(source, "gzip") == f"{source}.gz"
+
+    client = app.test_client()
+    response = client.get(DOCUMENT, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    with open(f"{source}.gz", "rb") as f:
+        assert response.get_data() == f.read()
+    with open(source, "rb") as f:
+        assert gzip.decompress(response.get_data()) == f.read()
+
+    # Outdated variants are not served
+    os.utime(f"{source}.gz", ns=(0, 0))
+    assert compression.variant(source, "gzip") is None
+    response = client.get(DOCUMENT, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    with open(source, "rb") as f:
+        assert gzip.decompress(response.get_data()) == f.read()
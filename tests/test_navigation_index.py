@@ -0,0 +1,126 @@
+import itertools
+import os
+import pytest
+from dapitains.app.database import Collection, Navigation, Reference
+from dapitains.app.navigation import select_nav
+from dapitains.app.navigation_index import NavigationIndex, NavigationIndexes, write_index
+from dapitains.errors import InvalidRangeOrder
+import uritemplate
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+BASE_URI = "http://localhost:5000"
+
+
+@pytest.fixture
+def apps(app_factory, tmp_path):
+    """Two applications on the same database, with and without navigation indexes"""
+    database = f"sqlite:///{tmp_path}/app.db"
+    indexed = app_factory(database=database, navigation_index=str(tmp_path / "indexes"))
+    plain = app_factory(database=database, catalog=None)
+    return indexed, plain
+
+
+def test_write_and_read(tmp_path):
+    paths = {"1": [0], "1.1": [0, 0], "1.2": [0, 1], "2": [1], "é": [2]}
+    write_index(str(tmp_path / "tree.nav"), paths, {ref: f'{{"identifier": "{ref}"}}' for ref in paths})
+    index = NavigationIndex(str(tmp_path / "tree.nav"))
+    assert len(index) == 5
+    # Readable as any file created by the writer, not only by its owner
+    mask = os.umask(0)
+    os.umask(mask)
+    assert os.stat(tmp_path / "tree.nav").st_mode & 0o777 == 0o666 & ~mask
+    assert [index.ref(position) for position in range(len(index))] == list(paths)
+    assert [index.depth(position) for position in range(len(index))] == [1, 2, 2, 1, 1]
+    assert index.index("é") == 4
+    assert index.member(1) == '{"identifier": "1.1"}'
+    with pytest.raises(ValueError):
+        index.index("3")
+
+
+def test_range_ends_with_subtree(tmp_path):
+    """Check that the end of a range includes its whole subtree, and nothing after it"""
+    paths = {"1": [0], "1.1": [0, 0], "1.2": [0, 1], "1.3": [0, 2], "1.4": [0, 3], "2": [1], "3": [2]}
+    write_index(str(tmp_path / "tree.nav"), paths, {ref: f'{{"identifier": "{ref}"}}' for ref in paths})
+    index = NavigationIndex(str(tmp_path / "tree.nav"))
+    expected = ["1", "1.1", "1.2", "1.3", "1.4"]
+    assert select_nav(paths, start_or_ref="1", end="1", down=-1)[0] == expected
+    positions, _, _ = index.select(start_or_ref="1", end="1", down=-1)
+    assert [index.ref(position) for position in positions] == expected
+    assert index.subtree(0) == {"identifier": "1", "members": [{"identifier": ref} for ref in expected[1:]]}
+
+
+def test_open_indexes_are_bounded(tmp_path):
+    indexes = NavigationIndexes(str(tmp_path), max_open=1)
+    for tree in ("a", "b"):
+        indexes.write("resource", tree, {"1": [0]}, {"1": '{"identifier": "1"}'})
+    first = indexes.get("resource", "a")
+    assert indexes.get("resource", "a") is first
+    indexes.get("resource", "b")
+    # Dropped once another index was mapped, and mapped again
+    assert indexes.get("resource", "a") is not first
+    first.close()
+
+
+def test_select_matches_select_nav(apps):
+    """Check that selections from the index are the ones computed from the stored paths"""
+    indexed, _ = apps
+    indexes = indexed.extensions["dapitains_navigation_index"]
+    with indexed.app_context():
+        for nav in Navigation.query.all():
+            collection = Collection.query.where(Collection.id == nav.collection_id).first()
+            for tree, paths in nav.paths.items():
+                index = indexes.get(collection.identifier, tree)
+                refs = [None, *paths]
+                for start, end, down in itertools.product(refs, refs, [0, 1, 2, -1]):
+                    try:
+                        expected = select_nav(paths, start_or_ref=start, end=end, down=down)
+                    except InvalidRangeOrder:
+                        with pytest.raises(InvalidRangeOrder):
+                            index.select(start_or_ref=start, end=end, down=down)
+                        continue
+                    except KeyError:
+                        # Start within the subtree of the end
+                        continue
+                    positions, selected_start, selected_end = index.select(start_or_ref=start, end=end, down=down)
+                    assert ([index.ref(position) for position in positions], selected_start, selected_end) == expected
+
+
+@pytest.mark.parametrize("query", [
+    {"down": 1},
+    {"down": -1},
+    {"ref": "Luke", "down": -1},
+    {"ref": "Luke 1", "down": 1},
+    {"ref": "Luke 1", "down": "0"},
+    {"ref": "Luke 1"},
+    {"ref": "Luke"},
+    {"start": "Luke 1", "end": "Mark 1"},
+    {"start": "Luke 1:1", "end": "Mark 1:2", "down": 1},
+    {"start": "Luke", "end": "Mark 1", "down": -1},
+    {"start": "Mark 1", "end": "Luke 1", "down": 1},
+    {"ref": "Luke 1", "tree": "nope", "down": 1},
+])
+def test_indexed_responses(apps, query):
+    """Check that navigation responses read from the index are the ones read from the database"""
+    indexed, plain = apps
+    template = uritemplate.URITemplate("/navigation/{?resource}{&ref,start,end,tree,down,page}")
+    url = template.expand(resource="https://foo.bar/text", **query)
+    expected = plain.test_client().get(url)
+    response = indexed.test_client().get(url)
+    assert response.status_code == expected.status_code
+    assert response.get_data(as_text=True) == expected.get_data(as_text=True)
+
+
+def test_index_is_replaced(apps):
+    """Check that indexes are mapped again when a new ingest replaces their file"""
+    indexed, _ = apps
+    indexes = indexed.extensions["dapitains_navigation_index"]
+    index = indexes.get("https://foo.bar/text", "default")
+    assert indexes.get("https://foo.bar/text", "default") is index
+    with indexed.app_context():
+        collection = Collection.query.where(Collection.identifier == "https://foo.bar/text").first()
+        rows = Reference.query.where(Reference.collection_id == collection.id, Reference.tree == "default").all()
+        indexes.write("https://foo.bar/text", "default", {"Luke": [0]}, {
+            row.ref: row.member for row in rows
+        })
+    assert len(indexes.get("https://foo.bar/text", "default")) == 1
+    assert len(index) > 1
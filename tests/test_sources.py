@@ -0,0 +1,70 @@
+import gzip
+import os
+import shutil
+import pytest
+import lxml.etree as ET
+from dapitains.app.compression import Compression
+from dapitains.tei.document import Document
+from dapitains.tei.sources import read_source
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def compress(source: str, target: str, encoding: str) -> str:
+    with open(source, "rb") as f:
+        data = f.read()
+    if encoding == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        data = gzip.compress(data)
+    with open(target, "wb") as f:
+        f.write(data)
+    return target
+
+
+@pytest.mark.parametrize("encoding,extension", [("gzip", ".gz"), ("zstd", ".zst")])
+@pytest.mark.parametrize("backend", ["saxon", "lxml"])
+def test_compressed_document(tmp_path, encoding, extension, backend):
+    source = f"{basedir}/tei/multiple_tree.xml"
+    compressed = compress(source, str(tmp_path / f"multiple_tree.xml{extension}"), encoding)
+    with open(source, "rb") as f:
+        assert read_source(compressed) == f.read()
+
+    expected, doc = Document(source, backend=backend), Document(compressed, backend=backend)
+    assert set(doc.citeStructure) == set(expected.citeStructure)
+    assert doc.get_reffs("alpha") == expected.get_reffs("alpha")
+    for tree, ref in [(None, "I"), ("alpha", "div-002")]:
+        assert ET.tostring(doc.get_passage(tree=tree, ref_or_start=ref), encoding=str) == ET.tostring(
+            expected.get_passage(tree=tree, ref_or_start=ref), encoding=str
+        )
+
+
+def test_compressed_catalog(app_factory, tmp_path):
+    """Check that compressed sources are ingested and served, as they are to clients accepting their encoding"""
+    shutil.copytree(f"{basedir}/catalog", tmp_path / "catalog")
+    os.makedirs(tmp_path / "tei")
+    shutil.copy(f"{basedir}/tei/multiple_tree.xml", tmp_path / "tei")
+    source = compress(f"{basedir}/tei/base_tei.xml", str(tmp_path / "tei" / "base_tei.xml.gz"), "gzip")
+    catalog_path = tmp_path / "catalog" / "example-collection.xml"
+    catalog_path.write_text(catalog_path.read_text().replace("base_tei.xml", "base_tei.xml.gz"))
+
+    app = app_factory(catalog=str(catalog_path), compression=Compression(["gzip"]))
+    client = app.test_client()
+
+    with open(f"{basedir}/tei/base_tei.xml") as f:
+        text = f.read()
+    response = client.get("/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext")
+    assert response.is_streamed
+    assert response.get_data(as_text=True) == text
+    response = client.get("/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    with open(source, "rb") as f:
+        assert response.get_data() == f.read()
+    # No other variant was written next to the compressed source
+    assert sorted(os.listdir(tmp_path / "tei")) == ["base_tei.xml.gz", "multiple_tree.xml", "multiple_tree.xml.gz"]
+
+    navigation = client.get("/navigation/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201&down=1").get_json()
+    assert "Luke 1:1" in [member["identifier"] for member in navigation["member"]]
+    passage = client.get("/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke%201:1")
+    assert passage.status_code == 200
@@ -0,0 +1,61 @@
+import os.path
+
+import pytest
+from dapitains.tei.document import Document
+from dapitains.tei.streaming import read_cite_structures, is_streamable, stream_refs, stream_trees
+
+local_dir = os.path.join(os.path.dirname(__file__), "tei")
+
+
+def test_read_cite_structures():
+    """Check that reading the header only gives the same trees as the Document"""
+    for file in ("base_tei.xml", "multiple_tree.xml", "test_citeData_two_levels.xml", "nested_attributes.xml"):
+        doc = Document(f"{local_dir}/{file}")
+        cite_structures, default = read_cite_structures(f"{local_dir}/{file}")
+        assert default == doc.default_tree
+        assert {key: value.structure.json() for key, value in cite_structures.items()} == {
+            key: value.structure.json() for key, value in doc.citeStructure.items()
+        }
+
+
+def test_is_streamable():
+    """Check that only simple child-axis matches and attribute uses are streamed"""
+    assert [
+        is_streamable(parser.structure)
+        for file in ("base_tei.xml", "test_citeData.xml", "tei_with_two_traversing_with_n.xml")
+        for parser in read_cite_structures(f"{local_dir}/{file}")[0].values()
+    ] == [False, False, False], "position(), citeData and child // are not streamable"
+    assert [
+        is_streamable(parser.structure)
+        for file in ("multiple_tree.xml", "nested_attributes.xml")
+        for parser in read_cite_structures(f"{local_dir}/{file}")[0].values()
+    ] == [True, True, True, True]
+
+
+@pytest.mark.parametrize("file", ["multiple_tree.xml", "nested_attributes.xml"])
+def test_stream_refs_matches_saxon(file):
+    """Check that streamed references are the same as the ones found by Saxon"""
+    doc = Document(f"{local_dir}/{file}", backend="saxon")
+    for tree, parser in doc.citeStructure.items():
+        assert [unit.json() for unit in stream_refs(f"{local_dir}/{file}", parser.structure)] == [
+            unit.json() for unit in doc.get_reffs(tree)
+        ]
+
+
+def test_stream_trees():
+    """Check that all trees of a document can be streamed in a single pass"""
+    doc = Document(f"{local_dir}/nested_attributes.xml", backend="saxon")
+    trees = stream_trees(
+        f"{local_dir}/nested_attributes.xml",
+        {tree: parser.structure for tree, parser in doc.citeStructure.items()}
+    )
+    assert list(trees) == ["nums", "ids"]
+    assert {tree: [unit.json() for unit in units] for tree, units in trees.items()} == {
+        tree: [unit.json() for unit in doc.get_reffs(tree)] for tree in doc.citeStructure
+    }
+
+
+def test_stream_refs_refuses_complex_structures():
+    doc = Document(f"{local_dir}/base_tei.xml")
+    with pytest.raises(ValueError):
+        stream_refs(f"{local_dir}/base_tei.xml", doc.citeStructure[doc.default_tree].structure)
@@ -0,0 +1,48 @@
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from lxml import etree
+from dapitains.tei.document import Document
+
+local_dir = os.path.join(os.path.dirname(__file__), "tei")
+
+PASSAGES = [
+    ("base_tei.xml", "Luke 1:1", None, None),
+    ("base_tei.xml", "Luke 1:1", "Luke 1#1", None),
+    ("multiple_tree.xml", "I", None, "nums"),
+    ("multiple_tree.xml", "div-002", None, "alpha"),
+    ("nested_attributes.xml", None, None, None),
+]
+
+
+def render(doc: Document, ref, end, tree) -> str:
+    if ref is None:
+        return etree.tostring(doc.get_passage(doc.get_reffs()[0].ref), encoding=str)
+    return etree.tostring(doc.get_passage(ref, end=end, tree=tree), encoding=str)
+
+
+@pytest.mark.parametrize("backend", ["saxon", "auto"])
+def test_shared_documents_under_threads(backend):
+    """Hammer get_passage and get_reffs on shared and thread-local documents from many threads"""
+    shared = {file: Document(f"{local_dir}/{file}", backend=backend) for file, *_ in PASSAGES}
+    expected_passages = [render(shared[file], ref, end, tree) for file, ref, end, tree in PASSAGES]
+    expected_refs = {
+        file: {tree: [unit.json() for unit in units] for tree, units in doc.get_all_reffs().items()}
+        for file, doc in shared.items()
+    }
+
+    def job(index: int):
+        file, ref, end, tree = PASSAGES[index % len(PASSAGES)]
+        # Every other job builds its own document, the others share one
+        doc = shared[file] if index % 2 else Document(f"{local_dir}/{file}", backend=backend)
+        refs = {tree: [unit.json() for unit in units] for tree, units in doc.get_all_reffs().items()}
+        return render(doc, ref, end, tree), refs
+
+    with ThreadPoolExecutor(16) as threads:
+        results = list(threads.map(job, range(160)))
+
+    for index, (passage, refs) in enumerate(results):
+        file = PASSAGES[index % len(PASSAGES)][0]
+        assert passage == expected_passages[index % len(PASSAGES)]
+        assert refs == expected_refs[file]
@@ -0,0 +1,81 @@
+import os
+import shutil
+import time
+from dapitains.app.caching import PassageCache
+from dapitains.app.compression import Compression
+from dapitains.app.warmup import Warmup
+from dapitains.tei.sources import source_hash
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+TEXT = "https://foo.bar/text"
+ACCESS_LOG = [
+    '127.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke '
+    'HTTP/1.1" 200 512 "-" "curl/8.0"',
+    '127.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke '
+    'HTTP/1.1" 200 512 "-" "curl/8.0"',
+    f"{TEXT} Mark 1",
+    f"{TEXT} Mark",
+]
+
+
+def cached_refs(cache: PassageCache):
+    content_hash = source_hash(f"{basedir}/tei/base_tei.xml")
+    return {ref for ref in ("Luke", "Mark 1", "Mark") if (TEXT, "default", ref, None, content_hash) in cache.cache}
+
+
+def test_warmup_on_first_request(app_factory):
+    cache = PassageCache()
+    warmup = Warmup(ACCESS_LOG)
+    app = app_factory(warmup=warmup, passage_cache=cache)
+    assert len(cache.cache) == 0 and not warmup.done
+
+    # The first request waits for the warm-up, and is then served from the cache
+    response = app.test_client().get("/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Mark%201")
+    assert response.status_code == 200
+    assert warmup.done and warmup.report.warmed == 3 and not warmup.report.failed
+    assert cached_refs(cache) == {"Luke", "Mark 1", "Mark"}
+    assert cache.stats()["hits"] == 1
+    assert warmup.run() is None
+
+
+def test_warmup_budget_and_background(app_factory):
+    cache = PassageCache()
+    warmup = Warmup(ACCESS_LOG, budget=1, background=True)
+    app = app_factory(warmup=warmup, passage_cache=cache)
+    assert app.test_client().get("/").status_code == 200
+    for _ in range(500):
+        if warmup.done:
+            break
+        time.sleep(0.01)
+    # Only the most requested passage fits in the budget
+    assert warmup.report.warmed == 1 and warmup.report.skipped == 2
+    assert cached_refs(cache) == {"Luke"}
+
+
+def test_warmup_command(app_factory, tmp_path):
+    hot_list = tmp_path / "hot.txt"
+    hot_list.write_text("\n".join(ACCESS_LOG + [f"{TEXT} Unknown"]))
+    cache = PassageCache()
+    app = app_factory(passage_cache=cache)
+    result = app.test_cli_runner().invoke(args=["warmup", str(hot_list), "--limit", "4"])
+    assert result.exit_code == 0, result.output
+    assert "4 requests warmed" in result.output
+    assert "Failed: /document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Unknown" in result.output
+    assert cached_refs(cache) == {"Luke", "Mark 1", "Mark"}
+
+
+def test_warmup_each_encoding(app_factory, tmp_path):
+    # Compressed variants of the sources are written at ingest, next to a copy of the test corpus
+    shutil.copytree(f"{basedir}/catalog", tmp_path / "catalog")
+    shutil.copytree(f"{basedir}/tei", tmp_path / "tei")
+    cache, compression = PassageCache(), Compression(encodings=["gzip"], minimum_size=0)
+    warmup = Warmup([f"{TEXT} Luke"])
+    app_factory(
+        catalog=str(tmp_path / "catalog" / "example-collection.xml"), warmup=warmup, passage_cache=cache,
+        compression=compression
+    )
+    report = warmup.run()
+    assert report.warmed == 1 and not report.failed
+    # Uncompressed passages and gzip responses are both ready
+    assert cached_refs(cache) == {"Luke"}
+    assert ("/document/?resource=https%3A%2F%2Ffoo.bar%2Ftext&ref=Luke", "gzip") in compression.cache
@@ -0,0 +1,77 @@
+import os.path
+
+import pytest
+from dapitains.app.workers import PassagePool, PoolBusy, PassageTimeout, render_passage
+from dapitains.tei.document import Document
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+local_dir = os.path.join(basedir, "tei")
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = PassagePool(workers=2, timeout=60)
+    yield pool
+    pool.shutdown()
+
+
+def test_pool_renders_like_the_document(pool):
+    """Check that passages rendered by workers are the ones rendered in process"""
+    for file, ref, end, tree in [
+        ("base_tei.xml", "Luke 1:1", "Luke 1#1", None),
+        ("multiple_tree.xml", "I", None, "nums"),
+        ("multiple_tree.xml", "div-002", None, "alpha"),
+    ]:
+        doc = Document(f"{local_dir}/{file}")
+        assert pool.render(f"{local_dir}/{file}", ref, end=end, tree=tree) == render_passage(
+            doc, ref, end=end, tree=tree
+        )
+
+
+def test_pool_reloads_modified_sources(pool, tmp_path):
+    """Check that workers parse a source again once it changed, rather than keeping the document of its former version"""
+    path = str(tmp_path / "base_tei.xml")
+    with open(f"{local_dir}/base_tei.xml") as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(text)
+    assert "<div>Text</div>" in pool.render(path, "Luke 1:1", content_hash="first")
+    with open(path, "w") as f:
+        f.write(text.replace("<div>Text</div>", "<div>Modified</div>"))
+    assert "<div>Text</div>" in pool.render(path, "Luke 1:1", content_hash="first"), "Same version, same document"
+    assert "<div>Modified</div>" in pool.render(path, "Luke 1:1", content_hash="second")
+    # Without the hash, the modification time tells the versions apart
+    assert "<div>Modified</div>" in pool.render(path, "Luke 1:1")
+    with open(path, "w") as f:
+        f.write(text.replace("<div>Text</div>", "<div>Again</div>"))
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    assert "<div>Again</div>" in pool.render(path, "Luke 1:1")
+
+
+def test_pool_affinity(pool):
+    """Check that a file is always sent to the same worker"""
+    assert pool._executor(f"{local_dir}/base_tei.xml") is pool._executor(f"{local_dir}/base_tei.xml")
+
+
+def test_pool_backpressure_and_timeout():
+    """Check that requests are refused when the pool is full, and abandoned after the timeout"""
+    pool = PassagePool(workers=1, timeout=0.0001, max_pending=1)
+    try:
+        with pytest.raises(PassageTimeout):
+            # The first call starts the worker process, which takes longer than the timeout
+            pool.render(f"{local_dir}/base_tei.xml", "Luke 1:1")
+        with pytest.raises(PoolBusy):
+            pool.render(f"{local_dir}/base_tei.xml", "Luke 1:1")
+    finally:
+        pool.shutdown()
+
+
+def test_document_view_with_pool(app_factory, pool):
+    """Check the document route when passages are rendered by a pool"""
+    app = app_factory(passage_pool=pool)
+    client = app.test_client()
+    response = client.get("/document/?resource=https%3A%2F%2Fexample.org%2Fresource1&ref=I&tree=nums")
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == render_passage(
+        Document(f"{local_dir}/multiple_tree.xml"), "I", tree="nums"
+    )